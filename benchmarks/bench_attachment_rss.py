@@ -0,0 +1,49 @@
+""" Peak RSS of building the attachment of a large document: read_file_contents + pack + Attachement.make
+    against MappedFile + Attachement.make_packed. Each variant runs in its own process.
+
+    Run from this directory:
+        PYTHONPATH=../src python bench_attachment_rss.py [size in MB]
+"""
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def build(mode, filename):
+    from crypto import AESKey
+    from model import Attachement
+    from serialization import MsgpackSerialize
+    from utils import read_file_contents, MappedFile
+    key = AESKey.generate()
+    start = time.perf_counter()
+    if mode == "bytes":
+        data = {"IdentityDocument": read_file_contents(filename)}
+        attachement = Attachement.make(key, MsgpackSerialize.pack(data), [])
+    else:
+        with MappedFile(filename) as document:
+            attachement = Attachement.make_packed(key, {"IdentityDocument": document}, [])
+    elapsed = time.perf_counter() - start
+    # ru_maxrss is in KB on Linux
+    print("%-7s %6.2fs  peak RSS %5d MB  (container %d MB)" % (mode, elapsed,
+          resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024, len(attachement.objectContainer) >> 20))
+
+
+def main(size_mb):
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "document.bin")
+        with open(filename, "wb") as fout:
+            for _ in range(size_mb):
+                fout.write(os.urandom(1024 * 1024))
+        print("document: %d MB" % size_mb)
+        for mode in ("bytes", "mapped"):
+            subprocess.check_call([sys.executable, __file__, "--run", mode, filename])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--run":
+        build(sys.argv[2], sys.argv[3])
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
@@ -0,0 +1,43 @@
+""" Throughput of PSS signing and OAEP key wrapping: serial vs cryptopool.CryptoExecutor with 1..N workers
+
+    Run from this directory:
+        PYTHONPATH=../src python bench_crypto_executor.py [key size] [messages]
+"""
+import os
+import sys
+import time
+from crypto import RSAKey, AESKey
+from cryptopool import CryptoExecutor
+
+
+def throughput(name, func, count):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    rate = count / elapsed
+    print("%-40s %10.1f ops/s" % (name, rate))
+    return rate
+
+
+def main(size=2048, count=400):
+    key = RSAKey.generate(size)
+    public_keys = [RSAKey.generate(size).public_key() for _ in range(4)]
+    messages = [os.urandom(512) for _ in range(count)]
+    aeskey = AESKey.generate()
+    print("%d bits, %d messages, %d cpus" % (size, count, os.cpu_count()))
+    serial_sign = throughput("sign serial", lambda: [key.sign(m) for m in messages], count)
+    serial_wrap = throughput("wrap serial", lambda: [k.encrypt(aeskey.key) for _ in range(count // len(public_keys)) for k in public_keys], count)
+    for workers in sorted(set([2 ** i for i in range(os.cpu_count().bit_length())] + [os.cpu_count()])):
+        with CryptoExecutor(workers) as executor:
+            # warm up: start the processes and import the keys
+            executor.sign_many(key, messages[:workers * 16])
+            executor.wrap_key(aeskey.key, public_keys * workers)
+            rate = throughput("sign %d workers" % workers, lambda: executor.sign_many(key, messages), count)
+            print("%-40s %10.2fx" % ("", rate / serial_sign))
+            rate = throughput("wrap %d workers" % workers,
+                              lambda: executor.wrap_key(aeskey.key, public_keys * (count // len(public_keys))), count)
+            print("%-40s %10.2fx" % ("", rate / serial_wrap))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
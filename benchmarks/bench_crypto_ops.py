@@ -0,0 +1,50 @@
+""" Per operation cost of RSAKey (OAEP encrypt/decrypt, PSS sign/verify) at 1024, 2048 and 4096 bits,
+    with the contexts created for each call (as before) and reused by RSAKey, and of AESKey for small messages
+
+    Run from this directory:
+        PYTHONPATH=../src python bench_crypto_ops.py
+"""
+import timeit
+from Crypto.Cipher import PKCS1_OAEP
+from Crypto.Hash import SHA256
+from Crypto.Signature import pss
+from crypto import RSAKey, AESKey
+
+
+def per_call(func, number):
+    return timeit.timeit(func, number=number) / number * 1e6
+
+
+def bench_rsa(size, number):
+    key = RSAKey.generate(size)
+    public_key = key.public_key()
+    data = b"\x01" * 32
+    wrapped = public_key.encrypt(data)
+    signature = key.sign(data)
+    operations = [("encrypt", lambda: PKCS1_OAEP.new(public_key.key).encrypt(data), lambda: public_key.encrypt(data)),
+                  ("decrypt", lambda: PKCS1_OAEP.new(key.key).decrypt(wrapped), lambda: key.decrypt(wrapped)),
+                  ("sign", lambda: pss.new(key.key).sign(SHA256.new(data)), lambda: key.sign(data)),
+                  ("verify", lambda: pss.new(public_key.key).verify(SHA256.new(data), signature),
+                   lambda: public_key.verify(data, signature))]
+    for name, fresh, reused in operations:
+        print("RSA %4d %-8s new context %9.1fus  reused %9.1fus" % (size, name, per_call(fresh, number),
+                                                                     per_call(reused, number)))
+
+
+def bench_aes(size, number):
+    key = AESKey.generate()
+    data = b"\x01" * size
+    encrypted = key.encrypt(data)
+    print("AES %6d bytes encrypt %7.1fus  decrypt %7.1fus" % (size, per_call(lambda: key.encrypt(data), number),
+                                                              per_call(lambda: key.decrypt(encrypted), number)))
+
+
+def main():
+    for size, number in ((1024, 500), (2048, 100), (4096, 20)):
+        bench_rsa(size, number)
+    for size in (64, 1024, 65536):
+        bench_aes(size, 2000)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+""" Enveloppes to 1, 10 and 100 recipients: time per enveloppe and size of the ACL for the key wrapping schemes
+    (keywrap.RSAOAEPKeyWrap, keywrap.BatchedKeyWrap on a CryptoExecutor, one recipient per task or by chunks)
+
+    Run from this directory:
+        PYTHONPATH=../src python bench_keywrap.py [key size] [enveloppes]
+"""
+import os
+import sys
+import time
+from crypto import RSAKey
+from cryptopool import CryptoExecutor
+from keywrap import RSAOAEPKeyWrap, BatchedKeyWrap
+from main import TelefericClient
+from model import InviteRegistration, Address
+from serialization import MsgpackSerialize
+
+
+class PublicKeyServer():
+    def __init__(self, keys):
+        self.public_keys = {key.address(): key.public_key() for key in keys}
+
+    def get_pubkey_for_address(self, addr):
+        return self.public_keys.get(addr)
+
+
+def body(i):
+    return InviteRegistration("http://api.bitstamp.com/teleferic", Address("2nPfgysH5URwM6mcknqwNEgbCi9C36oQsdZ"),
+                              Address("2n9hLLzhpn4ueRHYoJBtcR7JkmtcV4omzLK"), b"\x03" * 32, i, b"\x04" * 45)
+
+
+def run(name, client, sender_key, destinations, count):
+    batch = [(sender_key, 0, destinations, body(i)) for i in range(count)]
+    start = time.perf_counter()
+    enveloppes = client.make_enveloppes(batch)
+    elapsed = (time.perf_counter() - start) / count
+    ACL_size = sum(len(wrapped) for wrapped in enveloppes[0].ACL.values())
+    print("  %-26s %8.2f ms/enveloppe  ACL %6d bytes  enveloppe %6d bytes" % (
+        name, elapsed * 1000, ACL_size, len(MsgpackSerialize.pack(enveloppes[0]))))
+
+
+def main(size=2048, count=20):
+    sender_key = RSAKey.generate(size)
+    keys = [RSAKey.generate(size) for _ in range(100)]
+    server = PublicKeyServer(keys)
+    print("%d bits, %d enveloppes, %d cpus" % (size, count, os.cpu_count()))
+    with CryptoExecutor() as executor:
+        # warm up: start the processes and import the keys
+        executor.wrap_key(b"\x00" * 32, [key.public_key() for key in keys] * 2)
+        executor.sign_many(sender_key, [b"warm up"] * 16)
+        for recipients in (1, 10, 100):
+            destinations = [(key.address(), 0) for key in keys[:recipients]]
+            print("%d recipients" % recipients)
+            run("RSAOAEPKeyWrap", TelefericClient(server, key_wrap=RSAOAEPKeyWrap()), sender_key, destinations, count)
+            run("BatchedKeyWrap chunk 1", TelefericClient(server, executor, key_wrap=BatchedKeyWrap(executor, 1)),
+                sender_key, destinations, count)
+            run("BatchedKeyWrap chunk 8", TelefericClient(server, executor, key_wrap=BatchedKeyWrap(executor, 8)),
+                sender_key, destinations, count)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,40 @@
+""" Metahashes of many forms: get_metadata_dict form after form against get_metadata_batch
+
+    Run from this directory:
+        PYTHONPATH=../src python bench_metadata.py
+"""
+from concurrent.futures import ThreadPoolExecutor
+import random
+import timeit
+from forms import get_metadata_dict, get_metadata_batch
+from main import SaltStorage
+
+
+def make_forms(count):
+    cities = ["Luxembourg", "Paris", "Berlin", "London"]
+    return [{"Name": "Name%d" % (i % 1000),
+             "Surname": "Surname%d" % (i % 500),
+             "AddressLine1": "%d Main Street" % i,
+             "PostalCode": str(1000 + i % 300),
+             "City": cities[i % 4],
+             "Country": "Luxembourg",
+             "Email": "user%d@example.com" % i,
+             "PhoneNumber": "+352%08d" % i} for i in range(count)]
+
+
+def main():
+    forms = make_forms(10000)
+    random.seed(0)
+    salt_storage = SaltStorage()
+    # The salts are created by the first run, the timings do not include them
+    get_metadata_batch(forms, salt_storage)
+    per_form = timeit.timeit(lambda: [get_metadata_dict(data, salt_storage) for data in forms], number=3) / 3
+    batch = timeit.timeit(lambda: get_metadata_batch(forms, salt_storage), number=3) / 3
+    print("%d forms: per form %.1fms, batch %.1fms" % (len(forms), per_form * 1000, batch * 1000))
+    with ThreadPoolExecutor(4) as executor:
+        pooled = timeit.timeit(lambda: get_metadata_batch(forms, salt_storage, executor), number=3) / 3
+    print("batch with 4 threads %.1fms" % (pooled * 1000))
+
+
+if __name__ == "__main__":
+    main()
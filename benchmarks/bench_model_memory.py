@@ -0,0 +1,55 @@
+""" Memory per instance of the slotted model classes (utils.add_slots) against the same frozen dataclasses
+    without __slots__. The field values are shared by all the instances: only the instances are measured.
+
+    Run from this directory:
+        PYTHONPATH=../src python bench_model_memory.py [number of instances]
+"""
+import dataclasses
+import datetime
+import sys
+import time
+import tracemalloc
+from model import Address, Assertion, Attachement, MessageEnveloppe
+
+
+def plain(cls):
+    """ The frozen dataclass of cls, without __slots__ """
+    fields = []
+    for field in dataclasses.fields(cls):
+        if field.default is not dataclasses.MISSING:
+            fields.append((field.name, field.type, dataclasses.field(default=field.default)))
+        else:
+            fields.append((field.name, field.type))
+    return dataclasses.make_dataclass("Plain" + cls.__name__, fields, frozen=True)
+
+
+def measure(cls, args, count):
+    tracemalloc.start()
+    start = time.perf_counter()
+    instances = [cls(*args) for _ in range(count)]
+    elapsed = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # The list itself is not part of the instances
+    memory -= sys.getsizeof(instances)
+    return memory / count, elapsed / count * 1e6
+
+
+def main(count):
+    address = Address("2nPfgysH5URwM6mcknqwNEgbCi9C36oQsdZ")
+    attachement = Attachement(b"\x07" * 32, b"\x06" * 128, b"\x08" * 300, b"\x0b" * 32, [])
+    cases = [(Attachement, (b"\x07" * 32, b"\x06" * 128, b"\x08" * 300, b"\x0b" * 32, [])),
+             (MessageEnveloppe, (b"\x04" * 32, b"\x05" * 32, address, b"\x06" * 128, b"message", {},
+                                 [attachement])),
+             (Assertion.Metadata, (b"\x01" * 40, "value")),
+             (Assertion, (address, datetime.date(2020, 1, 1), datetime.date(2020, 1, 1), b"\x02" * 32, {}))]
+    print("%d instances" % count)
+    for cls, args in cases:
+        plain_bytes, plain_us = measure(plain(cls), args, count)
+        slotted_bytes, slotted_us = measure(cls, args, count)
+        print("%-18s plain %4d bytes %5.2fus   slotted %4d bytes %5.2fus" % (cls.__qualname__, plain_bytes, plain_us,
+                                                                          slotted_bytes, slotted_us))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
@@ -0,0 +1,55 @@
+""" Sustained msgs/sec of TelefericClient.send_message against pipeline.EnveloppePipeline
+
+    Run from this directory:
+        PYTHONPATH=../src python bench_pipeline.py [messages] [sign workers]
+"""
+import os
+import sys
+import tempfile
+import time
+from crypto import RSAKey
+from main import TelefericServer, TelefericClient
+from model import Address, InviteRegistration
+from pipeline import EnveloppePipeline
+
+
+def make_batch(sender_key, receivers, count):
+    return [(sender_key, 0, receivers,
+             InviteRegistration("http://api.bitstamp.com/teleferic", Address("2nPfgysH5URwM6mcknqwNEgbCi9C36oQsdZ"),
+                                Address("2n9hLLzhpn4ueRHYoJBtcR7JkmtcV4omzLK"), os.urandom(32), i, os.urandom(45)))
+            for i in range(count)]
+
+
+def main(count=500, sign_workers=2):
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tempdir:
+        # TelefericServer keeps its key in the current directory
+        os.chdir(tempdir)
+        try:
+            sender_key = RSAKey.generate(2048)
+            receiver_keys = [RSAKey.generate(2048) for _ in range(2)]
+            server = TelefericServer(dict((key.address(), key.public_key()) for key in [sender_key] + receiver_keys))
+            client = TelefericClient(server)
+            receivers = [(key.address(), 0) for key in receiver_keys]
+            batch = make_batch(sender_key, receivers, count)
+
+            start = time.perf_counter()
+            for entry in batch:
+                client.send_message(*entry)
+            elapsed = time.perf_counter() - start
+            print("%-30s %10.1f msgs/s" % ("send_message", count / elapsed))
+
+            with EnveloppePipeline(client, {"sign": sign_workers, "wrap": sign_workers}) as pipeline:
+                start = time.perf_counter()
+                pipeline.map(batch)
+                elapsed = time.perf_counter() - start
+                stats = pipeline.stats()
+            print("%-30s %10.1f msgs/s" % ("EnveloppePipeline", count / elapsed))
+            for name, (latency, depth, max_depth) in stats.items():
+                print("    %-10s mean %8.3f ms  max %8.3f ms  max queue depth %d" % (name, latency.mean * 1000, latency.max * 1000, max_depth))
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
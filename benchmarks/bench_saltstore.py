@@ -0,0 +1,49 @@
+""" LogSaltStore opening time: scanning the log against restoring the index snapshot
+
+    Run from this directory:
+        PYTHONPATH=../src python bench_saltstore.py [number of salts]
+"""
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from saltstore import LogSaltStore, salt_key
+
+
+def timed_open(filename):
+    tracemalloc.start()
+    start = time.perf_counter()
+    store = LogSaltStore(filename, snapshot_threshold=None)
+    elapsed = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return store, elapsed, memory
+
+
+def main(count):
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "salts.log")
+        # No automatic snapshot: the first opening scans the whole log
+        store = LogSaltStore(filename, snapshot_threshold=None)
+        keys = [salt_key("dossier", i) for i in range(count)]
+        start = time.perf_counter()
+        for key in keys:
+            store.put(key, os.urandom(40))
+        print("%d puts: %.2fs" % (count, time.perf_counter() - start))
+        store.close()
+        store, elapsed, memory = timed_open(filename)
+        print("open, scanning the log:   %.2fs, index %d MB" % (elapsed, memory >> 20))
+        store.snapshot()
+        store.close()
+        store, elapsed, memory = timed_open(filename)
+        print("open, from the snapshot:  %.2fs, index %d MB" % (elapsed, memory >> 20))
+        start = time.perf_counter()
+        for key in keys[:10000]:
+            store.get(key)
+        print("10000 uncached gets: %.2fs" % (time.perf_counter() - start))
+        store.close()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
@@ -0,0 +1,100 @@
+""" Compares the compiled MsgpackSerialize plans with the reflective reference implementation,
+    and the peak memory of pack (struct tree + packb) against the single pass encoder
+
+    Run from this directory:
+        PYTHONPATH=../src:../test python bench_serialization.py
+"""
+import datetime
+import os
+import tempfile
+import timeit
+import tracemalloc
+from model import Address, Message, MessageEnveloppe, ServiceRegistration, ServiceDocument,\
+    ServiceAttestation, DestinationType, RegistrationRequest, BodyType, Attachement, Assertion
+from forms import XForm
+from serialization import MsgpackSerialize
+from reflective_serialization import ReflectiveMsgpackSerialize
+
+
+def sample_objects():
+    registration = ServiceRegistration("exchange",
+                                       Address('2n9hLLzhpn4ueRHYoJBtcR7JkmtcV4omzLK'),
+                                       datetime.date(2018, 1, 1),
+                                       None,
+                                       "Bitstamp",
+                                       "Cryptocurrency Exchange",
+                                       b"",
+                                       [ServiceDocument(XForm(["IdentityDocument"]),
+                                                        [ServiceAttestation(Address('2n6HW4uS6Wqq8e4vgkQHnniCu3yrhvjHHHF'),
+                                                                            ["MRZ", "Fraud", "PEP", "Sanction"],
+                                                                            DestinationType.SendServiceProvider,
+                                                                            0)]),
+                                        ServiceDocument(XForm(["Name", "Surname", "City", "Country"]), [])])
+    message = Message(1, 2, b"\x01" * 40, BodyType.RegistrationRequest,
+                      RegistrationRequest(b"\x02" * 32, b"\x03" * 128, "AccountLevel1", "30819f30", "nickname1"))
+    assertion = Assertion(Address('2n4gSd2aVC6Dep5ECS4NRCw3AG2p73r7DcM'),
+                          datetime.date(2020, 1, 1),
+                          datetime.date(2020, 1, 1),
+                          b"\x04" * 32,
+                          {"Name" : Assertion.Metadata(b"\x05" * 40, "John"),
+                           "Surname" : Assertion.Metadata(b"\x06" * 40, "Doe")})
+    enveloppe = MessageEnveloppe(b"\x07" * 32,
+                                 b"\x08" * 32,
+                                 Address('2n4gSd2aVC6Dep5ECS4NRCw3AG2p73r7DcM'),
+                                 b"\x09" * 128,
+                                 b"\x0a" * 512,
+                                 {Address('2n6HW4uS6Wqq8e4vgkQHnniCu3yrhvjHHHF'): b"\x0b" * 128},
+                                 [Attachement(b"\x0c" * 32, b"\x0d" * 128, b"\x0e" * 1024, b"\x0f" * 32, [b"\x10" * 32] * 3)] * 3)
+    return [("ServiceRegistration", registration), ("Message", message),
+            ("Assertion", assertion), ("MessageEnveloppe", enveloppe)]
+
+
+def bench(name, func, number):
+    seconds = min(timeit.repeat(func, number=number, repeat=5))
+    print("%-45s %10.2f us/op" % (name, seconds / number * 1e6))
+    return seconds
+
+
+def large_enveloppe(attachement_size=8 * 1024 * 1024, count=3):
+    return MessageEnveloppe(b"\x07" * 32,
+                            b"\x08" * 32,
+                            Address('2n4gSd2aVC6Dep5ECS4NRCw3AG2p73r7DcM'),
+                            b"\x09" * 128,
+                            b"\x0a" * 512,
+                            {},
+                            [Attachement(None, None, os.urandom(attachement_size), None, []) for _ in range(count)])
+
+
+def peak_memory(name, func):
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("%-45s %10.2f MB peak" % (name, peak / 1024 / 1024))
+
+
+def main_memory():
+    enveloppe = large_enveloppe()
+    peak_memory("MessageEnveloppe 3x8MB pack", lambda: MsgpackSerialize.pack(enveloppe))
+    peak_memory("MessageEnveloppe 3x8MB pack_stream", lambda: MsgpackSerialize.pack_stream(enveloppe))
+    with tempfile.TemporaryFile() as fout:
+        peak_memory("MessageEnveloppe 3x8MB dump", lambda: MsgpackSerialize.dump(enveloppe, fout))
+
+
+def main(number=2000):
+    for name, obj in sample_objects():
+        objtype = type(obj)
+        packed = MsgpackSerialize.pack(obj)
+        assert packed == ReflectiveMsgpackSerialize.pack(obj)
+        reflective = bench(name + " pack (reflective)", lambda: ReflectiveMsgpackSerialize.pack(obj), number)
+        compiled = bench(name + " pack (compiled)", lambda: MsgpackSerialize.pack(obj), number)
+        print("%-45s %10.2fx" % ("", reflective / compiled))
+        bench(name + " pack_stream", lambda: MsgpackSerialize.pack_stream(obj), number)
+        reflective = bench(name + " unpack (reflective)", lambda: ReflectiveMsgpackSerialize.unpack(objtype, packed), number)
+        compiled = bench(name + " unpack (compiled)", lambda: MsgpackSerialize.unpack(objtype, packed), number)
+        print("%-45s %10.2fx" % ("", reflective / compiled))
+
+
+if __name__ == '__main__':
+    main()
+    main_memory()
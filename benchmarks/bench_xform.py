@@ -0,0 +1,82 @@
+""" XForm rendering of the field catalogue (bottom of forms.py): ElementTree + minidom round trip,
+    one pass serializer (uncached) and cached to_xform
+
+    Run from this directory:
+        PYTHONPATH=../src python bench_xform.py
+"""
+import timeit
+import xml.dom.minidom
+from xml.etree.ElementTree import tostring
+from forms import XForm, StringField, IntegerField, DateField, EnumField, BooleanField, FloatField, FileField,\
+    render_xml
+
+
+CATALOGUE = [StringField("Name"),
+             IntegerField("DocumentType"),
+             StringField("DocumentIssuer"),
+             DateField("DocumentIssueDate"),
+             DateField("DocumentExpDate"),
+             StringField("RegisteredAddress"),
+             EnumField("Gender", allowed_values=("M", "F", "U")),
+             StringField("Occupation"),
+             StringField("BirthName"),
+             StringField("FamilyName"),
+             StringField("GivenName"),
+             StringField("EyeColor"),
+             StringField("Heigh"),
+             StringField("Weight"),
+             StringField("ConvictedOf"),
+             StringField("Position"),
+             StringField("Ethnicity"),
+             StringField("ProductProduced"),
+             DateField("Inception"),
+             StringField("OfficialWebsite"),
+             DateField("DissolutionDate"),
+             StringField("PoliticalAlignement"),
+             StringField("LegalEntityID"),
+             StringField("TotalRevenue"),
+             StringField("TickerSymbol"),
+             StringField("OpenCorporateID"),
+             StringField("LegalForm"),
+             StringField("Employer"),
+             StringField("EmployerPersona"),
+             BooleanField("DocumentAccepted"),
+             BooleanField("MRZAccepted"),
+             StringField("IBAN"),
+             StringField("BIC"),
+             StringField("ClientNumber"),
+             StringField("CardNumber"),
+             DateField("CardExp"),
+             StringField("CardCVV"),
+             StringField("CardName"),
+             StringField("MatchObject"),
+             FloatField("MatchScore")] +\
+            [FileField(name) for name in ("GeneralDocument", "Passport", "DriverLicense", "NationalID",
+                                          "RegionalIdentityCard", "BirthCertificate", "SocialSecurityCard",
+                                          "ResidencePermitOrVisa", "StudentIdentityCard",
+                                          "GovernmentOrDeparmentOfDefenceIDCard", "PersonalQualification",
+                                          "CompanyFiling", "CommercialRegistration", "TradePermit", "ShareRegistry",
+                                          "VesselRegistrationDocument", "VesselInsuranceDocument", "PortraitFront",
+                                          "PresencePortaits", "PortraitSide", "VesselFront", "VesselPortSide",
+                                          "VesselStarboardSide", "VesselRear", "VesselIdentityTag", "PIV_Video",
+                                          "DigitalFootprint", "FatcaForm", "Mifid2Form", "TradingForm")]
+
+
+def main():
+    form = XForm(CATALOGUE)
+    number = 200
+    minidom = timeit.timeit(lambda: xml.dom.minidom.parseString(tostring(form.to_element())).toprettyxml(),
+                            number=number) / number
+    pretty = timeit.timeit(lambda: render_xml(form.to_element()), number=number) / number
+    compact = timeit.timeit(lambda: render_xml(form.to_element(), pretty=False), number=number) / number
+    form.to_xform()
+    cached = timeit.timeit(lambda: form.to_xform(), number=number * 100) / (number * 100)
+    print("%d fields" % len(CATALOGUE))
+    print("tostring + minidom  %8.1fus" % (minidom * 1e6))
+    print("one pass, pretty    %8.1fus" % (pretty * 1e6))
+    print("one pass, compact   %8.1fus" % (compact * 1e6))
+    print("cached to_xform     %8.1fus" % (cached * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+""" asyncio front end of the Teleferic Server and Client
+
+    Enveloppes go through a transport: InProcessTransport calls the AsyncTelefericServer directly,
+    SocketTransport talks to AsyncTelefericServer.serve over a stream socket. On the socket, each frame is
+    a 4 bytes big endian length followed by the packed enveloppe. The answer frames come back in the same order:
+    a status byte (0: ok, followed by the messageHash, 1: error, followed by the utf-8 message).
+    A frame longer than max_frame_size closes the connection.
+"""
+import asyncio
+from collections import deque
+import struct
+from serialization import MsgpackSerialize
+
+
+FRAME_HEADER = struct.Struct(">I")
+STATUS_OK = 0
+STATUS_ERROR = 1
+MAX_FRAME_SIZE = 128 * 1024 * 1024
+
+
+class TelefericError(Exception):
+    """ The server could not process an enveloppe """
+    pass
+
+
+class FrameTooLarge(TelefericError):
+    """ The length of a frame is above max_frame_size: nothing is read """
+    pass
+
+
+async def read_frame(reader, max_frame_size=MAX_FRAME_SIZE):
+    header = await reader.readexactly(FRAME_HEADER.size)
+    size = FRAME_HEADER.unpack(header)[0]
+    if size > max_frame_size:
+        raise FrameTooLarge("Frame of %d bytes, the limit is %d" % (size, max_frame_size))
+    return await reader.readexactly(size)
+
+
+def write_frame(writer, data):
+    writer.write(FRAME_HEADER.pack(len(data)))
+    writer.write(data)
+
+
+class AsyncTelefericServer():
+    """ Accepts enveloppes from concurrent submitters for a TelefericServer
+        Enveloppes wait in a bounded queue: submit_envelope waits while it is full (backpressure).
+        The workers run the CPU bound part (packing, RSA decrypt, hashing) in an executor (None: the loop default
+        executor) and accept the enveloppes (TelefericServer.accept_enveloppe) from the event loop.
+        max_frame_size: the connections sending a larger frame are closed
+    """
+    def __init__(self, server, max_queue=1024, workers=4, executor=None, max_frame_size=MAX_FRAME_SIZE):
+        self.server = server
+        self.max_queue = max_queue
+        self.workers = workers
+        self.executor = executor
+        self.max_frame_size = max_frame_size
+        self.queue = None
+        self.tasks = []
+
+    async def start(self):
+        self.queue = asyncio.Queue(self.max_queue)
+        self.tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        await self.queue.join()
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.stop()
+
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    async def submit_envelope(self, enveloppe):
+        """ Returns the messageHash, as TelefericServer.send_enveloppe """
+        return await self._submit(self.server.process_enveloppe, enveloppe)
+
+    async def submit_packed_envelope(self, packed):
+        return await self._submit(self.server.process_packed_enveloppe, packed)
+
+    async def _submit(self, process, data):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((process, data, future))
+        return await future
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            process, data, future = await self.queue.get()
+            try:
+                processed = await loop.run_in_executor(self.executor, process, data)
+                messageHash = self.server.accept_enveloppe(*processed)
+                if not future.cancelled():
+                    future.set_result(messageHash)
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            finally:
+                self.queue.task_done()
+
+    async def serve(self, host="127.0.0.1", port=0):
+        """ Accepts SocketTransport connections, returns the asyncio Server """
+        return await asyncio.start_server(self._handle_connection, host, port)
+
+    async def _handle_connection(self, reader, writer):
+        # The answers are written in the order of the requests, while the requests are processed concurrently
+        pending = asyncio.Queue(self.max_queue)
+        read_task = asyncio.ensure_future(self._read_requests(reader, pending))
+        answer_task = asyncio.ensure_future(self._write_answers(pending, writer, read_task))
+        try:
+            await asyncio.wait([read_task])
+        finally:
+            read_task.cancel()
+            # _write_answers consumes pending until None, even when the answers can not be written
+            await pending.put(None)
+            await answer_task
+            writer.close()
+
+    async def _read_requests(self, reader, pending):
+        while True:
+            try:
+                packed = await read_frame(reader, self.max_frame_size)
+            except (asyncio.IncompleteReadError, ConnectionError, FrameTooLarge):
+                return
+            await pending.put(asyncio.ensure_future(self.submit_packed_envelope(packed)))
+
+    async def _write_answers(self, pending, writer, read_task):
+        failed = False
+        while True:
+            task = await pending.get()
+            if task is None:
+                return
+            if failed:
+                task.cancel()
+                continue
+            try:
+                answer = bytes([STATUS_OK]) + await task
+            except Exception as e:
+                answer = bytes([STATUS_ERROR]) + str(e).encode()
+            try:
+                write_frame(writer, answer)
+                await writer.drain()
+            except Exception:
+                # The connection is broken: stop reading and drop the requests in flight
+                failed = True
+                read_task.cancel()
+
+
+class InProcessTransport():
+    def __init__(self, async_server):
+        self.async_server = async_server
+
+    async def send_packed_enveloppe(self, packed):
+        return await self.async_server.submit_packed_envelope(packed)
+
+    async def close(self):
+        pass
+
+
+class SocketTransport():
+    """ Pipelined connection to AsyncTelefericServer.serve: many enveloppes can be in flight """
+    def __init__(self, reader, writer, max_frame_size=MAX_FRAME_SIZE):
+        self.reader = reader
+        self.writer = writer
+        self.max_frame_size = max_frame_size
+        # Futures of the answers, in the order of the frames sent
+        self.pending = deque()
+        self.lock = asyncio.Lock()
+        self.reader_task = asyncio.ensure_future(self._read_answers())
+
+    @classmethod
+    async def connect(cls, host, port, max_frame_size=MAX_FRAME_SIZE):
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer, max_frame_size)
+
+    async def send_packed_enveloppe(self, packed):
+        future = asyncio.get_running_loop().create_future()
+        async with self.lock:
+            # The frame and its answer future must be queued in the same order. Once written, the frame is answered
+            # even if this call fails: its future stays in pending, cancelled, to consume the answer.
+            write_frame(self.writer, packed)
+            self.pending.append(future)
+            try:
+                await self.writer.drain()
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except BaseException:
+                future.cancel()
+                # The connection is broken: all the enveloppes in flight fail
+                self.writer.close()
+                self._fail_pending()
+                raise
+        return await future
+
+    def _fail_pending(self):
+        while self.pending:
+            future = self.pending.popleft()
+            if not future.cancelled():
+                future.set_exception(TelefericError("Connection closed"))
+
+    async def _read_answers(self):
+        while True:
+            try:
+                answer = await read_frame(self.reader, self.max_frame_size)
+            except (asyncio.IncompleteReadError, ConnectionError, FrameTooLarge):
+                self._fail_pending()
+                return
+            if not self.pending:
+                # An answer to no request: the stream is out of sync
+                self.writer.close()
+                continue
+            future = self.pending.popleft()
+            if future.cancelled():
+                continue
+            if answer[0] == STATUS_OK:
+                future.set_result(answer[1:])
+            else:
+                future.set_exception(TelefericError(answer[1:].decode()))
+
+    async def close(self):
+        self.writer.close()
+        await self.reader_task
+
+
+class AsyncTelefericClient():
+    """ Builds the enveloppes with a TelefericClient in an executor (None: the loop default executor),
+        and sends them through a transport without waiting for the previous answers.
+    """
+    def __init__(self, client, transport, executor=None):
+        self.client = client
+        self.transport = transport
+        self.executor = executor
+
+    async def send_message(self, sender_key, senderID, destination_list, message_body, attachements=[]):
+        return (await self.send_messages([(sender_key, senderID, destination_list, message_body, attachements)]))[0]
+
+    async def send_messages(self, batch):
+        """ batch: as TelefericClient.make_enveloppes, returns the messageHashes """
+        loop = asyncio.get_running_loop()
+        packed = await loop.run_in_executor(self.executor, self._make_packed_enveloppes, batch)
+        return await asyncio.gather(*[self.transport.send_packed_enveloppe(p) for p in packed])
+
+    def _make_packed_enveloppes(self, batch):
+        return [MsgpackSerialize.pack(enveloppe) for enveloppe in self.client.make_enveloppes(batch)]
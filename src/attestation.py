@@ -0,0 +1,67 @@
+""" Attestation rules of the AttestationEngine: the attestations made when an attachement has some fields
+"""
+from dataclasses import dataclass
+from typing import FrozenSet, Tuple
+
+
+MESSAGE_ANALYSIS = "message"
+RESEARCH_ANALYSIS = "research"
+
+
+@dataclass(frozen=True)
+class AttestationRule():
+    required_fields: FrozenSet[str]
+    entries: Tuple[Tuple[str, str], ...] # (attestType, MESSAGE_ANALYSIS or RESEARCH_ANALYSIS)
+
+
+DEFAULT_RULES = (AttestationRule(frozenset(["IdentityDocument"]),
+                                 (("MRZ", MESSAGE_ANALYSIS),
+                                  ("Fraud", RESEARCH_ANALYSIS),
+                                  ("PEP", RESEARCH_ANALYSIS),
+                                  ("Sanction", RESEARCH_ANALYSIS),
+                                  ("SanctionCountry", RESEARCH_ANALYSIS),
+                                  ("CountryRisk", RESEARCH_ANALYSIS),
+                                  ("BlackList", RESEARCH_ANALYSIS))),
+                 AttestationRule(frozenset(["Name", "Surname", "AddressLine1", "AddressLine2", "PostalCode", "City",
+                                            "Country", "Email", "PhoneNumber"]),
+                                 (("AddressValidity", RESEARCH_ANALYSIS),
+                                  ("KnownCustomer", RESEARCH_ANALYSIS),
+                                  ("ResidenceClassifier", MESSAGE_ANALYSIS))))
+
+
+class RuleIndex():
+    """ Rules compiled into a field name => rules index: matching the fields of an attachement only looks at
+        the rules having one of these fields. match returns the rules in their original order.
+    """
+    def __init__(self, rules=DEFAULT_RULES):
+        self.rules = tuple(rules)
+        self.by_field = {}
+        # Rules without required fields always apply
+        self.unconditional = []
+        for position, rule in enumerate(self.rules):
+            if not rule.required_fields:
+                self.unconditional.append(position)
+            for name in rule.required_fields:
+                self.by_field.setdefault(name, []).append(position)
+
+    def match(self, fields):
+        counts = {}
+        for name in set(fields):
+            for position in self.by_field.get(name, ()):
+                counts[position] = counts.get(position, 0) + 1
+        matched = [position for position, count in counts.items() if count == len(self.rules[position].required_fields)]
+        return [self.rules[position] for position in sorted(matched + self.unconditional)]
+
+
+# Scheduling classes of the attestation types, lower first (see scheduler.AttestationScheduler): screening
+# against sanction and watch lists before the slower research analyses
+DEFAULT_PRIORITIES = {"SanctionCountry": 0,
+                      "Sanction": 0,
+                      "PEP": 0,
+                      "BlackList": 0,
+                      "MRZ": 1,
+                      "Fraud": 1,
+                      "CountryRisk": 1,
+                      "ResidenceClassifier": 2,
+                      "AddressValidity": 2,
+                      "KnownCustomer": 3}
@@ -0,0 +1,146 @@
+""" Content addressed store of attachment containers (containerHash => objectContainer)
+
+    Enveloppes can carry Attachement references (objectContainer None, see Attachement.reference) instead of
+    the containers: a container already stored is not sent again.
+"""
+import dataclasses
+import os
+import sqlite3
+import threading
+from Crypto.Hash import SHA256
+
+
+class BlobStore():
+    """ Containers are stored as files named by their containerHash (hex) in directory, indexed in a SQLite table
+        (objectHash, size, reference count, last use).
+        A blob is referenced while an enveloppe needs it (acquire/release). When the total size is above max_size
+        (None: no limit), unreferenced blobs are evicted, least recently used first.
+    """
+    def __init__(self, directory, max_size=None):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(directory, "blobs.sqlite"), check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS blobs (containerHash BLOB PRIMARY KEY, objectHash BLOB, "
+                        "size INTEGER NOT NULL, refcount INTEGER NOT NULL, last_used INTEGER NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS blobs_objectHash ON blobs (objectHash)")
+        self.db.commit()
+        self.lock = threading.Lock()
+        # Logical clock of the uses, for the LRU order
+        self.clock = self.db.execute("SELECT COALESCE(MAX(last_used), 0) FROM blobs").fetchone()[0]
+
+    def _tick(self):
+        self.clock += 1
+        return self.clock
+
+    def _path(self, containerHash):
+        return os.path.join(self.directory, containerHash.hex())
+
+    def put(self, container, objectHash=None):
+        """ Stores a container (nothing is written if it is already there), returns its containerHash """
+        containerHash = SHA256.new(container).digest()
+        with self.lock:
+            if self._touch(containerHash):
+                return containerHash
+            path = self._path(containerHash)
+            with open(path + ".tmp", "wb") as fout:
+                fout.write(container)
+            os.replace(path + ".tmp", path)
+            self.db.execute("INSERT INTO blobs VALUES (?, ?, ?, 0, ?)",
+                            (containerHash, objectHash, len(container), self._tick()))
+            self.db.commit()
+            # The blob just stored is not evicted before it can be acquired
+            self._evict(keep=containerHash)
+        return containerHash
+
+    def put_attachement(self, attachement):
+        """ Stores the container of attachement, returns the reference to it """
+        containerHash = self.put(attachement.objectContainer, attachement.objectHash)
+        if attachement.containerHash is not None and attachement.containerHash != containerHash:
+            raise ValueError("Attachement containerHash mismatch")
+        return dataclasses.replace(attachement, containerHash=containerHash).reference()
+
+    def get(self, containerHash):
+        """ The container, None if it is not (or no longer) stored """
+        with self.lock:
+            if not self._touch(containerHash):
+                return None
+            with open(self._path(containerHash), "rb") as fin:
+                return fin.read()
+
+    def resolve(self, attachement):
+        """ Attachement reference => Attachement with its container (KeyError if the blob is missing) """
+        if attachement.objectContainer is not None:
+            return attachement
+        container = self.get(attachement.containerHash)
+        if container is None:
+            raise KeyError(attachement.containerHash.hex())
+        return dataclasses.replace(attachement, objectContainer=container)
+
+    def find(self, objectHash):
+        """ containerHashes of the stored containers of an object """
+        with self.lock:
+            return [row[0] for row in self.db.execute("SELECT containerHash FROM blobs WHERE objectHash = ?", (objectHash,))]
+
+    def acquire(self, containerHash):
+        """ Adds a reference, the blob can not be evicted until it is released. Returns False if it is not stored. """
+        with self.lock:
+            cursor = self.db.execute("UPDATE blobs SET refcount = refcount + 1, last_used = ? WHERE containerHash = ?",
+                                     (self._tick(), containerHash))
+            self.db.commit()
+            return cursor.rowcount == 1
+
+    def release(self, containerHash):
+        with self.lock:
+            self.db.execute("UPDATE blobs SET refcount = refcount - 1 WHERE containerHash = ? AND refcount > 0",
+                            (containerHash,))
+            self.db.commit()
+            self._evict()
+
+    def refcount(self, containerHash):
+        with self.lock:
+            row = self.db.execute("SELECT refcount FROM blobs WHERE containerHash = ?", (containerHash,)).fetchone()
+            return row[0] if row is not None else 0
+
+    def total_size(self):
+        with self.lock:
+            return self._total_size()
+
+    def __contains__(self, containerHash):
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM blobs WHERE containerHash = ?", (containerHash,)).fetchone() is not None
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM blobs").fetchone()[0]
+
+    def close(self):
+        self.db.close()
+
+    def _touch(self, containerHash):
+        cursor = self.db.execute("UPDATE blobs SET last_used = ? WHERE containerHash = ?", (self._tick(), containerHash))
+        self.db.commit()
+        return cursor.rowcount == 1
+
+    def _total_size(self):
+        return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+
+    def _evict(self, keep=None):
+        if self.max_size is None:
+            return
+        excess = self._total_size() - self.max_size
+        if excess <= 0:
+            return
+        evicted = []
+        for containerHash, size in self.db.execute("SELECT containerHash, size FROM blobs WHERE refcount = 0 "
+                                                   "ORDER BY last_used").fetchall():
+            if excess <= 0:
+                break
+            if containerHash == keep:
+                continue
+            evicted.append(containerHash)
+            excess -= size
+        self.db.executemany("DELETE FROM blobs WHERE containerHash = ?", ((h,) for h in evicted))
+        self.db.commit()
+        for containerHash in evicted:
+            os.remove(self._path(containerHash))
@@ -3,17 +3,20 @@ from Crypto.Hash import RIPEMD
 import base58
 import os
 import binascii
+import io
+import struct
 from Crypto.Cipher import AES, PKCS1_OAEP
 from Crypto.Protocol.KDF import PBKDF2
 from Crypto.Hash import SHA256
 from Crypto.Signature import pss
 from dataclasses import dataclass
+from functools import lru_cache
 
 
 ADDRESS_PREFIX = [1, 0]
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, order=True)
 class Address():
     address: str
     def to_struct(self):
@@ -23,11 +26,37 @@ class Address():
         return cls(addr)
 
 
+class CacheStats():
+    """ Hit/miss counters of a cache """
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return "CacheStats(hits=%d, misses=%d)" % (self.hits, self.misses)
+
+
 class RSAKey():
-    """ Peermountain RSAKey (wraps Cryptodome.RSAKey) """
-    def __init__(self, key, is_public):
+    """ Peermountain RSAKey (wraps Cryptodome.RSAKey)
+        The public DER, hex export and Address are computed once, and shared with the public_key() instance.
+        The OAEP cipher and PSS signer/verifier are created once per key (they keep no state between calls).
+    """
+    # Hits/misses of the per key cache (public DER, hex export, Address)
+    cache_stats = CacheStats()
+
+    def __init__(self, key, is_public, public_cache=None):
         self.key = key
         self.is_public = is_public
+        self._public_cache = {} if public_cache is None else public_cache
+        self._contexts = {}
+
+    def _cached(self, name, compute):
+        if name in self._public_cache:
+            RSAKey.cache_stats.hits += 1
+            return self._public_cache[name]
+        RSAKey.cache_stats.misses += 1
+        value = self._public_cache[name] = compute()
+        return value
 
     @classmethod
     def generate(cls, size=4096, randfunc=os.urandom):
@@ -38,14 +67,24 @@ class RSAKey():
         return self.key.exportKey('PEM')
 
     def public_key(self):
-        return RSAKey(self.key.publickey(), True)
+        if self.is_public:
+            return self
+        return self._cached("public_key", lambda: RSAKey(self.key.publickey(), True, self._public_cache))
+
+    def public_der(self):
+        return self._cached("der", lambda: self.key.publickey().exportKey("DER"))
 
     def public_key_hex(self):
-        return binascii.hexlify(self.key.publickey().exportKey("DER")).decode()
+        return self._cached("hex", lambda: binascii.hexlify(self.public_der()).decode())
 
     @classmethod
     def import_public_key_hex(cls, data):
-        return cls(RSA.importKey(binascii.unhexlify(data.encode())), True)
+        """ Parsed keys are kept in a LRU cache (see import_cache_info) """
+        return _import_public_key_hex(cls, data)
+
+    @staticmethod
+    def import_cache_info():
+        return _import_public_key_hex.cache_info()
 
     @classmethod
     def import_key(cls, data):
@@ -65,8 +104,11 @@ class RSAKey():
     def address(self):
         """Return the PeerMountain address.
         """
+        return self._cached("address", self._compute_address)
+
+    def _compute_address(self):
         # The public key of the pair is hashed SHA-256.
-        step_1 = SHA256.new(self.key.publickey().exportKey(format="DER")).digest()
+        step_1 = SHA256.new(self.public_der()).digest()
         # The resulting Hash is further hashed with RIPEMD-160.
         step_2 = RIPEMD.new(step_1).digest()
         # Two bytes are prefixed to the resulting RIPEMD-160 hash in order to
@@ -82,27 +124,90 @@ class RSAKey():
         # The resulting object is Base58 encoded
         return Address(base58.b58encode(step_4).decode())
 
+    def _context(self, name, create):
+        context = self._contexts.get(name)
+        if context is None:
+            context = self._contexts[name] = create()
+        return context
+
+    def cipher(self):
+        """ OAEP cipher of the key, can be reused to encrypt (and decrypt) many messages """
+        return self._context("cipher", lambda: PKCS1_OAEP.new(self.key))
+
     def encrypt(self, data):
-        cipher = PKCS1_OAEP.new(self.key)
-        return cipher.encrypt(data)
+        return self.cipher().encrypt(data)
     
     def decrypt(self, data):
         assert not self.is_public
-        cipher = PKCS1_OAEP.new(self.key)
-        return cipher.decrypt(data)
+        return self.cipher().decrypt(data)
     
+    def signer(self, randbytes=os.urandom):
+        """ PSS signer, can be reused to sign many SHA256 hashes """
+        if randbytes is not os.urandom:
+            return pss.new(self.key, rand_func=randbytes)
+        return self._context("signer", lambda: pss.new(self.key))
+
+    def verifier(self):
+        """ PSS verifier, can be reused to verify many signatures """
+        return self._context("verifier", lambda: pss.new(self.key))
+
     def sign(self, message, randbytes=os.urandom):
         message_hash = SHA256.new(message)
-        return pss.new(self.key, rand_func=randbytes).sign(message_hash)
+        return self.signer(randbytes).sign(message_hash)
         
     def verify(self, message, signature):
         message_hash = SHA256.new(message)
         try:
-            pss.new(self.key).verify(message_hash, signature)
+            self.verifier().verify(message_hash, signature)
             return True
         except (ValueError, TypeError):
             return False
     
+@lru_cache(maxsize=4096)
+def _import_public_key_hex(cls, data):
+    return cls(RSA.importKey(binascii.unhexlify(data.encode())), True)
+
+
+class AESEncryptWriter():
+    """ Encrypts the data as it is written (see AESKey.encrypt_writer), large buffers are encrypted by slices
+        so that no ciphertext copy of the whole buffer is made. The nonce, ciphertext and tag go to fout
+        (by default a BytesIO, and getvalue returns nonce + ciphertext + tag).
+    """
+    SLICE_SIZE = 1024 * 1024
+
+    def __init__(self, key, randbytes=os.urandom, fout=None):
+        nonce = randbytes(key.nonce_size)
+        self.cipher = AES.new(key.key, AES.MODE_GCM, nonce=nonce)
+        self.output = fout if fout is not None else io.BytesIO()
+        self.output.write(nonce)
+
+    def write(self, data):
+        data = memoryview(data).cast("B")
+        for start in range(0, len(data), AESEncryptWriter.SLICE_SIZE):
+            self.output.write(self.cipher.encrypt(data[start:start + AESEncryptWriter.SLICE_SIZE]))
+        return len(data)
+
+    def finish(self):
+        """ Writes the tag, nothing can be written after """
+        self.output.write(self.cipher.digest())
+
+    def getvalue(self):
+        self.finish()
+        # BytesIO.getvalue does not copy the buffer
+        return self.output.getvalue()
+
+
+def read_exactly(fin, size):
+    """ Reads size bytes from fin, less only at the end of the file """
+    data = fin.read(size)
+    while 0 < len(data) < size:
+        more = fin.read(size - len(data))
+        if not more:
+            break
+        data += more
+    return data
+
+
 class AESKey:
     def __init__(self, key):
         self.key = key
@@ -121,6 +226,109 @@ class AESKey:
         ciphertext, tag = cipher.encrypt_and_digest(data)
         return nonce + ciphertext + tag
 
+    def encrypt_writer(self, randbytes=os.urandom, fout=None):
+        """ File-like object producing the same result as encrypt for everything written to it """
+        return AESEncryptWriter(self, randbytes, fout)
+
+    # Chunked container, to encrypt/decrypt file objects with constant memory and read any chunk on its own:
+    #   header:  magic(4) version(1) chunk_size(4) nonce_prefix(7)
+    #   chunks:  ciphertext(chunk_size, the last one can be shorter) tag(16)
+    #            nonce = nonce_prefix + index(4) + 0x00, the header is authenticated with every chunk
+    #   trailer: chunk_count(8) plaintext_length(8) tag(16)
+    #            GCM of nothing, nonce = nonce_prefix + 0xffffffff + 0x01, authenticates header + chunk_count + plaintext_length
+    STREAM_MAGIC = b"PMAC"
+    STREAM_VERSION = 1
+    STREAM_HEADER = struct.Struct(">4sBI7s")
+    STREAM_TRAILER = struct.Struct(">QQ16s")
+
+    def _chunk_cipher(self, nonce_prefix, index, final=False):
+        nonce = nonce_prefix + struct.pack(">IB", index, 1 if final else 0)
+        return AES.new(self.key, AES.MODE_GCM, nonce=nonce)
+
+    def _trailer_cipher(self, header, nonce_prefix, count, length):
+        cipher = self._chunk_cipher(nonce_prefix, 0xffffffff, True)
+        cipher.update(header + struct.pack(">QQ", count, length))
+        return cipher
+
+    def _parse_stream_header(self, header):
+        if len(header) != AESKey.STREAM_HEADER.size:
+            raise ValueError("Truncated stream header")
+        magic, version, chunk_size, nonce_prefix = AESKey.STREAM_HEADER.unpack(header)
+        if magic != AESKey.STREAM_MAGIC or version != AESKey.STREAM_VERSION or chunk_size == 0:
+            raise ValueError("Not an encrypted stream")
+        return chunk_size, nonce_prefix
+
+    def encrypt_stream(self, fin, fout, chunk_size=64 * 1024, randbytes=os.urandom):
+        """ Encrypts the binary file object fin into fout, chunk by chunk. Returns the plaintext length """
+        nonce_prefix = randbytes(7)
+        header = AESKey.STREAM_HEADER.pack(AESKey.STREAM_MAGIC, AESKey.STREAM_VERSION, chunk_size, nonce_prefix)
+        fout.write(header)
+        count, length = 0, 0
+        while True:
+            chunk = read_exactly(fin, chunk_size)
+            if not chunk:
+                break
+            if count == 0xffffffff:
+                raise ValueError("Too many chunks")
+            cipher = self._chunk_cipher(nonce_prefix, count)
+            cipher.update(header)
+            ciphertext, tag = cipher.encrypt_and_digest(chunk)
+            fout.write(ciphertext)
+            fout.write(tag)
+            count += 1
+            length += len(chunk)
+        fout.write(AESKey.STREAM_TRAILER.pack(count, length, self._trailer_cipher(header, nonce_prefix, count, length).digest()))
+        return length
+
+    def decrypt_stream(self, fin, fout):
+        """ Decrypts an encrypt_stream container from fin into fout. Returns the plaintext length
+            Every chunk is verified before being written, the chunk count and length when the trailer is reached:
+            the content of fout must not be used if this raises ValueError.
+        """
+        header = read_exactly(fin, AESKey.STREAM_HEADER.size)
+        chunk_size, nonce_prefix = self._parse_stream_header(header)
+        record_size = chunk_size + 16
+        # Read ahead one record + the trailer, so that the trailer is never taken for a chunk
+        pending = read_exactly(fin, record_size + AESKey.STREAM_TRAILER.size)
+        count, length = 0, 0
+        while len(pending) > AESKey.STREAM_TRAILER.size:
+            record = pending[:min(record_size, len(pending) - AESKey.STREAM_TRAILER.size)]
+            pending = pending[len(record):]
+            if len(record) <= 16:
+                raise ValueError("Truncated chunk")
+            cipher = self._chunk_cipher(nonce_prefix, count)
+            cipher.update(header)
+            fout.write(cipher.decrypt_and_verify(record[:-16], record[-16:]))
+            count += 1
+            length += len(record) - 16
+            pending += read_exactly(fin, record_size + AESKey.STREAM_TRAILER.size - len(pending))
+        self._verify_trailer(header, nonce_prefix, pending, count, length)
+        return length
+
+    def _verify_trailer(self, header, nonce_prefix, trailer, count=None, length=None):
+        if len(trailer) != AESKey.STREAM_TRAILER.size:
+            raise ValueError("Truncated stream")
+        trailer_count, trailer_length, tag = AESKey.STREAM_TRAILER.unpack(trailer)
+        self._trailer_cipher(header, nonce_prefix, trailer_count, trailer_length).verify(tag)
+        if count is not None and (count, length) != (trailer_count, trailer_length):
+            raise ValueError("Chunks missing")
+        return trailer_count, trailer_length
+
+    def decrypt_chunk(self, fin, index):
+        """ Decrypts the chunk index of an encrypt_stream container (fin must be seekable) """
+        fin.seek(0)
+        header = fin.read(AESKey.STREAM_HEADER.size)
+        chunk_size, nonce_prefix = self._parse_stream_header(header)
+        fin.seek(-AESKey.STREAM_TRAILER.size, os.SEEK_END)
+        count, length = self._verify_trailer(header, nonce_prefix, fin.read(AESKey.STREAM_TRAILER.size))
+        if not 0 <= index < count:
+            raise IndexError("No chunk %d" % index)
+        fin.seek(AESKey.STREAM_HEADER.size + index * (chunk_size + 16))
+        record = fin.read(min(chunk_size, length - index * chunk_size) + 16)
+        cipher = self._chunk_cipher(nonce_prefix, index)
+        cipher.update(header)
+        return cipher.decrypt_and_verify(record[:-16], record[-16:])
+
     @classmethod
     def generate(cls, keysize=256, randbytes=os.urandom):
         assert keysize in {128, 192, 256}
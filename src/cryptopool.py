@@ -0,0 +1,179 @@
+""" Process pool for the CPU bound RSA operations (PSS signatures and their verification, OAEP key wrapping)
+"""
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+import threading
+from crypto import RSAKey
+
+
+class KeyNotLoaded(Exception):
+    """ A worker was sent a KeyHandle without its key material for a key it does not hold """
+    pass
+
+
+class KeyHandle():
+    """ Picklable reference to a RSAKey: each worker imports the key once and keeps it.
+        A handle sent without its key material (reference) only names the key (key_id).
+    """
+    def __init__(self, key_id, is_public, data=None):
+        self.key_id = key_id
+        self.is_public = is_public
+        self.data = data
+
+    @staticmethod
+    def key_id_of(key):
+        return (key.address().address, key.is_public)
+
+    @classmethod
+    def of(cls, key):
+        return cls(cls.key_id_of(key), key.is_public, key.public_key_hex() if key.is_public else key.export())
+
+    def reference(self):
+        return KeyHandle(self.key_id, self.is_public)
+
+    def load(self):
+        if self.is_public:
+            return RSAKey.import_public_key_hex(self.data)
+        return RSAKey.import_key(self.data)
+
+
+# Keys imported by this (worker) process, in LRU order: key_id => RSAKey (which keeps its signer and OAEP cipher)
+_worker_keys = OrderedDict()
+_worker_cache_size = 1024
+
+
+def _init_worker(cache_size):
+    global _worker_cache_size
+    _worker_cache_size = cache_size
+
+
+def _worker_key(handle):
+    key = _worker_keys.get(handle.key_id)
+    if key is not None:
+        _worker_keys.move_to_end(handle.key_id)
+        return key
+    if handle.data is None:
+        raise KeyNotLoaded(handle.key_id)
+    key = handle.load()
+    _worker_keys[handle.key_id] = key
+    while len(_worker_keys) > _worker_cache_size:
+        _worker_keys.popitem(last=False)
+    return key
+
+
+def _sign(handle, message):
+    return _worker_key(handle).sign(message)
+
+
+def _sign_many(handle, messages):
+    key = _worker_key(handle)
+    return [key.sign(message) for message in messages]
+
+
+def _encrypt(handle, data):
+    return _worker_key(handle).encrypt(data)
+
+
+def _encrypt_many(handles, data):
+    return [_worker_key(handle).encrypt(data) for handle in handles]
+
+
+def _verify(handle, message, signature):
+    return _worker_key(handle).verify(message, signature)
+
+
+class CryptoExecutor():
+    """ Runs RSAKey.sign, RSAKey.verify and RSAKey.encrypt on a pool of processes
+        submit_* return concurrent.futures.Future, the other methods block until the result is available.
+
+        The KeyHandles are kept by key_id in a LRU cache of cache_size entries, and each worker keeps the last
+        cache_size keys it imported. A key is sent with its key material the first time only: a worker which does
+        not hold it answers KeyNotLoaded, and the task is sent again with the key material.
+    """
+    def __init__(self, max_workers=None, cache_size=1024):
+        self.executor = ProcessPoolExecutor(max_workers, initializer=_init_worker, initargs=(cache_size,))
+        self.cache_size = cache_size
+        # key_id => (KeyHandle, sent to the workers)
+        self.handles = OrderedDict()
+        self.lock = threading.Lock()
+
+    def handle(self, key):
+        """ (KeyHandle with the key material, already sent) """
+        key_id = KeyHandle.key_id_of(key)
+        with self.lock:
+            entry = self.handles.get(key_id)
+            if entry is not None:
+                self.handles.move_to_end(key_id)
+                entry[1] = True
+                return entry[0], True
+            self.handles[key_id] = [KeyHandle.of(key), False]
+            while len(self.handles) > self.cache_size:
+                self.handles.popitem(last=False)
+            return self.handles[key_id][0], False
+
+    def _submit(self, fn, keys, *args):
+        """ Future of fn(handles, *args), or fn(handle, *args) if keys is a single key """
+        single = not isinstance(keys, list)
+        entries = [self.handle(key) for key in ([keys] if single else keys)]
+        full = [handle for handle, _ in entries]
+        light = [handle.reference() if sent else handle for handle, sent in entries]
+        if all(handle.data is not None for handle in light):
+            return self.executor.submit(fn, full[0] if single else full, *args)
+        future = Future()
+        def retried(attempt):
+            try:
+                future.set_result(attempt.result())
+            except BaseException as error:
+                future.set_exception(error)
+        def done(attempt):
+            try:
+                future.set_result(attempt.result())
+            except KeyNotLoaded:
+                try:
+                    self.executor.submit(fn, full[0] if single else full, *args).add_done_callback(retried)
+                except BaseException as error:
+                    future.set_exception(error)
+            except BaseException as error:
+                future.set_exception(error)
+        self.executor.submit(fn, light[0] if single else light, *args).add_done_callback(done)
+        return future
+
+    def submit_sign(self, key, message):
+        return self._submit(_sign, key, message)
+
+    def submit_encrypt(self, key, data):
+        return self._submit(_encrypt, key, data)
+
+    def submit_encrypt_many(self, keys, data):
+        """ Future of the list of data encrypted for each key, computed by one worker """
+        return self._submit(_encrypt_many, list(keys), data)
+
+    def submit_verify(self, key, message, signature):
+        return self._submit(_verify, key, message, signature)
+
+    def sign(self, key, message):
+        return self.submit_sign(key, message).result()
+
+    def encrypt(self, key, data):
+        return self.submit_encrypt(key, data).result()
+
+    def sign_many(self, key, messages, chunksize=16):
+        """ Signs messages with the same key, sending them to the workers by chunks """
+        messages = list(messages)
+        chunks = [messages[i:i + chunksize] for i in range(0, len(messages), chunksize)]
+        futures = [self._submit(_sign_many, key, chunk) for chunk in chunks]
+        return [signature for future in futures for signature in future.result()]
+
+    def wrap_key(self, data, public_keys):
+        """ Encrypts data (an AES key) for each public key """
+        futures = [self.submit_encrypt(key, data) for key in public_keys]
+        return [future.result() for future in futures]
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
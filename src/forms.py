@@ -5,12 +5,15 @@ from dataclasses import dataclass
 from typing import List, Tuple, Dict
 from xml.etree.ElementTree import Element, SubElement, tostring,\
     register_namespace
-import xml.dom.minidom
+from collections import OrderedDict
+from types import MappingProxyType
+import threading
 from builtins import str
 from enum import Enum
 import datetime
 from model import Assertion
-from Crypto.Hash import HMAC, SHA256
+import hashlib
+import hmac
 
 
 class ValidationError(Exception):
@@ -35,6 +38,10 @@ class Field():
 
     def validate(self, value):
         return value
+
+    def make_checker(self):
+        """ value => validated value, as validate (None if there is nothing to check) """
+        return None if type(self).validate is Field.validate else self.validate
     
     
 @dataclass(frozen=True)
@@ -66,6 +73,18 @@ class StringField(Field):
         if self.max_length is not None and len(value) > self.max_length:
             raise ValidationError(f"{self.name}: String too large")
         return value
+
+    def make_checker(self):
+        name, min_length, max_length = self.name, self.min_length, self.max_length
+        def check(value):
+            if type(value) is not str:
+                raise ValidationError(f"{name} must be a string")
+            if min_length is not None and len(value) < min_length:
+                raise ValidationError(f"{name}: String too small")
+            if max_length is not None and len(value) > max_length:
+                raise ValidationError(f"{name}: String too large")
+            return value
+        return check
  
  
 @dataclass(frozen=True)
@@ -76,7 +95,7 @@ class BooleanField(Field):
         return simpleType
         
     def generate_xml_view(self, view):
-        input = SubElement(view, "input", {"ref" : self.name, "type" : self.checkbox})
+        input = SubElement(view, "input", {"ref" : self.name, "type" : "checkbox"})
         if self.description:
             label = SubElement(input, "label")
             label.text = self.description
@@ -87,6 +106,14 @@ class BooleanField(Field):
             raise ValidationError(f"{self.name} must be a bool")
         return value
 
+    def make_checker(self):
+        name = self.name
+        def check(value):
+            if type(value) is not bool:
+                raise ValidationError(f"{name} must be a bool")
+            return value
+        return check
+
 
 @dataclass(frozen=True)
 class EnumField(Field):
@@ -105,6 +132,16 @@ class EnumField(Field):
         if not value in self.allowed_values:
             raise ValidationError(f"{self.name}: Invalid Value")
         return value
+
+    def make_checker(self):
+        name, allowed_values = self.name, frozenset(self.allowed_values)
+        def check(value):
+            if type(value) is not str:
+                raise ValidationError(f"{name} must be a string")
+            if not value in allowed_values:
+                raise ValidationError(f"{name}: Invalid Value")
+            return value
+        return check
     
 
 @dataclass(frozen=True)
@@ -133,6 +170,18 @@ class IntegerField(Field):
             raise ValidationError(f"{self.name}: Value too large")
         return value
 
+    def make_checker(self):
+        name, min, max = self.name, self.min, self.max
+        def check(value):
+            if type(value) is not int:
+                raise ValidationError(f"{name} must be an int")
+            if min is not None and value < min:
+                raise ValidationError(f"{name}: Value too small")
+            if max is not None and value > max:
+                raise ValidationError(f"{name}: Value too large")
+            return value
+        return check
+
 
 @dataclass(frozen=True)
 class DateField(Field):
@@ -149,6 +198,14 @@ class DateField(Field):
             raise ValidationError(f"{self.name} must be an date")
         return value
 
+    def make_checker(self):
+        name = self.name
+        def check(value):
+            if type(value) is not datetime.date:
+                raise ValidationError(f"{name} must be an date")
+            return value
+        return check
+
 
 @dataclass(frozen=True)
 class FloatField(Field):
@@ -200,25 +257,178 @@ StandardFields = set([StandardField(FileField("IdentityDocument"), False),
                       StandardField(StringField("IDNumber"))])
 
 
+class StandardFieldRegistry():
+    """ Immutable index of standard fields, built once: name => StandardField, the salted/unsalted and
+        file/non file partitions (frozensets of names) and a fingerprint of the definitions.
+        version is compared between nodes to check they use the same standard fields.
+    """
+    FORMAT = 1
+
+    def __init__(self, standard_fields):
+        standard_fields = sorted(standard_fields, key=lambda f: f.field.name)
+        by_name = dict((f.field.name, f) for f in standard_fields)
+        set_attribute = super().__setattr__
+        set_attribute("by_name", MappingProxyType(by_name))
+        set_attribute("salted", frozenset(name for name, f in by_name.items() if f.salted))
+        set_attribute("unsalted", frozenset(by_name) - self.salted)
+        set_attribute("files", frozenset(name for name, f in by_name.items() if type(f.field) is FileField))
+        set_attribute("non_files", frozenset(by_name) - self.files)
+        # Fields having metadata (see get_metadata_batch): name => salted
+        set_attribute("metadata_fields", MappingProxyType(dict((name, by_name[name].salted) for name in self.non_files)))
+        set_attribute("fingerprint", hashlib.sha256(repr(standard_fields).encode()).hexdigest())
+        set_attribute("version", "%d:%s" % (StandardFieldRegistry.FORMAT, self.fingerprint[:16]))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("StandardFieldRegistry is immutable")
+
+    def get(self, name):
+        """ StandardField, None if name is not standard """
+        return self.by_name.get(name)
+
+    def get_field(self, name):
+        f = self.by_name.get(name)
+        return f.field if f is not None else None
+
+    def is_salted(self, name):
+        return name in self.salted
+
+    def is_file(self, name):
+        return name in self.files
+
+    def same_version(self, version):
+        return version == self.version
+
+    def __getitem__(self, name):
+        return self.by_name[name]
+
+    def __contains__(self, name):
+        return name in self.by_name
+
+    def __iter__(self):
+        return iter(self.by_name.values())
+
+    def __len__(self):
+        return len(self.by_name)
+
+
+StandardRegistry = StandardFieldRegistry(StandardFields)
+
+
+def _escape_text(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def _escape_attribute(value, pretty):
+    value = _escape_text(value).replace('"', "&quot;")
+    return value if pretty else value.replace("\n", "&#10;")
+
+
+def _escape_pretty_text(text):
+    # minidom (up to Python 3.12) escapes the quotes of the text nodes as well
+    return _escape_text(text).replace('"', "&quot;")
+
+
+def _write_element(element, out, pretty, indent):
+    out.append("%s<%s" % (indent, element.tag) if pretty else "<" + element.tag)
+    for name, value in element.items():
+        out.append(' %s="%s"' % (name, _escape_attribute(value, pretty)))
+    children = list(element)
+    if not children and not element.text:
+        out.append("/>\n" if pretty else " />")
+    elif pretty and not children:
+        out.append(">%s</%s>\n" % (_escape_pretty_text(element.text), element.tag))
+    else:
+        out.append(">\n" if pretty else ">")
+        if element.text:
+            out.append("%s\t%s\n" % (indent, _escape_pretty_text(element.text)) if pretty else _escape_text(element.text))
+        for child in children:
+            _write_element(child, out, pretty, indent + "\t")
+            if child.tail and not pretty:
+                out.append(_escape_text(child.tail))
+        out.append("%s</%s>\n" % (indent, element.tag) if pretty else "</%s>" % element.tag)
+
+
+def render_xml(root, pretty=True):
+    """ One pass serialization of an ElementTree element.
+        pretty: same result as minidom.parseString(tostring(root)).toprettyxml(), else same as tostring(root).decode()
+    """
+    out = ['<?xml version="1.0" ?>\n'] if pretty else []
+    _write_element(root, out, pretty, "")
+    return "".join(out)
+
+
+# Rendered XForms: (fingerprint, pretty) => xml
+XFORM_CACHE_SIZE = 256
+_xform_cache = OrderedDict()
+_xform_cache_lock = threading.Lock()
+
+
+class FormValidator():
+    """ Validation of the values of a form, compiled once from its fields:
+        a name => checker index (see Field.make_checker) and the frozenset of the field names
+    """
+    def __init__(self, fields):
+        self.checkers = dict((f.name, f.make_checker()) for f in fields)
+        self.required = frozenset(self.checkers)
+
+    def __call__(self, values):
+        checkers = self.checkers
+        if not checkers.keys() >= values.keys():
+            raise Exception("Invalid fields; %s" , ",".join(values.keys() - self.required))
+        result = {}
+        for name, value in values.items():
+            check = checkers[name]
+            result[name] = value if check is None else check(value)
+        if len(result) != len(self.required):
+            raise Exception("Missing fields; %s" , ",".join(self.required - values.keys()))
+        return result
+
+    def validate_many(self, rows):
+        """ Returns (results, errors): results has the validated values of each row (None if invalid),
+            errors is row index => exception
+        """
+        results = []
+        errors = {}
+        for index, values in enumerate(rows):
+            try:
+                results.append(self(values))
+            except Exception as e:
+                results.append(None)
+                errors[index] = e
+        return results, errors
+
+
+def _resolve_field(f):
+    if isinstance(f, Field):
+        return f
+    if f in StandardRegistry:
+        return StandardRegistry.get_field(f)
+    # TODO: reintroduce standard vs non-standard fields in Tests (a non-standard name should be an error)
+    return Field(f)
+
+
 @dataclass
 class XForm():
     fields_init: List[str]
     
     def __post_init__(self):
-        self.fields = []
-        '''
-        TODO: reintroduce standard vs non-standard fields in Tests
-        stdfields_by_name = {field.field.name: field.field for field in StandardFields}
-        for f in self.fields_init:
-            if type(f) is str:
-                if f not in stdfields_by_name:
-                    raise Exception(f"The field {f} is not standard")
-                self.fields.append(stdfields_by_name[f])
-            else:
-                assert isinstance(f, Field)
-                self.fields.append(f)'''
+        self.fields = [_resolve_field(f) for f in self.fields_init]
+        self._validator = None
+        self._fingerprint = None
+
+    def validator(self):
+        """ The FormValidator of this form, compiled on first use """
+        if self._validator is None:
+            self._validator = FormValidator(self.fields)
+        return self._validator
          
-    def to_xform(self):
+    def fingerprint(self):
+        """ Stable hash of the field definitions """
+        if self._fingerprint is None:
+            self._fingerprint = hashlib.sha256(repr(self.fields).encode()).hexdigest()
+        return self._fingerprint
+
+    def to_element(self):
         root = Element('xforms')
         root.set('xmlns:xs','http://www.w3.org/2001/XMLSchema')
         model = SubElement(root, "model")
@@ -228,39 +438,104 @@ class XForm():
             SubElement(model, f.name)
             f.generate_xml_schema(schema)
             f.generate_xml_view(view)
-        xml_str = tostring(root).decode()
-        parsed = xml.dom.minidom.parseString(xml_str)
-        return (parsed.toprettyxml())
+        return root
+         
+    def to_xform(self, pretty=True):
+        """ pretty: as minidom toprettyxml, otherwise as ElementTree tostring
+            The result is cached by fingerprint (forms with the same fields share it).
+        """
+        key = (self.fingerprint(), pretty)
+        with _xform_cache_lock:
+            if key in _xform_cache:
+                _xform_cache.move_to_end(key)
+                return _xform_cache[key]
+        rendered = render_xml(self.to_element(), pretty)
+        with _xform_cache_lock:
+            _xform_cache[key] = rendered
+            while len(_xform_cache) > XFORM_CACHE_SIZE:
+                _xform_cache.popitem(last=False)
+        return rendered
     
     def validate(self, values):
-        given = set(values.keys())
-        fields_by_name = {f.name:f for f in self.fields}
-        required = set(fields_by_name.keys())
-        if (given - required):
-            raise Exception("Invalid fields; %s" , ",".join(given - required))
-        result = {}
-        for name in values:
-            result[name] = fields_by_name[name].validate(values[name])
-        if (required - given):
-            raise Exception("Missing fields; %s" , ",".join(required - given))
-        return result
+        return self.validator()(values)
+
+    def validate_many(self, rows):
+        """ Validates many submissions of the form, see FormValidator.validate_many """
+        return self.validator().validate_many(rows)
+
+
+class MetadataBatch():
+    """ Metadata of many forms, by column: metadata[name] and metahashes[name] have one entry per form
+        (None when the form has no such field). per_form(i) is get_metadata_dict of the i-th form.
+    """
+    def __init__(self, size):
+        self.size = size
+        # Per form, the metadata field names in the order of the form
+        self.names = [[] for _ in range(size)]
+        self.metadata = {}
+        self.metahashes = {}
+
+    def add(self, index, name, metadata, metahash):
+        if name not in self.metadata:
+            self.metadata[name] = [None] * self.size
+            self.metahashes[name] = [None] * self.size
+        self.names[index].append(name)
+        self.metadata[name][index] = metadata
+        self.metahashes[name][index] = metahash
+
+    def per_form(self, index):
+        names = self.names[index]
+        return (dict((name, self.metadata[name][index]) for name in names),
+                [self.metahashes[name][index] for name in names])
+
+    def __len__(self):
+        return self.size
+
+
+def _metahashes(jobs):
+    """ jobs: list of (keyed HMAC, value) """
+    results = []
+    for keyed, value in jobs:
+        h = keyed.copy()
+        h.update(value.encode())
+        results.append(h.digest())
+    return results
+
+
+def get_metadata_batch(forms, salt_storage, executor=None, chunk_size=256):
+    """ Metadata of many validated forms (see MetadataBatch)
+        The salts are fetched in the order of the forms, as get_metadata_dict would do form after form.
+        The HMAC keyed with a given salt is computed once and copied, executor (a concurrent.futures.Executor)
+        computes the hashes by chunks of chunk_size.
+    """
+    batch = MetadataBatch(len(forms))
+    metadata_fields = StandardRegistry.metadata_fields
+    keyed_by_salt = {}
+    entries = []
+    jobs = []
+    for index, data in enumerate(forms):
+        for name, value in data.items():
+            salted = metadata_fields.get(name)
+            if salted is None:
+                continue
+            salt = salt_storage.getMetadataSalt(value) if salted else ""
+            keyed = keyed_by_salt.get(salt)
+            if keyed is None:
+                keyed = keyed_by_salt[salt] = hmac.new(salt.encode() if type(salt) is str else salt, digestmod=hashlib.sha256)
+            entries.append((index, name, Assertion.Metadata(salt, value)))
+            jobs.append((keyed, value))
+    if executor is None:
+        metahashes = _metahashes(jobs)
+    else:
+        chunks = [jobs[i:i + chunk_size] for i in range(0, len(jobs), chunk_size)]
+        metahashes = [h for hashes in executor.map(_metahashes, chunks) for h in hashes]
+    for (index, name, metadata), metahash in zip(entries, metahashes):
+        batch.add(index, name, metadata, metahash)
+    return batch
 
 
 def get_metadata_dict(data, salt_storage):
-    results = {}
-    metahashes = []
-    stdfields_by_name = {field.field.name: field for field in StandardFields}
-    for name, value in data.items():
-        if name in stdfields_by_name and type(stdfields_by_name[name].field) is not FileField:
-            if stdfields_by_name[name].salted:
-                salt = salt_storage.getMetadataSalt(value)
-            else:
-                salt = ""
-            results[name] = Assertion.Metadata(salt, value)
-            h = HMAC.new(salt, digestmod=SHA256)
-            h.update(value.encode())
-            metahashes.append(h.digest())
-    return (results, metahashes)
+    return get_metadata_batch([data], salt_storage).per_form(0)
 
 
 if __name__ == '__main__':
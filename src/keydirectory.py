@@ -0,0 +1,104 @@
+""" Public key directories of the Teleferic Server (Address => public RSAKey)
+"""
+from collections import OrderedDict
+import sqlite3
+import threading
+from crypto import RSAKey, Address, CacheStats
+
+
+class KeyDirectory():
+    """ Address => public RSAKey """
+    def get_pubkey_for_address(self, addr):
+        raise NotImplementedError()
+
+    def add(self, addr, public_key):
+        raise NotImplementedError()
+
+    def bulk_import(self, public_keys):
+        """ public_keys: Dict[Address, RSAKey] """
+        for addr, public_key in public_keys.items():
+            self.add(addr, public_key)
+
+    def __contains__(self, addr):
+        return self.get_pubkey_for_address(addr) is not None
+
+
+class MemoryKeyDirectory(KeyDirectory):
+    """ In memory directory, lost on restart """
+    def __init__(self):
+        self.public_keys = {}
+
+    def get_pubkey_for_address(self, addr):
+        return self.public_keys.get(addr)
+
+    def add(self, addr, public_key):
+        self.public_keys[addr] = public_key
+
+    def bulk_import(self, public_keys):
+        self.public_keys.update(public_keys)
+
+    def __len__(self):
+        return len(self.public_keys)
+
+
+class SqliteKeyDirectory(KeyDirectory):
+    """ File backed directory: the keys are stored (hex DER) in a SQLite table indexed by address.
+        Nothing is loaded when opening, parsed keys are kept in a LRU cache of cache_size entries.
+    """
+    def __init__(self, filename, cache_size=10000):
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS public_keys (address TEXT PRIMARY KEY, public_key TEXT NOT NULL)")
+        self.db.commit()
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.cache_stats = CacheStats()
+
+    def _cache_put(self, addr, public_key):
+        self.cache[addr] = public_key
+        self.cache.move_to_end(addr)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def get_pubkey_for_address(self, addr):
+        with self.lock:
+            public_key = self.cache.get(addr)
+            if public_key is not None:
+                self.cache_stats.hits += 1
+                self.cache.move_to_end(addr)
+                return public_key
+            self.cache_stats.misses += 1
+            row = self.db.execute("SELECT public_key FROM public_keys WHERE address = ?", (addr.address,)).fetchone()
+            if row is None:
+                return None
+            public_key = RSAKey.import_public_key_hex(row[0])
+            self._cache_put(addr, public_key)
+            return public_key
+
+    def add(self, addr, public_key):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO public_keys VALUES (?, ?)", (addr.address, public_key.public_key_hex()))
+            self.db.commit()
+            self._cache_put(addr, public_key)
+
+    def bulk_import(self, public_keys):
+        with self.lock:
+            # A single transaction for all the keys
+            self.db.executemany("INSERT OR REPLACE INTO public_keys VALUES (?, ?)",
+                                ((addr.address, public_key.public_key_hex()) for addr, public_key in public_keys.items()))
+            self.db.commit()
+            # Cached keys that were replaced must not be served any longer
+            for addr, public_key in public_keys.items():
+                if addr in self.cache:
+                    self.cache[addr] = public_key
+
+    def addresses(self):
+        with self.lock:
+            return [Address(row[0]) for row in self.db.execute("SELECT address FROM public_keys")]
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM public_keys").fetchone()[0]
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,71 @@
+""" Key wrapping schemes of the TelefericClient: the AES key of an enveloppe is encrypted for each recipient
+    (MessageEnveloppe.ACL, address => wrapped key)
+"""
+from concurrent.futures import Future
+
+
+class KeyWrapScheme():
+    """ wrap returns the ACL, its values may be concurrent.futures.Future: resolve waits for them """
+    def wrap(self, key, recipients, context):
+        """ key: the AES key (bytes)
+            recipients: list of (address, public RSAKey)
+            context: main.EnveloppeContext of the batch
+        """
+        raise NotImplementedError()
+
+    @staticmethod
+    def resolve(ACL):
+        return {addr: wrapped.result() if isinstance(wrapped, Future) else wrapped for addr, wrapped in ACL.items()}
+
+
+class RSAOAEPKeyWrap(KeyWrapScheme):
+    """ The key is RSA-OAEP encrypted for each recipient in turn, the OAEP cipher of a recipient is created once
+        per batch
+    """
+    def wrap(self, key, recipients, context):
+        ACL = {}
+        for addr, public_key in recipients:
+            with context.lock:
+                if addr not in context.ciphers:
+                    context.ciphers[addr] = public_key.cipher()
+                cipher = context.ciphers[addr]
+            ACL[addr] = cipher.encrypt(key)
+        return ACL
+
+
+def _split(future, count):
+    """ One Future per item of the list future will return """
+    parts = [Future() for _ in range(count)]
+    def done(future):
+        try:
+            results = future.result()
+        except BaseException as error:
+            for part in parts:
+                part.set_exception(error)
+            return
+        for part, result in zip(parts, results):
+            part.set_result(result)
+    future.add_done_callback(done)
+    return parts
+
+
+class BatchedKeyWrap(KeyWrapScheme):
+    """ Same wrapped keys as RSAOAEPKeyWrap (RSA-OAEP per recipient), computed in parallel on a
+        cryptopool.CryptoExecutor: the recipients are sent to the workers by chunks of chunksize.
+        A recipient listed twice is wrapped once. Without crypto_executor, the keys are wrapped in turn.
+    """
+    def __init__(self, crypto_executor=None, chunksize=8):
+        self.crypto_executor = crypto_executor
+        self.chunksize = chunksize
+        self.serial = RSAOAEPKeyWrap()
+
+    def wrap(self, key, recipients, context):
+        recipients = list(dict(recipients).items())
+        if self.crypto_executor is None:
+            return self.serial.wrap(key, recipients, context)
+        ACL = {}
+        for start in range(0, len(recipients), self.chunksize):
+            chunk = recipients[start:start + self.chunksize]
+            future = self.crypto_executor.submit_encrypt_many([public_key for _, public_key in chunk], key)
+            ACL.update(zip([addr for addr, _ in chunk], _split(future, len(chunk))))
+        return ACL
@@ -7,20 +7,28 @@
             pip install msgpack
 """
 from typing import Dict
+from dataclasses import replace
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import os
 from forms import XForm, BooleanField, FileField, get_metadata_dict
 import datetime
 import hashlib
-from model import Address, GetBodyType, Message, MessageEnveloppe,\
+from model import Address, GetBodyType, Message, MessageEnveloppe, MessageEnveloppeView,\
     Attestation, ServiceRegistration, ServiceDocument, ServiceAttestation,\
     DestinationType, InviteRegistration, Invitation, RegistrationRequest,\
     Assertion, BodyType, Attachement, MessageAnalysis,\
     ResearchAnalysis
 from crypto import RSAKey, AESKey
-from serialization import MsgpackSerialize
-from utils import merge_dicts, read_file_contents
+from keydirectory import MemoryKeyDirectory
+from saltstore import salt_key
+from serialization import MsgpackSerialize, msgpack_dict_keys
+from attestation import DEFAULT_RULES, MESSAGE_ANALYSIS, RuleIndex
+from keywrap import BatchedKeyWrap, KeyWrapScheme
+from utils import merge_dicts, MappedFile
 from Crypto.Hash import SHA256
 import random
+import threading
 
 def random_bytes(len):
     # replace by os.urandom or some other crypto strong random in normal code
@@ -28,26 +36,47 @@ def random_bytes(len):
     return bytes(random.randrange(0, 256) for _ in range(len))
 
 class SaltStorage():
-    """ Salt Storage for the Teleferic Client """
-    def __init__(self):
+    """ Salt Storage for the Teleferic Client
+        backend: saltstore.SaltStore keeping the salts (e.g. LogSaltStore to keep them across restarts),
+                 None to keep them in dictionnaries
+    """
+    def __init__(self, backend=None, randbytes=random_bytes):
         self.dossierSalts = {}
         self.metadataSalts = {}
+        self.backend = backend
+        self.randbytes = randbytes
+        # A salt is created once, even when several threads ask for it
+        self.lock = threading.Lock()
 
     def getDossierSalt(self, sender_address, senderID, receiver_address, receiverID):
         key = (sender_address, senderID, receiver_address, receiverID)
-        if key in self.dossierSalts:
-            return self.dossierSalts[key]
-        dossierSalt = random_bytes(40)
-        self.dossierSalts[key] = dossierSalt
-        return dossierSalt
+        if self.backend is not None:
+            return self._get_or_create(salt_key("dossier", *key))
+        with self.lock:
+            if key in self.dossierSalts:
+                return self.dossierSalts[key]
+            dossierSalt = self.randbytes(40)
+            self.dossierSalts[key] = dossierSalt
+            return dossierSalt
     
 
     def getMetadataSalt(self, fieldName):
-        if fieldName in self.metadataSalts:
-            return self.metadataSalts[fieldName]
-        salt = random_bytes(40)
-        self.metadataSalts[fieldName] = salt
-        return salt
+        if self.backend is not None:
+            return self._get_or_create(salt_key("metadata", fieldName))
+        with self.lock:
+            if fieldName in self.metadataSalts:
+                return self.metadataSalts[fieldName]
+            salt = self.randbytes(40)
+            self.metadataSalts[fieldName] = salt
+            return salt
+
+    def _get_or_create(self, key):
+        with self.lock:
+            salt = self.backend.get(key)
+            if salt is None:
+                salt = self.randbytes(40)
+                self.backend.put(key, salt)
+            return salt
 
 
 def makeDossierHash(sender_address, senderID, receiver_address, receiverID, dossierSalt):
@@ -61,29 +90,125 @@ def makeDossierHash(sender_address, senderID, receiver_address, receiverID, doss
 
 
 class TelefericServer():
-    def __init__(self, initial_addresses : Dict[Address, RSAKey]={}):
+    def __init__(self, initial_addresses : Dict[Address, RSAKey]={}, key_directory=None, blob_store=None, verifier=None,
+                 retained_enveloppes=1024):
+        """ key_directory: keydirectory.KeyDirectory holding the public keys (in memory by default)
+            blob_store: blobstore.BlobStore of the attachement containers, None if attachements must be sent inline
+            retained_enveloppes: the containers referenced by the last retained_enveloppes accepted enveloppes can
+                                 not be evicted from blob_store (their recipients may still fetch them)
+            verifier: verification.EnveloppeVerifier checking the enveloppes received (e.g. set after creation to
+                      EnveloppeVerifier(server)), None to accept them unchecked
+        """
+        self.blob_store = blob_store
+        self.verifier = verifier
         self.teleferic_key = RSAKey.load_or_generate("teleferic.pem", 1024)
         self.server_publickey = self.teleferic_key.public_key()
         self.server_address = self.server_publickey.address()
-        self.public_keys = initial_addresses.copy()
-        self.public_keys[self.teleferic_key.address()] = self.teleferic_key.public_key()
+        self.public_keys = key_directory if key_directory is not None else MemoryKeyDirectory()
+        self.public_keys.bulk_import(initial_addresses)
+        self.public_keys.add(self.teleferic_key.address(), self.teleferic_key.public_key())
+        # messageHash of the accepted enveloppes => containerHashes of their attachement references, acquired in
+        # blob_store until drop_enveloppe (oldest first)
+        self.retained_enveloppes = retained_enveloppes
+        self.references = OrderedDict()
+        self.lock = threading.Lock()
         
     def get_pubkey_for_address(self, addr):
         """ Address => RSAKey (public) """
-        return self.public_keys.get(addr)
+        return self.public_keys.get_pubkey_for_address(addr)
     
     def send_enveloppe(self, enveloppe):
-        packed = MsgpackSerialize.pack(enveloppe)
+        return self.send_packed_enveloppe(MsgpackSerialize.pack(enveloppe))
+
+    def send_packed_enveloppe(self, packed):
+        """ Routes an enveloppe as received on the wire: only the fields needed are decoded """
+        return self.accept_enveloppe(*self.process_packed_enveloppe(packed))
+
+    def process_enveloppe(self, enveloppe):
+        return self.process_packed_enveloppe(MsgpackSerialize.pack(enveloppe))
+
+    def process_packed_enveloppe(self, packed):
+        """ CPU bound part of send_packed_enveloppe, without side effect (can run in any thread)
+            Returns (messageHash, public key to register or None, containerHashes of the attachement references),
+            to pass to accept_enveloppe
+        """
+        enveloppe = MessageEnveloppeView(packed)
+        references = []
+        for attachement in enveloppe.attachements:
+            if attachement.objectContainer is not None:
+                continue
+            containerHash = attachement.containerHash
+            if containerHash is None:
+                raise ValueError("Attachement reference without containerHash")
+            if not self.has_blob(containerHash):
+                raise KeyError("Unknown attachement container %s" % containerHash.hex())
+            references.append(containerHash)
+        if self.verifier is not None and not self.verifier.check_hash(enveloppe):
+            raise ValueError("Invalid enveloppe messageHash")
+        public_key = None
         if self.server_address in enveloppe.ACL:
             # The message is for the teleferic server  
-            message = enveloppe.decrypt(self.server_address, self.teleferic_key)
-            # No signature check yet as this is just a proof of concept
+            plaintext = enveloppe.decrypt_raw(self.server_address, self.teleferic_key)
+            message = MsgpackSerialize.unpack(Message, plaintext)
             if message.bodyType == BodyType.RegistrationRequest:
                 # New Registration must be added to the public key database
                 public_key = RSAKey.import_public_key_hex(message.body.publicKey)
-                self.public_keys[public_key.address()] = public_key
+            if self.verifier is not None and not self.verifier.verify(enveloppe, plaintext, public_key):
+                raise ValueError("Invalid enveloppe signature")
+        elif self.verifier is not None and not enveloppe.ACL:
+            # Public message
+            if not self.verifier.verify(enveloppe):
+                raise ValueError("Invalid enveloppe signature")
         
-        return SHA256.new(packed).digest()
+        return SHA256.new(packed).digest(), public_key, references
+
+    def accept_enveloppe(self, messageHash, public_key, references):
+        """ Side effects of an enveloppe processed by process_packed_enveloppe: the containers it references are
+            acquired and public_key is registered. Returns messageHash.
+            The containers are released by drop_enveloppe, or when more than retained_enveloppes enveloppes with
+            references were accepted since.
+        """
+        dropped = []
+        with self.lock:
+            if references and messageHash not in self.references:
+                acquired = []
+                for containerHash in references:
+                    if not self.blob_store.acquire(containerHash):
+                        # Evicted since process_packed_enveloppe
+                        for done in acquired:
+                            self.blob_store.release(done)
+                        raise KeyError("Unknown attachement container %s" % containerHash.hex())
+                    acquired.append(containerHash)
+                self.references[messageHash] = acquired
+                while len(self.references) > self.retained_enveloppes:
+                    dropped.extend(self.references.popitem(last=False)[1])
+        for containerHash in dropped:
+            self.blob_store.release(containerHash)
+        if public_key is not None:
+            self.register_public_key(public_key)
+        return messageHash
+
+    def drop_enveloppe(self, messageHash):
+        """ Releases the containers referenced by an accepted enveloppe, once it is no longer kept """
+        with self.lock:
+            references = self.references.pop(messageHash, [])
+        for containerHash in references:
+            self.blob_store.release(containerHash)
+
+    def has_blob(self, containerHash):
+        return self.blob_store is not None and containerHash in self.blob_store
+
+    def put_blob(self, container, objectHash=None):
+        """ Uploads an attachement container, returns its containerHash """
+        if self.blob_store is None:
+            raise ValueError("The server has no blob store")
+        return self.blob_store.put(container, objectHash)
+
+    def get_blob(self, containerHash):
+        return self.blob_store.get(containerHash) if self.blob_store is not None else None
+
+    def register_public_key(self, public_key):
+        self.public_keys.add(public_key.address(), public_key)
         
     def get_server_address(self):
         return self.server_publickey.address()
@@ -94,9 +219,18 @@ class TelefericServer():
 
 
 class AttestationEngine():
-    def __init__(self):
+    def __init__(self, rules=DEFAULT_RULES, executor=None):
+        """ rules: attestation.AttestationRule, compiled into a RuleIndex
+            executor: optional concurrent.futures.ThreadPoolExecutor, the attachements are decrypted and scanned on
+            it and process_batch fans the enveloppes across it. The tasks share the engine key and the blob store
+            connection, they can not be pickled to a process pool.
+        """
+        if executor is not None and not isinstance(executor, ThreadPoolExecutor):
+            raise TypeError("AttestationEngine needs a ThreadPoolExecutor, not %s" % type(executor).__name__)
         self.key = RSAKey.load_or_generate('KYC3_key.pem', 1024)
         self.address = self.key.address()
+        self.rule_index = RuleIndex(rules)
+        self.executor = executor
 
     def create_message_analysis(self, name, valid=True):
         return Attestation.AttestationEntry(name, 
@@ -109,37 +243,110 @@ class AttestationEngine():
     def create_attestation(self, name):
         Attestation.AttestationEntry("MRZ", )
         
-        
-    def get_attestation(self, assertion_enveloppe):
-        # There are no fields to describe which assertions are requested? We will just make all possible
+    def create_entry(self, name, kind):
+        if kind == MESSAGE_ANALYSIS:
+            return self.create_message_analysis(name)
+        return self.create_research_analysis(name)
+
+    @staticmethod
+    def attachement_fields(key, attachement):
+        """ Field names of an attachement: only the keys of the packed dict are decoded, not the documents.
+            Raises ValueError if the container does not match objectHash.
+        """
+        return msgpack_dict_keys(attachement.decrypt(key))
+
+    def scan_assertion(self, assertion_enveloppe, blob_store=None, parallel=True):
+        """ (Assertion, the field names of each attachement), the attachements are checked against their objectHash
+            blob_store: where to find the containers of the attachement references
+            parallel: scan the attachements on the executor
+        """
         message = assertion_enveloppe.decrypt(self.address, self.key)
         assertion = message.body
-        attestation_entries = []
-        for a in assertion_enveloppe.attachements:
-            key = AESKey(assertion.containerKey)
-            decrypted_container = key.decrypt(a.objectContainer)
-            #print (decrypted_container)
-            attachement_dict = MsgpackSerialize.unpack(Dict[str, str], decrypted_container)
-            #for name, value in attachement_dict:
-            if "IdentityDocument" in attachement_dict:
-                attestation_entries.append(self.create_message_analysis("MRZ"))
-                attestation_entries.append(self.create_research_analysis("Fraud"))
-                attestation_entries.append(self.create_research_analysis("PEP"))
-                attestation_entries.append(self.create_research_analysis("Sanction"))
-                attestation_entries.append(self.create_research_analysis("SanctionCountry"))
-                attestation_entries.append(self.create_research_analysis("CountryRisk"))
-                attestation_entries.append(self.create_research_analysis("BlackList"))
-            if {"Name", "Surname", "AddressLine1", "AddressLine2", "PostalCode", "City", "Country", "Email", "PhoneNumber"}.issubset(set(attachement_dict.keys())):
-                attestation_entries.append(self.create_research_analysis("AddressValidity"))
-                attestation_entries.append(self.create_research_analysis("KnownCustomer"))
-                attestation_entries.append(self.create_message_analysis("ResidenceClassifier"))
-        return Attestation(assertion.subjectAddr, attestation_entries)
+        key = AESKey(assertion.containerKey)
+        attachements = [self.resolve(a, blob_store) for a in assertion_enveloppe.attachements]
+        if not parallel or self.executor is None or len(attachements) < 2:
+            fields = [self.attachement_fields(key, a) for a in attachements]
+        else:
+            fields = list(self.executor.map(lambda a: self.attachement_fields(key, a), attachements))
+        return assertion, fields
+
+    @staticmethod
+    def resolve(attachement, blob_store):
+        """ The attachement with its container, ValueError for a reference without blob_store """
+        if not attachement.is_reference:
+            return attachement
+        if blob_store is None:
+            raise ValueError("Attachement reference without a blob store")
+        return blob_store.resolve(attachement)
+
+    def rules_for(self, fields):
+        """ The rules matched by the field names of each attachement, in attachement order """
+        return [rule for attachement_fields in fields for rule in self.rule_index.match(attachement_fields)]
+
+    def match_rules(self, assertion_enveloppe, blob_store=None, parallel=True):
+        """ (Assertion, the rules matched by the attachements, in attachement order), see scan_assertion """
+        assertion, fields = self.scan_assertion(assertion_enveloppe, blob_store, parallel)
+        return assertion, self.rules_for(fields)
+
+    def build_attestation(self, subject, rules):
+        """ The Attestation of subject (Address) for the matched rules """
+        return Attestation(subject, [self.create_entry(name, kind) for rule in rules for name, kind in rule.entries])
+
+    def get_attestation(self, assertion_enveloppe, blob_store=None, parallel=True):
+        """ blob_store: where to find the containers of the attachement references
+            parallel: scan the attachements on the executor
+        """
+        # There are no fields to describe which assertions are requested? We will just make all possible
+        assertion, rules = self.match_rules(assertion_enveloppe, blob_store, parallel)
+        return self.build_attestation(assertion.subjectAddr, rules)
+
+    def process_batch(self, envelopes, blob_store=None):
+        """ Attestations of several assertion enveloppes, in order. With an executor, each enveloppe is processed
+            by a worker (its attachements are then scanned on that worker, not submitted to the executor again)
+        """
+        if self.executor is None:
+            return [self.get_attestation(e, blob_store) for e in envelopes]
+        return list(self.executor.map(lambda e: self.get_attestation(e, blob_store, parallel=False), envelopes))
     
     
+class EnveloppeDraft():
+    """ An enveloppe being built by the TelefericClient stages """
+    def __init__(self, sender_key, senderID, destination_list, message_body, attachements=[], metahashes=[]):
+        self.sender_key = sender_key
+        self.senderID = senderID
+        self.destination_list = destination_list
+        self.message_body = message_body
+        self.attachements = attachements
+        # The DossierHash is computed using the first Destination.
+        if destination_list:
+            self.receiver_address, self.receiverID = destination_list[0]
+        else:
+            self.receiver_address, self.receiverID = None, None
+        self.key = None
+        self.ACL = {}
+
+
+class EnveloppeContext():
+    """ Per sender and per recipient work shared by the enveloppes of a batch (make_enveloppes, or a window of
+        EnveloppePipeline messages). The stage workers of a pipeline share it: lookups and inserts hold lock.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.senders = {} # sender_key => (sender_address, signer)
+        self.dossier_salts = {} # (sender_address, senderID, receiver_address, receiverID) => dossierSalt
+        self.ciphers = {} # receiver address => OAEP cipher
+
+
 class TelefericClient():
-    def __init__(self, teleferic_server):
+    def __init__(self, teleferic_server, crypto_executor=None, salt_storage=None, key_wrap=None):
+        """ crypto_executor: optional cryptopool.CryptoExecutor, signs and wraps the keys on a process pool
+            salt_storage: SaltStorage of the client (by default, in memory)
+            key_wrap: keywrap.KeyWrapScheme of the ACL (by default BatchedKeyWrap on crypto_executor)
+        """
         self.teleferic_server = teleferic_server
-        self.salt_storage = SaltStorage()
+        self.salt_storage = salt_storage if salt_storage is not None else SaltStorage()
+        self.crypto_executor = crypto_executor
+        self.key_wrap = key_wrap if key_wrap is not None else BatchedKeyWrap(crypto_executor)
 
     def get_teleferic_address(self):
         return self.teleferic_server.get_server_address()
@@ -154,50 +361,101 @@ class TelefericClient():
             Dossier Hash for public messages?
             Service ID 0, is a special value?
         """
-        serviceID = senderID
-        if destination_list:
-            receiver_address, receiverID = destination_list[0]
-        else:
-            receiver_address, receiverID = None, None
-        sender_address = sender_key.address()
-        dossierSalt = self.salt_storage.getDossierSalt(sender_address, senderID, receiver_address, receiverID)
-        bodyType = GetBodyType(message_body)
+        return self.make_enveloppes([(sender_key, senderID, destination_list, message_body, attachements, metahashes)])[0]
+
+    def make_enveloppes(self, batch):
+        """
+            batch: list of (sender_key, senderID, destination_list, message_body[, attachements[, metahashes]]),
+            as the arguments of make_enveloppe. Returns the same enveloppes as make_enveloppe called for each entry.
+            The sender address and signer are derived once per sender key, the dossier salt once per dossier,
+            the recipient public key and OAEP cipher once per recipient.
+        """
+        context = EnveloppeContext()
+        drafts = []
+        for entry in batch:
+            draft = self.pack_message(EnveloppeDraft(*entry), context)
+            self.sign_message(draft)
+            self.encrypt_message(draft)
+            self.wrap_key(draft, context)
+            drafts.append(draft)
+        # With a crypto_executor, the signatures and wrapped keys of the whole batch are submitted before waiting
+        return [self.seal_enveloppe(draft) for draft in drafts]
+
+    # The stages of make_enveloppes (see also pipeline.EnveloppePipeline)
+    def pack_message(self, draft, context):
+        sender_key = draft.sender_key
+        with context.lock:
+            if sender_key not in context.senders:
+                context.senders[sender_key] = (sender_key.address(), sender_key.signer())
+            draft.sender_address, draft.signer = context.senders[sender_key]
+            dossier = (draft.sender_address, draft.senderID, draft.receiver_address, draft.receiverID)
+            if dossier not in context.dossier_salts:
+                context.dossier_salts[dossier] = self.salt_storage.getDossierSalt(*dossier)
+            draft.dossierSalt = context.dossier_salts[dossier]
+        serviceID = draft.senderID
         message = Message(serviceID,
-                          receiverID,
-                          dossierSalt,
-                          bodyType,
-                          message_body)
+                          draft.receiverID,
+                          draft.dossierSalt,
+                          GetBodyType(draft.message_body),
+                          draft.message_body)
+        draft.serialized_message = MsgpackSerialize.pack(message)
+        return draft
 
-        serialized_message = MsgpackSerialize.pack(message)
-        messageSig = sender_key.sign(serialized_message)
-        replacesMsgHash = None
-        ACL = {}
-        if not destination_list:
+    def sign_message(self, draft):
+        if self.crypto_executor:
+            draft.messageSig = self.crypto_executor.submit_sign(draft.sender_key, draft.serialized_message)
+        else:
+            draft.messageSig = draft.signer.sign(SHA256.new(draft.serialized_message))
+        return draft
+
+    def encrypt_message(self, draft):
+        if not draft.destination_list:
             # This is a public message: don't encrypt anything
-            encrypted_message = serialized_message         
+            draft.encrypted_message = draft.serialized_message
         else:
-            # Message with destinations
-            # We encrypt the message using AES, query each destination public key and RSA encrypt the key for each destination
-            key = AESKey.generate()
-            for addr, receiver_id in destination_list:
-                pubkey = self.teleferic_server.get_pubkey_for_address(addr)
-                ACL[addr] = pubkey.encrypt(key.key)
-            encrypted_message = key.encrypt(serialized_message)
-            
-        messageHash = hashlib.sha256(encrypted_message).digest()
-        dossierHash = makeDossierHash(sender_address, senderID, receiver_address, receiverID, dossierSalt)
-        
-        enveloppe = MessageEnveloppe(messageHash, # hash of encrypted body
-                        dossierHash, # hash of the SerciceAddress+ServiceId+ConsumerAddres+ConsumerId+DossierSalt
-                        sender_key.address(),
-                        messageSig, # signature of the unencrypted message
-                        encrypted_message,
-                        ACL, #: List[Address, bytes]]
-                        attachements, #: List[Attachement]
-                        replacesMsgHash) #: bytes
-        return enveloppe
+            # Message with destinations: we encrypt the message using AES
+            draft.key = AESKey.generate()
+            draft.encrypted_message = draft.key.encrypt(draft.serialized_message)
+        return draft
+
+    def wrap_key(self, draft, context):
+        # Query each destination public key and RSA encrypt the AES key for each destination
+        if draft.destination_list:
+            recipients = [(addr, self.teleferic_server.get_pubkey_for_address(addr)) for addr, receiver_id in draft.destination_list]
+            draft.ACL = self.key_wrap.wrap(draft.key.key, recipients, context)
+        return draft
+
+    def seal_enveloppe(self, draft):
+        if self.crypto_executor:
+            # Wait for the signature computed by the process pool
+            draft.messageSig = draft.messageSig.result()
+        draft.ACL = KeyWrapScheme.resolve(draft.ACL)
+        messageHash = hashlib.sha256(draft.encrypted_message).digest()
+        dossierHash = makeDossierHash(draft.sender_address, draft.senderID, draft.receiver_address, draft.receiverID, draft.dossierSalt)
+        replacesMsgHash = None
+        return MessageEnveloppe(messageHash, # hash of encrypted body
+                                dossierHash, # hash of the SerciceAddress+ServiceId+ConsumerAddres+ConsumerId+DossierSalt
+                                draft.sender_address,
+                                draft.messageSig, # signature of the unencrypted message
+                                draft.encrypted_message,
+                                draft.ACL, #: List[Address, bytes]]
+                                draft.attachements, #: List[Attachement]
+                                replacesMsgHash) #: bytes
 
     
+    def upload_attachements(self, attachements):
+        """ Uploads the containers the server does not have yet, returns the references to send instead """
+        references = []
+        for attachement in attachements:
+            if attachement.is_reference:
+                references.append(attachement)
+                continue
+            if attachement.containerHash is None or not self.teleferic_server.has_blob(attachement.containerHash):
+                containerHash = self.teleferic_server.put_blob(attachement.objectContainer, attachement.objectHash)
+                attachement = replace(attachement, containerHash=containerHash)
+            references.append(attachement.reference())
+        return references
+
     def send_message(self, sender_key, senderID, destination_list, message_body, attachements=[]):
         enveloppe = self.make_enveloppe(sender_key, senderID, destination_list, message_body, attachements)
         return self.teleferic_server.send_enveloppe(enveloppe)
@@ -281,7 +539,6 @@ def main_scenario():
     # We prepare the required forms
     doc1, doc2, doc3 = serviceAnnouncementMessage.documents
     form1, form2, form3 = doc1.xform, doc2.xform, doc3.xform
-    data1 = form1.validate({"IdentityDocument" : read_file_contents("passport.png")})
     data2 = form2.validate({"Name" : "John",
                             "Surname" : "Doe",
                             "AddressLine1" : "167 Custom Road",
@@ -294,12 +551,15 @@ def main_scenario():
     data3 = form3.validate({"TermsAndConditions" : True})
 
     key = AESKey.generate()
-    metadict1, metahashes1 = get_metadata_dict(data1, teleferic.salt_storage)
+    # The document is encrypted straight from the mapped file
+    with MappedFile("passport.png") as passport:
+        data1 = form1.validate({"IdentityDocument" : passport})
+        metadict1, metahashes1 = get_metadata_dict(data1, teleferic.salt_storage)
+        attachement1 = Attachement.make_packed(key, data1, metahashes1, customer_key)
     metadict2, metahashes2 = get_metadata_dict(data2, teleferic.salt_storage)
     metadict3, metahashes3 = get_metadata_dict(data3, teleferic.salt_storage)
-    attachement1 = Attachement.make(key, MsgpackSerialize.pack(data1), metahashes1) 
-    attachement2 = Attachement.make(key, MsgpackSerialize.pack(data2), metahashes2) 
-    attachement3 = Attachement.make(key, MsgpackSerialize.pack(data3), metahashes3) 
+    attachement2 = Attachement.make(key, MsgpackSerialize.pack(data2), metahashes2, customer_key)
+    attachement3 = Attachement.make(key, MsgpackSerialize.pack(data3), metahashes3, customer_key)
     
     assertion = Assertion(customer_address, # PM Address Persona for the assertion
                           datetime.date(2020, 1, 1), # Unix timestamp, 0 or -1 ZULU time, 0 for none, -1 for indefinite, -2 for undetermined
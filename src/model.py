@@ -1,9 +1,13 @@
 from enum import Enum, auto
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 from typing import Dict, List
 import datetime
-from crypto import AESKey, Address
-from serialization import MsgpackSerialize
+import io
+import os
+from Crypto.Hash import SHA256
+from crypto import AESKey, AESEncryptWriter, Address
+from serialization import MsgpackSerialize, MsgpackStructView, msgpack_array_header
+from utils import HashingWriter, add_slots
 
 
 class BodyType(Enum):
@@ -26,6 +30,7 @@ class BodyType(Enum):
 
 
 
+@add_slots
 @dataclass(frozen=True)
 class Attachement():
     containerHash: bytes
@@ -35,20 +40,121 @@ class Attachement():
     Metahashes: List[bytes]
 
     @classmethod
-    def make(cls, key, data, metahashes):
-        """ Make an attachment while computing all hashes """
-        objectContainer = key.encrypt(data)
-        containerHash = None # TODO
-        containerSig = None # TODO
-        objectHash = None # TODO
-        return cls(containerHash, containerSig, objectContainer, objectHash, metahashes)
+    def make(cls, key, data, metahashes, sign_key=None):
+        """ Make an attachment while computing all hashes (see AttachementBuilder) """
+        builder = AttachementBuilder(key, sign_key)
+        builder.write(data)
+        return builder.build(metahashes)
+
+    @classmethod
+    def make_packed(cls, key, values, metahashes, sign_key=None):
+        """ Same as make(key, MsgpackSerialize.pack(values), metahashes), packing and encrypting in one pass:
+            large binary values (e.g. a MappedFile) are encrypted in place, without packed or plaintext copies.
+        """
+        builder = AttachementBuilder(key, sign_key)
+        MsgpackSerialize.dump(values, builder)
+        return builder.build(metahashes)
+
+    @classmethod
+    def make_from_stream(cls, key, fin, metahashes, sign_key=None, chunk_size=1024 * 1024):
+        """ Same as make(key, fin.read(), metahashes), reading the binary file-like object fin by chunks """
+        builder = AttachementBuilder(key, sign_key)
+        builder.write_stream(fin, chunk_size)
+        return builder.build(metahashes)
+
+    def reference(self):
+        """ The attachement without its container, to send when the container is in the BlobStore """
+        return replace(self, objectContainer=None)
+
+    @property
+    def is_reference(self):
+        return self.objectContainer is None
+
+    def verify_container(self, public_key=None):
+        """ Checks containerHash, and containerSig if public_key (of the signer) is given """
+        if self.containerHash != SHA256.new(self.objectContainer).digest():
+            return False
+        return public_key is None or public_key.verify(self.objectContainer, self.containerSig)
+
+    def decrypt(self, key):
+        """ Decrypts the container and checks objectHash """
+        data = key.decrypt(self.objectContainer)
+        if self.objectHash != SHA256.new(data).digest():
+            raise ValueError("Attachement objectHash mismatch")
+        return data
+
+
+class AttachementBuilder():
+    """ Builds an Attachement in a single pass: each slice of plaintext written is hashed (objectHash) and encrypted,
+        and the container (nonce + ciphertext + tag) is hashed as it is produced (containerHash).
+        containerSig is the PSS signature of the container by sign_key (None without sign_key),
+        so that sign_key.public_key().verify(objectContainer, containerSig) holds.
+        The digests are available after build, as objectHash and containerHash.
+    """
+    def __init__(self, key, sign_key=None, randbytes=os.urandom):
+        self.sign_key = sign_key
+        self.object_digest = SHA256.new()
+        self.container_digest = SHA256.new()
+        self.container = io.BytesIO()
+        self.writer = key.encrypt_writer(randbytes, HashingWriter(self.container, self.container_digest))
+        self.objectHash = None
+        self.containerHash = None
+
+    def write(self, data):
+        data = memoryview(data).cast("B")
+        for start in range(0, len(data), AESEncryptWriter.SLICE_SIZE):
+            chunk = data[start:start + AESEncryptWriter.SLICE_SIZE]
+            self.object_digest.update(chunk)
+            self.writer.write(chunk)
+        return len(data)
+
+    def write_stream(self, fin, chunk_size=1024 * 1024):
+        while True:
+            chunk = fin.read(chunk_size)
+            if not chunk:
+                return
+            self.write(chunk)
+
+    def build(self, metahashes):
+        self.writer.finish()
+        self.objectHash = self.object_digest.digest()
+        self.containerHash = self.container_digest.digest()
+        containerSig = self.sign_key.signer().sign(self.container_digest) if self.sign_key is not None else None
+        # BytesIO.getvalue does not copy the buffer
+        return Attachement(self.containerHash, containerSig, self.container.getvalue(), self.objectHash, metahashes)
       
       
 @dataclass(frozen=True)
 class MessageBody():
-    pass
+    # Lets the body classes have __slots__ (utils.add_slots)
+    __slots__ = ()
+
+
+class UnregisteredBodyType(KeyError):
+    """ No MessageBody class is registered for a BodyType (or no BodyType for a class) """
+
+
+# Filled once at import by the register_body decorator
+_body_classes = {} # BodyType => MessageBody subclass
+_body_types = {} # MessageBody subclass => BodyType
+_body_decoders = {} # BodyType name (as packed) => (BodyType, struct => body)
+
+
+def register_body(bodyType):
+    """ Class decorator: cls is the body of the bodyType messages. The body decoder is compiled here. """
+    def register(cls):
+        if bodyType in _body_classes:
+            raise ValueError("%s is already registered to %s" % (bodyType, _body_classes[bodyType].__name__))
+        _body_classes[bodyType] = cls
+        _body_types[cls] = bodyType
+        _body_decoders[bodyType.name] = (bodyType, MsgpackSerialize.unpacker(cls))
+        return cls
+    return register
 
     
+_MESSAGE_FIELDS = ("body", "bodyType", "consumerID", "dossierSalt", "serviceID")
+
+
 @dataclass(frozen=True)
 class Message():
     serviceID: int
@@ -59,14 +165,17 @@ class Message():
 
     @classmethod
     def from_struct(cls, data):
-        datadict = dict(data)
-        # Deserialize Body based on BodyClass
-        bodyType = MsgpackSerialize.from_struct(BodyType, datadict["bodyType"])
-        bodyClass = GetBodyClass(bodyType)
-        body = MsgpackSerialize.from_struct(bodyClass, datadict["body"])
-        return cls(datadict["serviceID"], datadict["consumerID"], datadict["dossierSalt"], 
-                   bodyType, body)
+        # Packed fields are sorted by name
+        (k0, body), (k1, bodyTypeName), (k2, consumerID), (k3, dossierSalt), (k4, serviceID) = data
+        if (k0, k1, k2, k3, k4) != _MESSAGE_FIELDS:
+            raise ValueError("Unexpected Message fields %s" % ((k0, k1, k2, k3, k4),))
+        try:
+            bodyType, decode = _body_decoders[bodyTypeName]
+        except KeyError:
+            raise UnregisteredBodyType(bodyTypeName) from None
+        return cls(serviceID, consumerID, dossierSalt, bodyType, None if body is None else decode(body))
         
+@add_slots
 @dataclass(frozen=True)
 class MessageEnveloppe():
     messageHash: bytes
@@ -80,11 +189,108 @@ class MessageEnveloppe():
 
     def decrypt(self, address, key):
         """ Returns Message, Body """             
+        return MsgpackSerialize.unpack(Message, self.decrypt_raw(address, key))
+
+    def decrypt_raw(self, address, key):
+        """ The packed Message (what messageSig signs) """
         encrypted_key = self.ACL[address]
         aeskeydata = key.decrypt(encrypted_key)
         aeskey = AESKey(aeskeydata)
-        message = MsgpackSerialize.unpack(Message, aeskey.decrypt(self.message))
-        return message
+        return aeskey.decrypt(self.message)
+
+
+class AttachementView():
+    """ Lazy view over a packed Attachement: objectContainer is a memoryview slice of the packed buffer """
+    def __init__(self, view):
+        self.view = view
+
+    @property
+    def objectContainer(self):
+        return self.view.binary("objectContainer")
+
+    @property
+    def containerHash(self):
+        return self.view.decode("containerHash", bytes)
+
+    @property
+    def containerSig(self):
+        return self.view.decode("containerSig", bytes)
+
+    @property
+    def objectHash(self):
+        return self.view.decode("objectHash", bytes)
+
+    @property
+    def Metahashes(self):
+        return self.view.decode("Metahashes", List[bytes])
+
+
+class MessageEnveloppeView():
+    """ Lazy, zero copy view over a packed MessageEnveloppe (as needed to route it)
+        Header fields are decoded on first access, message and the attachement containers are memoryview
+        slices of the packed buffer. Use MsgpackSerialize.unpack(MessageEnveloppe, packed) to decode everything.
+    """
+    def __init__(self, packed):
+        self.packed = memoryview(packed)
+        self.view = MsgpackStructView(self.packed)
+        self._decoded = {}
+
+    def _field(self, name, objtype):
+        if name not in self._decoded:
+            self._decoded[name] = self.view.decode(name, objtype)
+        return self._decoded[name]
+
+    @property
+    def messageHash(self):
+        return self._field("messageHash", bytes)
+
+    @property
+    def dossierHash(self):
+        return self._field("dossierHash", bytes)
+
+    @property
+    def senderAddr(self):
+        return self._field("senderAddr", Address)
+
+    @property
+    def messageSig(self):
+        return self._field("messageSig", bytes)
+
+    @property
+    def ACL(self):
+        return self._field("ACL", Dict[Address, bytes])
+
+    @property
+    def replacesMsgHash(self):
+        return self._field("replacesMsgHash", bytes)
+
+    @property
+    def message(self):
+        return self.view.binary("message")
+
+    @property
+    def attachements(self):
+        if "attachements" not in self._decoded:
+            start, _ = self.view.spans["attachements"]
+            count, pos = msgpack_array_header(self.packed, start)
+            attachements = []
+            for _ in range(count):
+                view = MsgpackStructView(self.packed, pos)
+                attachements.append(AttachementView(view))
+                pos = view.end
+            self._decoded["attachements"] = attachements
+        return self._decoded["attachements"]
+
+    def decrypt(self, address, key):
+        """ Returns Message, Body """
+        return MsgpackSerialize.unpack(Message, self.decrypt_raw(address, key))
+
+    def decrypt_raw(self, address, key):
+        aeskey = AESKey(key.decrypt(self.ACL[address]))
+        return aeskey.decrypt(self.message)
+
+    def unpack(self):
+        return MsgpackSerialize.unpack(MessageEnveloppe, self.packed)
 
 
 DestinationType = Enum("DestinationType", "SendConsumer SendServiceProvider SendBoth")
@@ -104,6 +310,7 @@ class ServiceDocument():
     requiredAttestations: List[ServiceAttestation]
 
 
+@register_body(BodyType.ServiceRegistration)
 @dataclass(frozen=True)
 class ServiceRegistration(MessageBody):
     serviceId: str
@@ -116,6 +323,7 @@ class ServiceRegistration(MessageBody):
     documents: List[ServiceDocument]
 
 
+@register_body(BodyType.InviteRegistration)
 @dataclass(frozen=True)
 class InviteRegistration(MessageBody):
     boostrapNode: str
@@ -132,6 +340,7 @@ class Invitation(InviteRegistration):
     inviteKey: bytes
 
 
+@register_body(BodyType.RegistrationRequest)
 @dataclass(frozen=True)
 class RegistrationRequest(MessageBody):
     inviteMsgID: bytes
@@ -141,8 +350,11 @@ class RegistrationRequest(MessageBody):
     publicNickname: bytes
 
 
+@register_body(BodyType.Assertion)
+@add_slots
 @dataclass(frozen=True)
 class Assertion(MessageBody):
+    @add_slots
     @dataclass(frozen=True)
     class Metadata():
         MetaSalt: bytes # 40 bytes or “0” A 40-byte salt value appended to meta-data in order to match public hash values, or 0 for unsalted.  Metasalt should be generated CONFIDENTIAL Page | 19
@@ -162,6 +374,7 @@ class AttestationDetail():
 AttestationType = Enum("AttestationType", "MessageAnalysis MessageComparision ResearchAnalysis Rejection")
 
 
+@register_body(BodyType.Attestation)
 @dataclass(frozen=True)
 class Attestation(MessageBody):
     @dataclass(frozen=True)
@@ -169,8 +382,17 @@ class Attestation(MessageBody):
         attestType: str
         #attestSig: bytes # xades-t
         detail: AttestationDetail
+
+        @classmethod
+        def from_struct(cls, data):
+            datadict = dict(data)
+            detail = datadict["detail"]
+            if detail is not None:
+                # The detail is packed as its subclass: found by its field names
+                detail = MsgpackSerialize.from_struct(_detail_classes[frozenset(k for k, _ in detail)], detail)
+            return cls(datadict["attestType"], detail)
     subject: Address
-    attestations: AttestationEntry
+    attestations: List[AttestationEntry]
  
  
 @dataclass(frozen=True)
@@ -232,23 +454,18 @@ class Rejection(AttestationDetail):
     rejectReason: str
 
 
-def GetBodyType(message_body):
-    objtype = type(message_body)
-    mapping = {ServiceRegistration : BodyType.ServiceRegistration,
-               InviteRegistration : BodyType.InviteRegistration,
-               RegistrationRequest : BodyType.RegistrationRequest,
-               Assertion: BodyType.Assertion}
-    return mapping[objtype]
-
-
-
-def GetBodyClass(bodyType):
-    mapping = {BodyType.ServiceRegistration: ServiceRegistration ,
-               BodyType.InviteRegistration: InviteRegistration,
-               BodyType.RegistrationRequest : RegistrationRequest,
-               BodyType.Assertion : Assertion}
-    return mapping[bodyType]
+_detail_classes = {frozenset(cls.__dataclass_fields__): cls for cls in AttestationDetail.__subclasses__()}
 
 
+def GetBodyType(message_body):
+    try:
+        return _body_types[type(message_body)]
+    except KeyError:
+        raise UnregisteredBodyType(type(message_body).__name__) from None
 
 
+def GetBodyClass(bodyType):
+    try:
+        return _body_classes[bodyType]
+    except KeyError:
+        raise UnregisteredBodyType(bodyType) from None
@@ -0,0 +1,137 @@
+""" Staged processing pipeline: each stage has its own worker threads and bounded input queue,
+    so that the stages of consecutive items overlap (serializing N+1 while signing N and submitting N-1).
+"""
+from concurrent.futures import Future
+import queue
+import threading
+import time
+from main import EnveloppeDraft, EnveloppeContext
+from utils import LatencyStats
+
+
+_STOP = object()
+
+
+class Stage():
+    """ func: item => item for the next stage """
+    def __init__(self, name, func, workers=1, queue_size=64):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.queue = queue.Queue(queue_size)
+        self.latency = LatencyStats()
+        self.max_depth = 0
+
+    def depth(self):
+        return self.queue.qsize()
+
+
+class Pipeline():
+    """ Runs the items submitted through the stages, in order. submit returns a concurrent.futures.Future
+        of the result of the last stage. A full stage queue blocks the previous stage (and submit).
+    """
+    def __init__(self, stages):
+        self.stages = stages
+        self.threads = []
+
+    def start(self):
+        for i, stage in enumerate(self.stages):
+            next_stage = self.stages[i + 1] if i + 1 < len(self.stages) else None
+            for _ in range(stage.workers):
+                thread = threading.Thread(target=self._run, args=(stage, next_stage), daemon=True)
+                thread.start()
+                self.threads.append(thread)
+        return self
+
+    def stop(self):
+        """ Waits for the items already submitted, then stops the workers """
+        for stage in self.stages:
+            for _ in range(stage.workers):
+                stage.queue.put(_STOP)
+            for thread in self.threads[:stage.workers]:
+                thread.join()
+            self.threads = self.threads[stage.workers:]
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def submit(self, item):
+        future = Future()
+        self._put(self.stages[0], (item, future))
+        return future
+
+    def map(self, items):
+        futures = [self.submit(item) for item in items]
+        return [future.result() for future in futures]
+
+    def _put(self, stage, job):
+        stage.queue.put(job)
+        stage.max_depth = max(stage.max_depth, stage.queue.qsize())
+
+    def _run(self, stage, next_stage):
+        while True:
+            job = stage.queue.get()
+            if job is _STOP:
+                return
+            item, future = job
+            start = time.perf_counter()
+            try:
+                result = stage.func(item)
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            finally:
+                stage.latency.record(time.perf_counter() - start)
+            if next_stage is None:
+                future.set_result(result)
+            else:
+                self._put(next_stage, (result, future))
+
+    def stats(self):
+        """ name => (LatencyStats, current queue depth, max queue depth) """
+        return dict((stage.name, (stage.latency, stage.depth(), stage.max_depth)) for stage in self.stages)
+
+
+class EnveloppePipeline(Pipeline):
+    """ TelefericClient.send_message as a pipeline: pack, sign, AES encrypt, key wrap, hash and submit
+        workers: name => number of worker threads of the stage
+        context_size: messages sharing an EnveloppeContext, a new one is started after them so that the per
+        sender and per recipient caches do not grow for the lifetime of the pipeline
+    """
+    STAGES = ("pack", "sign", "encrypt", "wrap", "seal", "submit")
+
+    def __init__(self, client, workers={}, queue_size=64, context_size=1024):
+        self.client = client
+        self.context_size = context_size
+        self.context = EnveloppeContext()
+        self.context_uses = 0
+        self.context_lock = threading.Lock()
+        funcs = {"pack": self._pack,
+                 "sign": client.sign_message,
+                 "encrypt": client.encrypt_message,
+                 "wrap": self._wrap,
+                 "seal": client.seal_enveloppe,
+                 "submit": client.teleferic_server.send_enveloppe}
+        super().__init__([Stage(name, funcs[name], workers.get(name, 1), queue_size) for name in self.STAGES])
+
+    def _pack(self, entry):
+        with self.context_lock:
+            if self.context_uses >= self.context_size:
+                self.context = EnveloppeContext()
+                self.context_uses = 0
+            self.context_uses += 1
+            context = self.context
+        draft = self.client.pack_message(EnveloppeDraft(*entry), context)
+        # The later stages use the context the draft was packed with
+        draft.context = context
+        return draft
+
+    def _wrap(self, draft):
+        return self.client.wrap_key(draft, draft.context)
+
+    def send_message(self, sender_key, senderID, destination_list, message_body, attachements=[]):
+        """ Returns a Future of the messageHash """
+        return self.submit((sender_key, senderID, destination_list, message_body, attachements))
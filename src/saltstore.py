@@ -0,0 +1,246 @@
+""" Salt stores of the Teleferic Client SaltStorage (salt key => salt)
+
+    Salt keys are SHA256 digests of what the salt is for (see salt_key): the dossier parties and the metadata
+    values are not written to disk.
+"""
+from collections import OrderedDict
+import hashlib
+import heapq
+import os
+import struct
+import threading
+from crypto import CacheStats
+from serialization import MsgpackSerialize
+
+
+def salt_key(*parts):
+    """ 32 bytes key of a salt, e.g. salt_key("dossier", sender_address, senderID, receiver_address, receiverID) """
+    return hashlib.sha256(MsgpackSerialize.pack(list(parts))).digest()
+
+
+class SaltStore():
+    """ salt key => salt """
+    def get(self, key):
+        raise NotImplementedError()
+
+    def put(self, key, salt):
+        raise NotImplementedError()
+
+
+class MemorySaltStore(SaltStore):
+    """ In memory store, lost on restart """
+    def __init__(self):
+        self.salts = {}
+
+    def get(self, key):
+        return self.salts.get(key)
+
+    def put(self, key, salt):
+        self.salts[key] = salt
+
+    def __len__(self):
+        return len(self.salts)
+
+
+class LogSaltStore(SaltStore):
+    """ File backed store: the salts are appended to a log, a record being the salt key, the payload size and
+        the payload (the salt, or if aes_key is given, the salt key + salt encrypted with AESKey.encrypt).
+
+        The index (salt key => log offset) is a sorted array of fixed size entries, loaded as is from the
+        snapshot file (filename + ".index"), plus a dict of the entries appended since the snapshot: opening only
+        reads the snapshot and the end of the log. The whole array is held in memory (40 bytes per salt).
+        When the dict reaches snapshot_threshold entries (None: only by snapshot), a background thread rewrites
+        the snapshot while get and put go on. Salts read are kept in a LRU cache of cache_size entries.
+    """
+    RECORD_HEADER = struct.Struct(">32sH")
+    INDEX_ENTRY = struct.Struct(">32sQ")
+    INDEX_HEADER = struct.Struct(">4sQ")
+    INDEX_MAGIC = b"PMSI"
+
+    def __init__(self, filename, aes_key=None, cache_size=100000, snapshot_threshold=65536):
+        self.filename = filename
+        self.snapshot_threshold = snapshot_threshold
+        self.index_filename = filename + ".index"
+        self.aes_key = aes_key
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.cache_stats = CacheStats()
+        self.lock = threading.Lock()
+        self.snapshot_index = b""
+        self.index = {}
+        # Entries being written to the snapshot by _snapshot
+        self.frozen_index = {}
+        # One snapshot is written at a time, automatic ones by snapshot_thread
+        self.snapshot_lock = threading.Lock()
+        self.snapshot_thread = None
+        self.log = open(filename, "a+b")
+        self._load()
+
+    def _load(self):
+        log_size = self.log.seek(0, os.SEEK_END)
+        start = 0
+        if os.path.exists(self.index_filename):
+            with open(self.index_filename, "rb") as fin:
+                magic, covered = LogSaltStore.INDEX_HEADER.unpack(fin.read(LogSaltStore.INDEX_HEADER.size))
+                if magic == LogSaltStore.INDEX_MAGIC and covered <= log_size:
+                    self.snapshot_index = fin.read()
+                    start = covered
+        # Entries appended after the snapshot
+        self.log.seek(start)
+        position = start
+        header_size = LogSaltStore.RECORD_HEADER.size
+        while position < log_size:
+            header = self.log.read(header_size)
+            if len(header) < header_size:
+                break
+            key, size = LogSaltStore.RECORD_HEADER.unpack(header)
+            if position + header_size + size > log_size:
+                break
+            self.index[key] = position
+            position += header_size + size
+            self.log.seek(position)
+        if position < log_size:
+            # Torn write at the end of the log
+            self.log.truncate(position)
+
+    def _find_snapshot(self, key):
+        """ Binary search in the snapshot index """
+        entry = LogSaltStore.INDEX_ENTRY
+        low, high = 0, len(self.snapshot_index) // entry.size
+        while low < high:
+            middle = (low + high) // 2
+            middle_key, offset = entry.unpack_from(self.snapshot_index, middle * entry.size)
+            if middle_key == key:
+                return offset
+            if middle_key < key:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def _read(self, offset):
+        self.log.seek(offset)
+        key, size = LogSaltStore.RECORD_HEADER.unpack(self.log.read(LogSaltStore.RECORD_HEADER.size))
+        payload = self.log.read(size)
+        if self.aes_key is None:
+            return payload
+        decrypted = self.aes_key.decrypt(payload)
+        if decrypted[:32] != key:
+            raise ValueError("Salt record does not match its key")
+        return decrypted[32:]
+
+    def _cache_put(self, key, salt):
+        self.cache[key] = salt
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def get(self, key):
+        with self.lock:
+            salt = self.cache.get(key)
+            if salt is not None:
+                self.cache_stats.hits += 1
+                self.cache.move_to_end(key)
+                return salt
+            self.cache_stats.misses += 1
+            offset = self.index.get(key)
+            if offset is None:
+                offset = self.frozen_index.get(key)
+            if offset is None:
+                offset = self._find_snapshot(key)
+            if offset is None:
+                return None
+            salt = self._read(offset)
+            self._cache_put(key, salt)
+            return salt
+
+    def put(self, key, salt):
+        payload = salt if self.aes_key is None else self.aes_key.encrypt(key + salt)
+        with self.lock:
+            offset = self.log.seek(0, os.SEEK_END)
+            self.log.write(LogSaltStore.RECORD_HEADER.pack(key, len(payload)) + payload)
+            self.log.flush()
+            self.index[key] = offset
+            self._cache_put(key, salt)
+            if (self.snapshot_threshold is not None and len(self.index) >= self.snapshot_threshold
+                    and self.snapshot_thread is None):
+                self.snapshot_thread = threading.Thread(target=self._background_snapshot, daemon=True)
+                self.snapshot_thread.start()
+
+    @staticmethod
+    def _merged_entries(snapshot_index, index):
+        """ The snapshot entries and the entries appended since, in key order: for a key in both, the appended
+            one (a salt written again) wins
+        """
+        snapshot = ((key, 0, offset) for key, offset in LogSaltStore.INDEX_ENTRY.iter_unpack(snapshot_index))
+        appended = ((key, 1, offset) for key, offset in sorted(index.items()))
+        previous = None
+        for key, _, offset in heapq.merge(snapshot, appended):
+            if previous is not None and previous[0] != key:
+                yield previous
+            previous = (key, offset)
+        if previous is not None:
+            yield previous
+
+    def snapshot(self):
+        """ Writes the whole index to the snapshot file, the next opening will not scan the log """
+        with self.snapshot_lock:
+            self._snapshot()
+
+    def _background_snapshot(self):
+        try:
+            with self.snapshot_lock:
+                self._snapshot()
+        finally:
+            with self.lock:
+                self.snapshot_thread = None
+
+    def _snapshot(self):
+        """ Only the swaps of the indexes hold lock: get and put go on while the snapshot is written """
+        with self.lock:
+            snapshot_index, frozen = self.snapshot_index, self.index
+            self.frozen_index = frozen
+            self.index = {}
+            covered = self.log.seek(0, os.SEEK_END)
+        try:
+            entry = LogSaltStore.INDEX_ENTRY
+            merged = bytearray()
+            with open(self.index_filename + ".tmp", "wb") as fout:
+                fout.write(LogSaltStore.INDEX_HEADER.pack(LogSaltStore.INDEX_MAGIC, covered))
+                for key, offset in self._merged_entries(snapshot_index, frozen):
+                    packed = entry.pack(key, offset)
+                    fout.write(packed)
+                    merged += packed
+                fout.flush()
+                os.fsync(fout.fileno())
+            os.replace(self.index_filename + ".tmp", self.index_filename)
+        except BaseException:
+            with self.lock:
+                # The entries appended meanwhile are newer
+                frozen.update(self.index)
+                self.index = frozen
+                self.frozen_index = {}
+            raise
+        with self.lock:
+            self.snapshot_index = bytes(merged)
+            self.frozen_index = {}
+
+    def sync(self):
+        with self.lock:
+            self.log.flush()
+            os.fsync(self.log.fileno())
+
+    def __len__(self):
+        with self.lock:
+            count = len(self.snapshot_index) // LogSaltStore.INDEX_ENTRY.size
+            appended = set(self.index).union(self.frozen_index)
+            return count + sum(1 for key in appended if self._find_snapshot(key) is None)
+
+    def close(self):
+        """ Waits for the snapshot being written """
+        with self.lock:
+            snapshot_thread = self.snapshot_thread
+        if snapshot_thread is not None:
+            snapshot_thread.join()
+        with self.snapshot_lock:
+            self.log.close()
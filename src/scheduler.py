@@ -0,0 +1,165 @@
+""" Scheduling of the attestations of an AttestationEngine: persistent job queue, priority classes and result store
+"""
+from concurrent.futures import Future
+import hashlib
+import heapq
+import sqlite3
+import threading
+from attestation import DEFAULT_PRIORITIES
+from typing import List
+from model import Address, Attestation
+from serialization import MsgpackSerialize
+
+
+def document_hash(enveloppe):
+    """ Hash of the documents of an assertion enveloppe, from the objectHashes of its attachements: the same
+        documents sent again in a new enveloppe have the same hash. The objectHashes are only trusted once the
+        attachements were checked against them (AttestationEngine.scan_assertion).
+    """
+    hashes = [a.objectHash for a in enveloppe.attachements]
+    if any(h is None for h in hashes):
+        raise ValueError("Attachement without objectHash")
+    return hashlib.sha256(b"".join(hashes)).digest()
+
+
+class AttestationScheduler():
+    """ Queues assertion enveloppes for an AttestationEngine, processed by at most `workers` threads
+
+        The attachements of an enveloppe are decrypted and checked once, when it is submitted: a job keeps their
+        field names in a SQLite database (filename) until its attestation is stored, the pending jobs are
+        run after a restart. A job is scheduled by the priority class of the attestations it requests
+        (priorities: attestType => class, lower first, unknown types last), then in submission order.
+        Attestations are stored by (subject Address, messageHash): an enveloppe with the same subject and documents
+        (document_hash) as a stored or queued one is answered from the store, the engine is not run again.
+    """
+    def __init__(self, engine, filename, workers=2, priorities=DEFAULT_PRIORITIES, blob_store=None):
+        self.engine = engine
+        self.priorities = priorities
+        self.default_priority = max(priorities.values(), default=-1) + 1
+        self.blob_store = blob_store
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                        "priority INTEGER NOT NULL, subject TEXT NOT NULL, messageHash BLOB NOT NULL, "
+                        "documentHash BLOB NOT NULL, fields BLOB NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS results (subject TEXT NOT NULL, messageHash BLOB NOT NULL, "
+                        "documentHash BLOB NOT NULL, attestation BLOB NOT NULL, PRIMARY KEY (subject, messageHash))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS results_documentHash ON results (subject, documentHash)")
+        # messageHashes of the enveloppes with the same documents as a queued job, answered by it
+        self.db.execute("CREATE TABLE IF NOT EXISTS job_waiters (job INTEGER NOT NULL, messageHash BLOB NOT NULL)")
+        self.db.commit()
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.closed = False
+        self.queue = [] # heap of (priority, job id)
+        # (subject, documentHash) of the queued and running jobs => (job id, [(messageHash, Future or None)])
+        self.waiting = {}
+        for job_id, priority, subject, messageHash, documentHash in self.db.execute(
+                "SELECT id, priority, subject, messageHash, documentHash FROM jobs ORDER BY id").fetchall():
+            self.queue.append((priority, job_id))
+            self.waiting[(subject, documentHash)] = (job_id, [(messageHash, None)])
+        for job_id, subject, documentHash, messageHash in self.db.execute(
+                "SELECT job, subject, documentHash, job_waiters.messageHash FROM job_waiters "
+                "JOIN jobs ON jobs.id = job_waiters.job ORDER BY job_waiters.rowid").fetchall():
+            self.waiting[(subject, documentHash)][1].append((messageHash, None))
+        heapq.heapify(self.queue)
+        self.threads = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def priority(self, rules):
+        return min((self.priorities.get(name, self.default_priority) for rule in rules for name, _ in rule.entries),
+                   default=self.default_priority)
+
+    def submit(self, enveloppe):
+        """ Queues an assertion enveloppe (MessageEnveloppe), returns a concurrent.futures.Future of its Attestation """
+        assertion, fields = self.engine.scan_assertion(enveloppe, self.blob_store)
+        subject = assertion.subjectAddr.address
+        documentHash = document_hash(enveloppe)
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("AttestationScheduler is closed")
+            row = self.db.execute("SELECT attestation FROM results WHERE subject = ? AND documentHash = ?",
+                                  (subject, documentHash)).fetchone()
+            if row is not None:
+                self.db.execute("INSERT OR IGNORE INTO results VALUES (?, ?, ?, ?)",
+                                (subject, enveloppe.messageHash, documentHash, row[0]))
+                self.db.commit()
+                future.set_result(MsgpackSerialize.unpack(Attestation, row[0]))
+                return future
+            waiting = self.waiting.get((subject, documentHash))
+            if waiting is not None:
+                job_id, waiters = waiting
+                self.db.execute("INSERT INTO job_waiters VALUES (?, ?)", (job_id, enveloppe.messageHash))
+                self.db.commit()
+                waiters.append((enveloppe.messageHash, future))
+                return future
+            priority = self.priority(self.engine.rules_for(fields))
+            cursor = self.db.execute("INSERT INTO jobs (priority, subject, messageHash, documentHash, fields) "
+                                     "VALUES (?, ?, ?, ?, ?)", (priority, subject, enveloppe.messageHash, documentHash,
+                                                                MsgpackSerialize.pack(fields)))
+            self.db.commit()
+            self.waiting[(subject, documentHash)] = (cursor.lastrowid, [(enveloppe.messageHash, future)])
+            heapq.heappush(self.queue, (priority, cursor.lastrowid))
+            self.ready.notify()
+        return future
+
+    def result(self, subject, messageHash):
+        """ The stored Attestation of an enveloppe, None if it is not (yet) there """
+        with self.lock:
+            row = self.db.execute("SELECT attestation FROM results WHERE subject = ? AND messageHash = ?",
+                                  (subject.address, messageHash)).fetchone()
+        return MsgpackSerialize.unpack(Attestation, row[0]) if row is not None else None
+
+    def __len__(self):
+        """ Jobs queued or running """
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+
+    def close(self):
+        """ Stops the workers after their current job, the queued jobs stay in the database """
+        with self.lock:
+            self.closed = True
+            self.ready.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.db.close()
+
+    def _work(self):
+        while True:
+            with self.lock:
+                while not self.queue and not self.closed:
+                    self.ready.wait()
+                if self.closed:
+                    return
+                _, job_id = heapq.heappop(self.queue)
+                subject, documentHash, packed = self.db.execute(
+                    "SELECT subject, documentHash, fields FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            attestation, error = None, None
+            try:
+                fields = MsgpackSerialize.unpack(List[List[str]], packed)
+                attestation = self.engine.build_attestation(Address(subject), self.engine.rules_for(fields))
+            except Exception as e:
+                error = e
+            with self.lock:
+                _, waiting = self.waiting.pop((subject, documentHash))
+                try:
+                    if error is None:
+                        packed = MsgpackSerialize.pack(attestation)
+                        self.db.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                                            ((subject, messageHash, documentHash, packed) for messageHash, _ in waiting))
+                    # A failing job is not run again
+                    self.db.execute("DELETE FROM job_waiters WHERE job = ?", (job_id,))
+                    self.db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+                    self.db.commit()
+                except Exception as e:
+                    # The job stays in the database, it is run again after a restart
+                    self.db.rollback()
+                    error = e
+            for _, future in waiting:
+                if future is None:
+                    continue
+                if error is None:
+                    future.set_result(attestation)
+                else:
+                    future.set_exception(error)
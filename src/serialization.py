@@ -1,66 +1,446 @@
 import msgpack
 import datetime
 from enum import Enum
+from operator import attrgetter, methodcaller
 import binascii
+import io
+import struct
+import threading
 
 
-class MsgpackSerialize():
-    """ Deterministric serialization to msgpack (sorts dictionnary and object fields)"""
-    
-    @staticmethod
-    def to_struct(obj):
-        if hasattr(obj, "to_struct"):
-            result =  obj.to_struct()
-            return result
-        elif hasattr(obj, "__dataclass_fields__"):
+# Types that are already msgpack structures: no conversion needed
+_SCALARS = frozenset((str, bytes, int, float, bool, type(None)))
+
+
+def _identity(obj):
+    return obj
+
+
+# Packers are keyed by the runtime type of the object (a MessageBody field may hold any subclass)
+_packers = {}
+# Unpackers are keyed by the declared type (dataclass, Enum, List[...], Dict[...], ...)
+_unpackers = {}
+
+
+def _to_struct(obj):
+    objtype = type(obj)
+    try:
+        packer = _packers[objtype]
+    except KeyError:
+        packer = _packers[objtype] = _compile_packer(objtype)
+    return packer(obj)
+
+
+def _compile_packer(objtype):
+    """ Build the obj => struct function for a type (same rules as the reflective reference implementation,
+        test/reflective_serialization.py) """
+    if hasattr(objtype, "to_struct"):
+        return methodcaller("to_struct")
+    elif hasattr(objtype, "__dataclass_fields__"):
+        names = tuple(sorted(objtype.__dataclass_fields__.keys()))
+        def pack_dataclass(obj):
             result = []
-            for k in sorted(obj.__dataclass_fields__.keys()):
+            for k in names:
                 v = getattr(obj, k)
-                result.append((k, MsgpackSerialize.to_struct(v)))
+                if type(v) not in _SCALARS:
+                    v = _to_struct(v)
+                result.append((k, v))
             return result
-        elif isinstance(obj, Enum):
-            return obj.name
-        elif type(obj) in (list, tuple):
-            return [MsgpackSerialize.to_struct(v) for v in obj]
-        elif type(obj) is dict:
-            keys = sorted(obj.keys())
-            return [(MsgpackSerialize.to_struct(k), MsgpackSerialize.to_struct(obj[k])) for k in keys]
-        elif type(obj) is datetime.date:
-            return obj.isoformat()
+        return pack_dataclass
+    elif issubclass(objtype, Enum):
+        return attrgetter("name")
+    elif objtype in (list, tuple):
+        def pack_list(obj):
+            return [_to_struct(v) for v in obj]
+        return pack_list
+    elif objtype is dict:
+        def pack_dict(obj):
+            return [(_to_struct(k), _to_struct(obj[k])) for k in sorted(obj.keys())]
+        return pack_dict
+    elif objtype is datetime.date:
+        return methodcaller("isoformat")
+    else:
+        return _identity
+
+
+# Unpackers being compiled, published to _unpackers once the outermost compilation is complete: other threads
+# never see a dataclass unpacker whose fields are not linked yet
+_compiling = {}
+_compile_lock = threading.RLock()
+
+
+def _unpacker_for(objtype):
+    try:
+        return _unpackers[objtype]
+    except KeyError:
+        pass
+    with _compile_lock:
+        unpacker = _unpackers.get(objtype) or _compiling.get(objtype)
+        if unpacker is not None:
+            return unpacker
+        outermost = not _compiling
+        try:
+            unpacker = _compile_unpacker(objtype)
+            if outermost:
+                _unpackers.update(_compiling)
+        finally:
+            if outermost:
+                _compiling.clear()
+        return unpacker
+
+
+def _compile_unpacker(objtype):
+    """ Build the struct => obj function for a declared type (same rules as the reflective reference
+        implementation, test/reflective_serialization.py). The returned function expects data to be not None.
+        Called with _compile_lock held.
+    """
+    if hasattr(objtype, "from_struct"):
+        unpacker = objtype.from_struct
+    elif hasattr(objtype, "__dataclass_fields__"):
+        field_unpackers = {}
+        def unpack_dataclass(data):
+            initilizers = {}
+            for (k, value) in data:
+                unpack = field_unpackers[k]
+                initilizers[k] = value if (value is None or unpack is _identity) else unpack(value)
+            return objtype(**initilizers)
+        # Register before linking the fields, so that self referencing types resolve
+        _compiling[objtype] = unpack_dataclass
+        for k, field in objtype.__dataclass_fields__.items():
+            field_unpackers[k] = _unpacker_for(field.type)
+        return unpack_dataclass
+    elif isinstance(objtype, type) and issubclass(objtype, Enum):
+        def unpacker(data):
+            return objtype[data]
+    elif hasattr(objtype, "__origin__") and objtype.__origin__ in (list, tuple):
+        unpack_item = _unpacker_for(objtype.__args__[0])
+        def unpacker(data):
+            return [None if v is None else unpack_item(v) for v in data]
+    elif hasattr(objtype, "__origin__") and objtype.__origin__ is dict:
+        unpack_key = _unpacker_for(objtype.__args__[0])
+        unpack_value = _unpacker_for(objtype.__args__[1])
+        def unpacker(data):
+            return dict((None if k is None else unpack_key(k), None if v is None else unpack_value(v)) for k, v in data)
+    elif objtype is datetime.date:
+        unpacker = datetime.date.fromisoformat
+    else:
+        unpacker = _identity
+    _compiling[objtype] = unpacker
+    return unpacker
+
+
+def _array_header(n):
+    if n < 16:
+        return bytes((0x90 | n,))
+    elif n < 0x10000:
+        return b"\xdc" + struct.pack(">H", n)
+    else:
+        return b"\xdd" + struct.pack(">I", n)
+
+
+def _bin_header(n):
+    if n < 0x100:
+        return bytes((0xc4, n))
+    elif n < 0x10000:
+        return b"\xc5" + struct.pack(">H", n)
+    else:
+        return b"\xc6" + struct.pack(">I", n)
+
+
+# Scalars that the Packer writes as is (binaries go through write_bin)
+_PACKED_SCALARS = frozenset((str, int, float, bool, type(None)))
+
+
+# Encoders write the packed form of an object directly: they are keyed by runtime type, like the packers
+_encoders = {}
+
+
+def _encode(encoder, obj):
+    objtype = type(obj)
+    try:
+        encode = _encoders[objtype]
+    except KeyError:
+        encode = _encoders[objtype] = _compile_encoder(objtype)
+    encode(encoder, obj)
+
+
+def _encode_packed(encoder, obj):
+    encoder.buffer += encoder.packb(obj)
+
+
+def _encode_bin(encoder, obj):
+    if type(obj) is not bytes:
+        obj = memoryview(obj).cast("B")
+    encoder.buffer += _bin_header(len(obj))
+    encoder.write_bin(obj)
+
+
+def _compile_encoder(objtype):
+    """ Build the (encoder, obj) => None function for a type (writes what packb(to_struct(obj)) would) """
+    if hasattr(objtype, "to_struct"):
+        def encode_struct(encoder, obj):
+            encoder.buffer += encoder.packb(obj.to_struct())
+        return encode_struct
+    elif hasattr(objtype, "__dataclass_fields__"):
+        names = sorted(objtype.__dataclass_fields__.keys())
+        header = _array_header(len(names))
+        # Each field is a (name, value) pair: the pair header and the name are packed once
+        prefixes = [(k, _array_header(2) + msgpack.packb(k, use_bin_type=True)) for k in names]
+        def encode_dataclass(encoder, obj):
+            buffer = encoder.buffer
+            buffer += header
+            for k, prefix in prefixes:
+                buffer += prefix
+                v = getattr(obj, k)
+                if type(v) in _PACKED_SCALARS:
+                    buffer += encoder.packb(v)
+                else:
+                    _encode(encoder, v)
+        return encode_dataclass
+    elif issubclass(objtype, Enum):
+        def encode_enum(encoder, obj):
+            encoder.buffer += encoder.packb(obj.name)
+        return encode_enum
+    elif objtype in (list, tuple):
+        def encode_list(encoder, obj):
+            encoder.buffer += _array_header(len(obj))
+            for v in obj:
+                _encode(encoder, v)
+        return encode_list
+    elif objtype is dict:
+        def encode_dict(encoder, obj):
+            encoder.buffer += _array_header(len(obj))
+            for k in sorted(obj.keys()):
+                encoder.buffer += b"\x92"
+                _encode(encoder, k)
+                _encode(encoder, obj[k])
+        return encode_dict
+    elif objtype is datetime.date:
+        def encode_date(encoder, obj):
+            encoder.buffer += encoder.packb(obj.isoformat())
+        return encode_date
+    elif objtype in (bytes, bytearray, memoryview):
+        return _encode_bin
+    else:
+        return _encode_packed
+
+
+class MsgpackEncoder():
+    """ Single pass deterministic encoder: writes the MsgpackSerialize format straight into a reusable buffer.
+        No intermediate struct tree is built. If fout (a binary file-like object) is given, the buffer is flushed
+        to it whenever it grows above flush_size, and large binaries are written to it without being buffered.
+    """
+    def __init__(self, fout=None, flush_size=64 * 1024):
+        self.buffer = bytearray()
+        self.packb = msgpack.Packer(use_bin_type=True).pack
+        self.fout = fout
+        self.flush_size = flush_size
+
+    def encode(self, obj):
+        _encode(self, obj)
+        if self.fout is not None:
+            self.flush()
+        return self
+
+    def write_bin(self, data):
+        if self.fout is not None and len(data) >= self.flush_size:
+            self.flush()
+            self.fout.write(data)
         else:
-            return obj
+            self.buffer += data
+            if self.fout is not None and len(self.buffer) >= self.flush_size:
+                self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.fout.write(self.buffer)
+            del self.buffer[:]
+
+    def getvalue(self):
+        return bytes(self.buffer)
+
+    def reset(self):
+        del self.buffer[:]
+
+
+# Lazy access to packed data: msgpack type byte => (header size, size of the length field, number of sub objects)
+def _scan_table():
+    table = {}
+    for b in range(0x00, 0x80):
+        table[b] = (1, 0, 0)
+    for b in range(0xe0, 0x100):
+        table[b] = (1, 0, 0)
+    for b in range(0x80, 0x90):
+        table[b] = (1, 0, 2 * (b & 0x0f))
+    for b in range(0x90, 0xa0):
+        table[b] = (1, 0, b & 0x0f)
+    for b in range(0xa0, 0xc0):
+        table[b] = (1 + (b & 0x1f), 0, 0)
+    table.update({0xc0: (1, 0, 0), 0xc2: (1, 0, 0), 0xc3: (1, 0, 0),
+                  0xca: (5, 0, 0), 0xcb: (9, 0, 0),
+                  0xcc: (2, 0, 0), 0xcd: (3, 0, 0), 0xce: (5, 0, 0), 0xcf: (9, 0, 0),
+                  0xd0: (2, 0, 0), 0xd1: (3, 0, 0), 0xd2: (5, 0, 0), 0xd3: (9, 0, 0),
+                  0xd4: (3, 0, 0), 0xd5: (4, 0, 0), 0xd6: (6, 0, 0), 0xd7: (10, 0, 0), 0xd8: (18, 0, 0)})
+    return table
+
+
+_SCAN_TABLE = _scan_table()
+# Variable size types: msgpack type byte => (size of the length field, is a container, items per entry)
+_SCAN_VARIABLE = {0xc4: (1, False, 0), 0xc5: (2, False, 0), 0xc6: (4, False, 0),
+                  0xd9: (1, False, 0), 0xda: (2, False, 0), 0xdb: (4, False, 0),
+                  0xc7: (1, False, 1), 0xc8: (2, False, 1), 0xc9: (4, False, 1),
+                  0xdc: (2, True, 1), 0xdd: (4, True, 1), 0xde: (2, True, 2), 0xdf: (4, True, 2)}
+
+
+def _type_byte(buf, pos):
+    if pos >= len(buf):
+        raise ValueError("Truncated msgpack data at %d" % pos)
+    return buf[pos]
+
+
+def _read_length(buf, pos, size):
+    if pos + size > len(buf):
+        raise ValueError("Truncated msgpack data at %d" % pos)
+    return int.from_bytes(buf[pos:pos + size], "big")
+
+
+def msgpack_skip(buf, pos):
+    """ Returns the position right after the msgpack object starting at pos (nothing is decoded)
+        ValueError if the data is not valid or truncated
+    """
+    remaining = 1
+    while remaining:
+        remaining -= 1
+        b = _type_byte(buf, pos)
+        fixed = _SCAN_TABLE.get(b)
+        if fixed is not None:
+            pos += fixed[0]
+            remaining += fixed[2]
+            continue
+        if b not in _SCAN_VARIABLE:
+            raise ValueError("Invalid msgpack type 0x%02x at %d" % (b, pos))
+        size, container, items = _SCAN_VARIABLE[b]
+        length = _read_length(buf, pos + 1, size)
+        if container:
+            pos += 1 + size
+            remaining += length * items
+        else:
+            # ext types carry one extra type byte
+            pos += 1 + size + items + length
+    if pos > len(buf):
+        raise ValueError("Truncated msgpack data")
+    return pos
+
+
+def msgpack_array_header(buf, pos):
+    """ Returns (number of items, position of the first item) for the array starting at pos """
+    b = _type_byte(buf, pos)
+    if 0x90 <= b <= 0x9f:
+        return b & 0x0f, pos + 1
+    elif b == 0xdc:
+        return _read_length(buf, pos + 1, 2), pos + 3
+    elif b == 0xdd:
+        return _read_length(buf, pos + 1, 4), pos + 5
+    raise ValueError("Expected a msgpack array at %d" % pos)
+
+
+def msgpack_dict_keys(buf, pos=0):
+    """ Decoded keys of the dict packed by MsgpackSerialize (array of (key, value) pairs) starting at pos,
+        the values are skipped
+    """
+    count, pos = msgpack_array_header(buf, pos)
+    keys = []
+    for _ in range(count):
+        _, start = msgpack_array_header(buf, pos)
+        end = msgpack_skip(buf, start)
+        keys.append(msgpack.unpackb(buf[start:end], raw=False))
+        pos = msgpack_skip(buf, end)
+    return keys
+
+
+def msgpack_bin(buf, pos):
+    """ Returns the payload of the binary starting at pos as a slice of buf (None for nil) """
+    b = _type_byte(buf, pos)
+    if b == 0xc0:
+        return None
+    if b not in (0xc4, 0xc5, 0xc6):
+        raise ValueError("Expected a msgpack binary at %d" % pos)
+    size = 1 << (b - 0xc4)
+    start = pos + 1 + size
+    end = start + _read_length(buf, pos + 1, size)
+    if end > len(buf):
+        raise ValueError("Truncated msgpack data at %d" % pos)
+    return buf[start:end]
+
+
+class MsgpackStructView():
+    """ Lazy view over a packed dataclass (an array of (name, value) pairs): values are located once,
+        then decoded on demand. buffer must support slicing without copy (a memoryview).
+    """
+    def __init__(self, buffer, pos=0):
+        self.buffer = buffer
+        self.spans = {}
+        count, pos = msgpack_array_header(buffer, pos)
+        for _ in range(count):
+            pair_size, pos = msgpack_array_header(buffer, pos)
+            if pair_size != 2:
+                raise ValueError("Expected a (name, value) pair at %d" % pos)
+            start = msgpack_skip(buffer, pos)
+            name = msgpack.unpackb(buffer[pos:start], raw=False)
+            pos = msgpack_skip(buffer, start)
+            self.spans[name] = (start, pos)
+        self.end = pos
+
+    def raw(self, name):
+        start, end = self.spans[name]
+        return self.buffer[start:end]
+
+    def decode(self, name, objtype):
+        return MsgpackSerialize.unpack(objtype, self.raw(name))
+
+    def binary(self, name):
+        return msgpack_bin(self.buffer, self.spans[name][0])
+
+
+class MsgpackSerialize():
+    """ Deterministric serialization to msgpack (sorts dictionnary and object fields)
+
+        The conversion plan (sorted field names, resolved field types) is compiled once per type and cached.
+    """
+
+    @staticmethod
+    def to_struct(obj):
+        return _to_struct(obj)
 
     @staticmethod
     def pack(obj):
-        res = MsgpackSerialize.to_struct(obj)
+        res = _to_struct(obj)
         result = msgpack.packb(res, use_bin_type=True)
         return result
-    
+
+    @staticmethod
+    def pack_stream(obj):
+        """ Same result as pack, without the intermediate struct tree (see MsgpackEncoder) """
+        # Large binaries go straight to the BytesIO, whose getvalue does not copy the result
+        fout = io.BytesIO()
+        MsgpackEncoder(fout).encode(obj)
+        return fout.getvalue()
+
+    @staticmethod
+    def dump(obj, fout):
+        """ Streams the packed form of obj into the binary file-like object fout """
+        MsgpackEncoder(fout).encode(obj)
+
     @staticmethod
     def from_struct(objtype, data):
         if data is None:
             return None
-        if hasattr(objtype, "from_struct"):
-            return objtype.from_struct(data)
-        elif hasattr(objtype, "__dataclass_fields__"):
-            initilizers = {}
-            for (k, value) in data: 
-                field = objtype.__dataclass_fields__[k]
-                #for k, field in objtype.__dataclass_fields__.items():
-                initilizers[k] = MsgpackSerialize.from_struct(field.type, value)
-            return objtype(**initilizers)
-        elif isinstance(objtype, type) and issubclass(objtype, Enum):
-            return objtype[data]
-        elif hasattr(objtype, "__origin__") and objtype.__origin__ in (list, tuple):
-            listype= objtype.__args__[0]
-            return [MsgpackSerialize.from_struct(listype, v) for v in data]
-        elif hasattr(objtype, "__origin__") and objtype.__origin__ is dict:
-            dict_src, dict_dest = objtype.__args__[0], objtype.__args__[1]
-            return dict((MsgpackSerialize.from_struct(dict_src, k), MsgpackSerialize.from_struct(dict_dest, v)) for k, v in data)
-        elif objtype is datetime.date:
-            return datetime.date.fromisoformat(data)
-        else:
-            return data
+        return _unpacker_for(objtype)(data)
+
+    @staticmethod
+    def unpacker(objtype):
+        """ The compiled struct => obj function of objtype (data must not be None) """
+        return _unpacker_for(objtype)
 
     @staticmethod
     def unpack(objtype, data):
@@ -1,3 +1,6 @@
+import dataclasses
+import mmap
+import threading
 
 
 def merge_dicts(*dicts):
@@ -12,3 +15,92 @@ def read_file_contents(filename):
     with open(filename, "rb") as fin:
         return fin.read()
     
+
+
+def _slots_getstate(self):
+    return tuple(getattr(self, field.name) for field in dataclasses.fields(self))
+
+
+def _slots_setstate(self, state):
+    # object.__setattr__: frozen dataclasses refuse setattr
+    for field, value in zip(dataclasses.fields(self), state):
+        object.__setattr__(self, field.name, value)
+
+
+def add_slots(cls):
+    """ Class decorator, above @dataclass: the same dataclass with __slots__ for its fields, its instances have no
+        __dict__. The bases must have __slots__ too (e.g. __slots__ = () in a base without fields).
+        Instances are pickled and copied with __getstate__/__setstate__, which also work when frozen.
+    """
+    names = tuple(field.name for field in dataclasses.fields(cls))
+    namespace = dict(cls.__dict__)
+    # The defaults are in the generated __init__, a class attribute would conflict with the slot
+    for name in names:
+        namespace.pop(name, None)
+    namespace.pop("__dict__", None)
+    namespace.pop("__weakref__", None)
+    namespace["__slots__"] = names
+    namespace["__qualname__"] = cls.__qualname__
+    namespace["__getstate__"] = _slots_getstate
+    namespace["__setstate__"] = _slots_setstate
+    return type(cls)(cls.__name__, cls.__bases__, namespace)
+
+
+class MappedFile():
+    """ Read only memory map of a file, as a memoryview: the content is not copied into Python bytes.
+        The memoryview (and any slice of it) must not be used after the with block.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = None
+        self.map = None
+        self.data = None
+
+    def __enter__(self):
+        self.file = open(self.filename, "rb")
+        if self.file.seek(0, 2) == 0:
+            # Empty files can not be mapped
+            self.data = memoryview(b"")
+        else:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.data = memoryview(self.map)
+        return self.data
+
+    def __exit__(self, *args):
+        self.data.release()
+        if self.map is not None:
+            self.map.close()
+        self.file.close()
+
+
+class HashingWriter():
+    """ Binary file-like object updating digest (a hash object) with what is written, before writing it to fout """
+    def __init__(self, fout, digest):
+        self.fout = fout
+        self.digest = digest
+
+    def write(self, data):
+        self.digest.update(data)
+        return self.fout.write(data)
+
+
+class LatencyStats():
+    """ Count, total and maximum duration of an operation (thread safe) """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        with self.lock:
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def __repr__(self):
+        return "LatencyStats(count=%d, mean=%.3fms, max=%.3fms)" % (self.count, self.mean * 1000, self.max * 1000)
@@ -0,0 +1,111 @@
+""" Verification of the enveloppes: messageHash (hash of the message as sent) and messageSig (PSS signature
+    of the sender over the packed Message, before encryption)
+"""
+from collections import OrderedDict
+import hashlib
+import threading
+import time
+from crypto import CacheStats
+from utils import LatencyStats
+
+
+class EnveloppeVerifier():
+    """ Checks MessageEnveloppe (or MessageEnveloppeView) hashes and signatures
+
+        public_keys: any object with get_pubkey_for_address (TelefericServer, keydirectory.KeyDirectory)
+        The signature results are cached by (messageHash, senderAddr), in a LRU cache of cache_size entries:
+        an enveloppe relayed to several parties is verified once. The messageHash is always recomputed, and a
+        cached result is only used for the same messageSig.
+        crypto_executor: optional cryptopool.CryptoExecutor, verify_many then checks the signatures on its processes.
+    """
+    def __init__(self, public_keys, cache_size=10000, crypto_executor=None):
+        self.public_keys = public_keys
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.cache_stats = CacheStats()
+        self.crypto_executor = crypto_executor
+        self.lock = threading.Lock()
+        self.latency = LatencyStats()
+
+    @staticmethod
+    def check_hash(enveloppe):
+        return hashlib.sha256(enveloppe.message).digest() == enveloppe.messageHash
+
+    def _cached(self, key, messageSig):
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is None or entry[0] != messageSig:
+                self.cache_stats.misses += 1
+                return None
+            self.cache_stats.hits += 1
+            self.cache.move_to_end(key)
+            return entry[1]
+
+    def _cache_put(self, key, messageSig, valid):
+        with self.lock:
+            self.cache[key] = (messageSig, valid)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def _prepare(self, enveloppe, plaintext, public_key):
+        """ Returns (result, None) when known without RSA, else (None, (cache key, public key, plaintext)) """
+        if not self.check_hash(enveloppe):
+            return False, None
+        key = (enveloppe.messageHash, enveloppe.senderAddr)
+        valid = self._cached(key, enveloppe.messageSig)
+        if valid is not None:
+            return valid, None
+        if plaintext is None:
+            if enveloppe.ACL:
+                raise ValueError("The decrypted message is needed to check the signature")
+            # Public message: it is not encrypted
+            plaintext = enveloppe.message
+        if public_key is None:
+            public_key = self.public_keys.get_pubkey_for_address(enveloppe.senderAddr)
+            if public_key is None:
+                # Not cached: the key can be registered later
+                return False, None
+        elif public_key.address() != enveloppe.senderAddr:
+            return False, None
+        return None, (key, public_key, plaintext)
+
+    def verify(self, enveloppe, plaintext=None, public_key=None):
+        """ plaintext: the decrypted message (MessageEnveloppe.decrypt_raw), not needed for public messages
+            public_key: key of the sender when it is not in public_keys yet (e.g. from a RegistrationRequest)
+        """
+        start = time.perf_counter()
+        valid, pending = self._prepare(enveloppe, plaintext, public_key)
+        if pending is not None:
+            key, public_key, plaintext = pending
+            valid = public_key.verify(plaintext, enveloppe.messageSig)
+            self._cache_put(key, enveloppe.messageSig, valid)
+        self.latency.record(time.perf_counter() - start)
+        return valid
+
+    def verify_many(self, items):
+        """ items: enveloppes, or (enveloppe, plaintext) tuples. Returns the list of results.
+            The latency of each enveloppe runs from its preparation until its result is known.
+        """
+        items = [item if type(item) is tuple else (item, None) for item in items]
+        results = []
+        pending = []
+        for index, (enveloppe, plaintext) in enumerate(items):
+            start = time.perf_counter()
+            valid, job = self._prepare(enveloppe, plaintext, None)
+            results.append(valid)
+            if job is None:
+                self.latency.record(time.perf_counter() - start)
+                continue
+            key, public_key, plaintext = job
+            if self.crypto_executor is not None:
+                check = self.crypto_executor.submit_verify(public_key, bytes(plaintext), enveloppe.messageSig)
+            else:
+                check = public_key.verify(plaintext, enveloppe.messageSig)
+            pending.append((index, start, key, enveloppe.messageSig, check))
+        for index, start, key, messageSig, check in pending:
+            valid = check if self.crypto_executor is None else check.result()
+            self._cache_put(key, messageSig, valid)
+            results[index] = valid
+            self.latency.record(time.perf_counter() - start)
+        return results
@@ -0,0 +1,68 @@
+""" Reference implementation of serialization.MsgpackSerialize, inspecting every object on every call (no cache).
+    The tests and bench_serialization.py check the compiled plans against it.
+"""
+import datetime
+from enum import Enum
+import msgpack
+
+
+class ReflectiveMsgpackSerialize():
+
+    @staticmethod
+    def to_struct(obj):
+        if hasattr(obj, "to_struct"):
+            result =  obj.to_struct()
+            return result
+        elif hasattr(obj, "__dataclass_fields__"):
+            result = []
+            for k in sorted(obj.__dataclass_fields__.keys()):
+                v = getattr(obj, k)
+                result.append((k, ReflectiveMsgpackSerialize.to_struct(v)))
+            return result
+        elif isinstance(obj, Enum):
+            return obj.name
+        elif type(obj) in (list, tuple):
+            return [ReflectiveMsgpackSerialize.to_struct(v) for v in obj]
+        elif type(obj) is dict:
+            keys = sorted(obj.keys())
+            return [(ReflectiveMsgpackSerialize.to_struct(k), ReflectiveMsgpackSerialize.to_struct(obj[k])) for k in keys]
+        elif type(obj) is datetime.date:
+            return obj.isoformat()
+        else:
+            return obj
+
+    @staticmethod
+    def pack(obj):
+        res = ReflectiveMsgpackSerialize.to_struct(obj)
+        result = msgpack.packb(res, use_bin_type=True)
+        return result
+
+    @staticmethod
+    def from_struct(objtype, data):
+        if data is None:
+            return None
+        if hasattr(objtype, "from_struct"):
+            return objtype.from_struct(data)
+        elif hasattr(objtype, "__dataclass_fields__"):
+            initilizers = {}
+            for (k, value) in data:
+                field = objtype.__dataclass_fields__[k]
+                initilizers[k] = ReflectiveMsgpackSerialize.from_struct(field.type, value)
+            return objtype(**initilizers)
+        elif isinstance(objtype, type) and issubclass(objtype, Enum):
+            return objtype[data]
+        elif hasattr(objtype, "__origin__") and objtype.__origin__ in (list, tuple):
+            listype= objtype.__args__[0]
+            return [ReflectiveMsgpackSerialize.from_struct(listype, v) for v in data]
+        elif hasattr(objtype, "__origin__") and objtype.__origin__ is dict:
+            dict_src, dict_dest = objtype.__args__[0], objtype.__args__[1]
+            return dict((ReflectiveMsgpackSerialize.from_struct(dict_src, k), ReflectiveMsgpackSerialize.from_struct(dict_dest, v)) for k, v in data)
+        elif objtype is datetime.date:
+            return datetime.date.fromisoformat(data)
+        else:
+            return data
+
+    @staticmethod
+    def unpack(objtype, data):
+        struct = msgpack.unpackb(data, raw=False)
+        return ReflectiveMsgpackSerialize.from_struct(objtype, struct)
@@ -0,0 +1,105 @@
+""" These tests require the same dependencies as test_serializations.py
+"""
+import datetime
+import os
+import unittest
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from main import AttestationEngine, TelefericClient, TelefericServer
+from attestation import AttestationRule, RuleIndex, DEFAULT_RULES, MESSAGE_ANALYSIS, RESEARCH_ANALYSIS
+from model import Assertion, Attachement, MessageAnalysis, ResearchAnalysis
+from crypto import AESKey
+from blobstore import BlobStore
+from serialization import MsgpackSerialize
+from test_teleferic import TelefericServerTestCase
+
+
+ADDRESS = {"Name": "John", "Surname": "Doe", "AddressLine1": "167 Custom Road", "AddressLine2": "",
+           "PostalCode": "456", "City": "Luxembourg", "Country": "Luxembourg", "Email": "anymail@gmail.com",
+           "PhoneNumber": "+35278745544"}
+
+
+class RuleIndexTests(unittest.TestCase):
+
+    def test_Match_AllRequiredFields(self):
+        index = RuleIndex(DEFAULT_RULES)
+        self.assertEqual(index.match(["IdentityDocument"]), [DEFAULT_RULES[0]])
+        self.assertEqual(index.match(list(ADDRESS) + ["IdentityDocument"]), list(DEFAULT_RULES))
+        self.assertEqual(index.match(list(ADDRESS)[1:]), [])
+        self.assertEqual(index.match(["TermsAndConditions"]), [])
+
+    def test_Match_RulesOrder(self):
+        always = AttestationRule(frozenset(), (("Always", MESSAGE_ANALYSIS),))
+        pair = AttestationRule(frozenset(["A", "B"]), (("Pair", RESEARCH_ANALYSIS),))
+        single = AttestationRule(frozenset(["B"]), (("Single", RESEARCH_ANALYSIS),))
+        index = RuleIndex([single, always, pair])
+        self.assertEqual(index.match(["B", "A", "B"]), [single, always, pair])
+        self.assertEqual(index.match([]), [always])
+
+
+class AttestationTestCase(TelefericServerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.engine = AttestationEngine()
+        self.server = TelefericServer({self.customer_key.address(): self.customer_key.public_key(),
+                                       self.engine.address: self.engine.key.public_key()})
+        self.client = TelefericClient(self.server)
+
+    def make_assertion(self, documents, key=None):
+        key = key or AESKey.generate()
+        attachements = [Attachement.make(key, MsgpackSerialize.pack(document), []) for document in documents]
+        assertion = Assertion(self.customer_key.address(), datetime.date(2020, 1, 1), datetime.date(2020, 1, 1),
+                              key.key, {})
+        return self.client.make_enveloppe(self.customer_key, 0, [(self.engine.address, 0)], assertion, attachements, [])
+
+    def entries(self, attestation):
+        return [(entry.attestType, type(entry.detail)) for entry in attestation.attestations]
+
+
+class AttestationEngineTests(AttestationTestCase):
+
+    def test_GetAttestation_EntriesInAttachementOrder(self):
+        enveloppe = self.make_assertion([ADDRESS, {"IdentityDocument": b"\x89PNG" * 100},
+                                         {"TermsAndConditions": True}])
+        attestation = self.engine.get_attestation(enveloppe)
+        self.assertEqual(attestation.subject, self.customer_key.address())
+        self.assertEqual(self.entries(attestation),
+                         [("AddressValidity", ResearchAnalysis), ("KnownCustomer", ResearchAnalysis),
+                          ("ResidenceClassifier", MessageAnalysis), ("MRZ", MessageAnalysis),
+                          ("Fraud", ResearchAnalysis), ("PEP", ResearchAnalysis), ("Sanction", ResearchAnalysis),
+                          ("SanctionCountry", ResearchAnalysis), ("CountryRisk", ResearchAnalysis),
+                          ("BlackList", ResearchAnalysis)])
+
+    def test_Executor_SameAttestations(self):
+        documents = [[ADDRESS], [{"IdentityDocument": b"passport"}, ADDRESS], [{"TermsAndConditions": True}], []]
+        envelopes = [self.make_assertion(d) for d in documents]
+        expected = [self.engine.get_attestation(e) for e in envelopes]
+        with ThreadPoolExecutor(4) as executor:
+            engine = AttestationEngine(executor=executor)
+            self.assertEqual([engine.get_attestation(e) for e in envelopes], expected)
+            self.assertEqual(engine.process_batch(envelopes), expected)
+        self.assertEqual(self.engine.process_batch(envelopes), expected)
+
+    def test_GetAttestation_ResolvesReferences(self):
+        blob_store = BlobStore(os.path.join(self.tempdir.name, "blobs"))
+        key = AESKey.generate()
+        attachement = Attachement.make(key, MsgpackSerialize.pack({"IdentityDocument": b"passport"}), [])
+        reference = blob_store.put_attachement(attachement)
+        assertion = Assertion(self.customer_key.address(), datetime.date(2020, 1, 1), datetime.date(2020, 1, 1),
+                              key.key, {})
+        enveloppe = self.client.make_enveloppe(self.customer_key, 0, [(self.engine.address, 0)], assertion,
+                                               [reference], [])
+        attestation = self.engine.get_attestation(enveloppe, blob_store)
+        self.assertEqual(len(attestation.attestations), 7)
+        with self.assertRaisesRegex(ValueError, "blob store"):
+            self.engine.get_attestation(enveloppe)
+        blob_store.close()
+
+    def test_Executor_ProcessPool_Rejected(self):
+        with ProcessPoolExecutor(1) as executor:
+            with self.assertRaises(TypeError):
+                AttestationEngine(executor=executor)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+""" These tests require the same dependencies as test_serializations.py
+"""
+import os
+import tempfile
+import unittest
+from blobstore import BlobStore
+from crypto import AESKey
+from model import Attachement
+
+
+class BlobStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.directory = os.path.join(self.tempdir.name, "blobs")
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_PutAttachement_Deduplicated_Resolved(self):
+        store = BlobStore(self.directory)
+        key = AESKey.generate()
+        attachement = Attachement.make(key, b"document" * 1000, [b"\x01" * 32])
+        reference = store.put_attachement(attachement)
+        self.assertTrue(reference.is_reference)
+        self.assertEqual(reference.containerHash, attachement.containerHash)
+        self.assertEqual(store.put_attachement(attachement), reference)
+        self.assertEqual(len(store), 1)
+        self.assertEqual(store.find(attachement.objectHash), [attachement.containerHash])
+        self.assertEqual(store.resolve(reference), attachement)
+        store.close()
+        store = BlobStore(self.directory)
+        self.assertEqual(store.resolve(reference).decrypt(key), b"document" * 1000)
+        store.close()
+
+    def test_Evict_LeastRecentlyUsedUnreferenced(self):
+        store = BlobStore(self.directory, max_size=250)
+        first = store.put(b"\x01" * 100)
+        self.assertTrue(store.acquire(first))
+        second = store.put(b"\x02" * 100)
+        third = store.put(b"\x03" * 100)
+        # first is the least recently used, but it is referenced
+        self.assertIn(first, store)
+        self.assertNotIn(second, store)
+        self.assertIn(third, store)
+        self.assertEqual(store.total_size(), 200)
+        store.release(first)
+        store.get(third)
+        store.put(b"\x04" * 100)
+        self.assertNotIn(first, store)
+        self.assertIsNone(store.get(first))
+        self.assertIn(third, store)
+        with self.assertRaises(KeyError):
+            store.resolve(Attachement(first, None, None, None, []))
+        store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+""" These tests require the same dependencies as test_serializations.py
+"""
+import io
+import os
+import unittest
+from crypto import RSAKey, AESKey
+import cryptopool
+from cryptopool import CryptoExecutor, KeyHandle, KeyNotLoaded
+
+
+class RSAKeyCacheTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.key = RSAKey.import_key(RSAKey.generate(1024).export())
+
+    def test_Address_ComputedOnce_SharedWithPublicKey(self):
+        key = RSAKey.import_key(self.key.export())
+        misses = RSAKey.cache_stats.misses
+        address = key.address()
+        self.assertEqual(RSAKey.cache_stats.misses - misses, 2) # DER + Address
+        hits = RSAKey.cache_stats.hits
+        self.assertEqual(key.address(), address)
+        self.assertEqual(key.public_key().address(), address)
+        self.assertEqual(RSAKey.cache_stats.misses - misses, 3) # + public_key
+        self.assertEqual(RSAKey.cache_stats.hits - hits, 2)
+        # Same as a freshly imported public key
+        self.assertEqual(RSAKey.import_public_key_hex(key.public_key_hex()).address(), address)
+
+    def test_ImportPublicKeyHex_Repeated_HitsCache(self):
+        data = self.key.public_key_hex()
+        first = RSAKey.import_public_key_hex(data)
+        hits = RSAKey.import_cache_info().hits
+        self.assertIs(RSAKey.import_public_key_hex(data), first)
+        self.assertEqual(RSAKey.import_cache_info().hits - hits, 1)
+        self.assertTrue(first.is_public)
+        self.assertEqual(first.public_key_hex(), data)
+
+    def test_Contexts_Reused(self):
+        key = RSAKey.import_key(self.key.export())
+        public_key = key.public_key()
+        self.assertIs(key.cipher(), key.cipher())
+        self.assertIs(key.signer(), key.signer())
+        self.assertIs(public_key.verifier(), public_key.verifier())
+        for _ in range(2):
+            self.assertEqual(key.decrypt(public_key.encrypt(b"\x01" * 32)), b"\x01" * 32)
+            signature = key.sign(b"message")
+            self.assertTrue(public_key.verify(b"message", signature))
+            self.assertFalse(public_key.verify(b"other", signature))
+
+
+class AESKeyStreamTests(unittest.TestCase):
+
+    def setUp(self):
+        self.key = AESKey.generate()
+
+    def encrypt(self, data, chunk_size=16):
+        encrypted = io.BytesIO()
+        self.assertEqual(self.key.encrypt_stream(io.BytesIO(data), encrypted, chunk_size), len(data))
+        return encrypted.getvalue()
+
+    def decrypt(self, encrypted):
+        decrypted = io.BytesIO()
+        self.key.decrypt_stream(io.BytesIO(encrypted), decrypted)
+        return decrypted.getvalue()
+
+    def test_Stream_EncryptDecrypt_RoundTrip(self):
+        for size in (0, 1, 16, 17, 100, 1000):
+            data = os.urandom(size)
+            encrypted = self.encrypt(data)
+            self.assertEqual(len(encrypted), 16 + size + 16 * ((size + 15) // 16) + 32)
+            self.assertEqual(self.decrypt(encrypted), data)
+
+    def test_Stream_DecryptChunk_RandomAccess(self):
+        data = os.urandom(100)
+        encrypted = io.BytesIO(self.encrypt(data))
+        self.assertEqual(self.key.decrypt_chunk(encrypted, 0), data[:16])
+        self.assertEqual(self.key.decrypt_chunk(encrypted, 3), data[48:64])
+        self.assertEqual(self.key.decrypt_chunk(encrypted, 6), data[96:])
+        with self.assertRaises(IndexError):
+            self.key.decrypt_chunk(encrypted, 7)
+
+    def test_Stream_Tampered_Raises(self):
+        encrypted = self.encrypt(os.urandom(100))
+        record = 16 + 16
+        swapped = encrypted[:16] + encrypted[16 + record:16 + 2 * record] + encrypted[16:16 + record] + encrypted[16 + 2 * record:]
+        truncated = encrypted[:16 + record] + encrypted[-32:]
+        flipped = encrypted[:20] + bytes([encrypted[20] ^ 1]) + encrypted[21:]
+        for tampered in (swapped, truncated, flipped, encrypted[:-1]):
+            with self.assertRaises(ValueError):
+                self.decrypt(tampered)
+        with self.assertRaises(ValueError):
+            AESKey.generate().decrypt_stream(io.BytesIO(encrypted), io.BytesIO())
+
+    def test_EncryptWriter_SameAsEncrypt(self):
+        data = os.urandom(3000)
+        nonce = os.urandom(16)
+        writer = self.key.encrypt_writer(randbytes=lambda size: nonce)
+        writer.write(data[:5])
+        writer.write(memoryview(data)[5:])
+        encrypted = writer.getvalue()
+        self.assertEqual(encrypted, self.key.encrypt(data, randbytes=lambda size: nonce))
+        self.assertEqual(self.key.decrypt(encrypted), data)
+
+
+class CryptoExecutorTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.keys = [RSAKey.generate(1024) for _ in range(4)]
+
+    def test_WorkerKey_Reference_LoadedOnce(self):
+        handle = KeyHandle.of(self.keys[0].public_key())
+        cryptopool._worker_keys.pop(handle.key_id, None)
+        with self.assertRaises(KeyNotLoaded):
+            cryptopool._worker_key(handle.reference())
+        key = cryptopool._worker_key(handle)
+        self.assertIs(cryptopool._worker_key(handle.reference()), key)
+        cryptopool._worker_keys.pop(handle.key_id)
+
+    def test_Handles_ByKeyId_Bounded(self):
+        with CryptoExecutor(2, cache_size=2) as executor:
+            for _ in range(3):
+                for key in self.keys:
+                    # A new instance of the same public key, as a key directory would return after a cache miss
+                    public_key = RSAKey(key.public_key().key, True)
+                    signature = executor.sign(key, b"message")
+                    self.assertTrue(executor.submit_verify(public_key, b"message", signature).result())
+                    self.assertEqual(key.decrypt(executor.encrypt(public_key, b"\x01" * 32)), b"\x01" * 32)
+                    wrapped = executor.submit_encrypt_many([key.public_key(), public_key], b"\x02" * 32).result()
+                    self.assertEqual([key.decrypt(data) for data in wrapped], [b"\x02" * 32] * 2)
+                    self.assertLessEqual(len(executor.handles), 2)
+            # Sent once with the key material, then by reference
+            executor.sign(self.keys[0], b"message")
+            handle, sent = executor.handle(self.keys[0])
+            self.assertTrue(sent)
+            self.assertEqual(handle.key_id, KeyHandle.key_id_of(self.keys[0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
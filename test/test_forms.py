@@ -0,0 +1,157 @@
+""" These tests require the same dependencies as test_serializations.py
+"""
+from concurrent.futures import ThreadPoolExecutor
+import random
+import unittest
+from Crypto.Hash import HMAC, SHA256
+import datetime
+import xml.dom.minidom
+from xml.etree.ElementTree import tostring
+from forms import StandardFields, StandardRegistry, StandardFieldRegistry, StandardField, FileField, StringField, EnumField, IntegerField, BooleanField, XForm,\
+    ValidationError, get_metadata_dict, get_metadata_batch
+from main import SaltStorage
+from model import Assertion
+
+
+def reference_metadata_dict(data, salt_storage):
+    """ get_metadata_dict as it was first written """
+    results = {}
+    metahashes = []
+    stdfields_by_name = {field.field.name: field for field in StandardFields}
+    for name, value in data.items():
+        if name in stdfields_by_name and type(stdfields_by_name[name].field) is not FileField:
+            if stdfields_by_name[name].salted:
+                salt = salt_storage.getMetadataSalt(value)
+            else:
+                salt = ""
+            results[name] = Assertion.Metadata(salt, value)
+            h = HMAC.new(salt, digestmod=SHA256)
+            h.update(value.encode())
+            metahashes.append(h.digest())
+    return (results, metahashes)
+
+
+def make_forms(count):
+    cities = ["Luxembourg", "Paris", "Berlin"]
+    return [{"Name": "Name%d" % (i % 7),
+             "City": cities[i % 3],
+             "IdentityDocument": b"\x01" * 10,
+             "NonStandard": "x",
+             "Email": "user%d@example.com" % i} for i in range(count)]
+
+
+class MetadataBatchTests(unittest.TestCase):
+
+    def check_batch(self, executor):
+        forms = make_forms(50)
+        salt_storage = SaltStorage()
+        random.seed(1)
+        expected = [reference_metadata_dict(data, salt_storage) for data in forms]
+        random.seed(1)
+        batch = get_metadata_batch(forms, SaltStorage(), executor, chunk_size=16)
+        self.assertEqual(len(batch), len(forms))
+        self.assertEqual([batch.per_form(i) for i in range(len(forms))], expected)
+        self.assertEqual(batch.metadata["City"][4], expected[4][0]["City"])
+        self.assertNotIn("IdentityDocument", batch.metadata)
+
+    def test_MetadataBatch_SameAsPerForm(self):
+        self.check_batch(None)
+
+    def test_MetadataBatch_ThreadPool_SameAsPerForm(self):
+        with ThreadPoolExecutor(4) as executor:
+            self.check_batch(executor)
+
+    def test_MetadataDict_SameAsReference(self):
+        data = make_forms(1)[0]
+        random.seed(2)
+        expected = reference_metadata_dict(data, SaltStorage())
+        random.seed(2)
+        self.assertEqual(get_metadata_dict(data, SaltStorage()), expected)
+
+
+class XFormValidationTests(unittest.TestCase):
+
+    def setUp(self):
+        self.form = XForm(["Name", "DateOfBirth", "NonStandard", StringField("Code", min_length=2, max_length=4),
+                           EnumField("Gender", allowed_values=("M", "F")), IntegerField("Age", min=0, max=150)])
+        self.values = {"Name": "John", "DateOfBirth": datetime.date(2000, 1, 1), "NonStandard": 1,
+                       "Code": "abc", "Gender": "M", "Age": 20}
+
+    def test_Fields_StandardNamesResolved(self):
+        self.assertEqual([type(f).__name__ for f in self.form.fields],
+                         ["StringField", "DateField", "Field", "StringField", "EnumField", "IntegerField"])
+
+    def test_Validate_ValidValues_Returned(self):
+        self.assertEqual(self.form.validate(self.values), self.values)
+        self.assertIs(self.form.validator(), self.form.validator())
+
+    def test_Validate_InvalidValues_Raise(self):
+        for name, value in (("Name", 1), ("DateOfBirth", "2000"), ("Code", "a"), ("Code", "abcde"),
+                            ("Gender", "X"), ("Age", -1), ("Age", 151), ("Age", "20")):
+            with self.assertRaises(ValidationError):
+                self.form.validate(dict(self.values, **{name: value}))
+        with self.assertRaisesRegex(Exception, "Invalid fields"):
+            self.form.validate(dict(self.values, Other=1))
+        values = dict(self.values)
+        del values["Age"]
+        with self.assertRaisesRegex(Exception, "Missing fields"):
+            self.form.validate(values)
+
+    def test_ValidateMany_ReportsErrorsPerRow(self):
+        rows = [self.values, dict(self.values, Age=-1), {"Name": "John"}, dict(self.values, Gender="F")]
+        results, errors = self.form.validate_many(rows)
+        self.assertEqual(results, [self.values, None, None, rows[3]])
+        self.assertEqual(sorted(errors), [1, 2])
+        self.assertIsInstance(errors[1], ValidationError)
+
+
+class XFormRenderingTests(unittest.TestCase):
+
+    def setUp(self):
+        self.form = XForm(["Name", "DateOfBirth", "IdentityDocument", "NonStandard",
+                           StringField("Code", "Code <a> & b\nline", max_length=4),
+                           EnumField("Gender", allowed_values=["M", "F", "<\"U\">"]), IntegerField("Age", min=0, max=150),
+                           BooleanField("TermsAndConditions", "I accept")])
+
+    def test_ToXform_SameAsElementTreeAndMinidom(self):
+        compact = tostring(self.form.to_element()).decode()
+        self.assertEqual(self.form.to_xform(pretty=False), compact)
+        self.assertEqual(self.form.to_xform(), xml.dom.minidom.parseString(compact).toprettyxml())
+
+    def test_ToXform_CachedByFingerprint(self):
+        other = XForm(list(self.form.fields_init))
+        self.assertEqual(other.fingerprint(), self.form.fingerprint())
+        self.assertIs(other.to_xform(), self.form.to_xform())
+        self.assertNotEqual(XForm(["Name"]).fingerprint(), self.form.fingerprint())
+
+
+class StandardFieldRegistryTests(unittest.TestCase):
+
+    def test_Registry_IndexesStandardFields(self):
+        self.assertEqual(len(StandardRegistry), len(StandardFields))
+        for standard_field in StandardFields:
+            name = standard_field.field.name
+            self.assertIs(StandardRegistry[name], standard_field)
+            self.assertIs(StandardRegistry.get_field(name), standard_field.field)
+            self.assertEqual(StandardRegistry.is_salted(name), standard_field.salted)
+            self.assertEqual(StandardRegistry.is_file(name), type(standard_field.field) is FileField)
+        self.assertIsNone(StandardRegistry.get("NonStandard"))
+        self.assertEqual(StandardRegistry.files, {"IdentityDocument"})
+        self.assertEqual(StandardRegistry.unsalted, {"IdentityDocument"})
+        self.assertEqual(set(StandardRegistry.metadata_fields), StandardRegistry.non_files)
+
+    def test_Registry_Immutable(self):
+        with self.assertRaises(AttributeError):
+            StandardRegistry.version = "0"
+        with self.assertRaises(TypeError):
+            StandardRegistry.by_name["Name"] = None
+
+    def test_Registry_VersionDependsOnDefinitions(self):
+        same = StandardFieldRegistry(list(StandardFields))
+        self.assertTrue(StandardRegistry.same_version(same.version))
+        other = StandardFieldRegistry(StandardFields | {StandardField(StringField("Other"))})
+        self.assertFalse(StandardRegistry.same_version(other.version))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+""" These tests require the same dependencies as test_serializations.py
+"""
+import os
+import tempfile
+import unittest
+from crypto import RSAKey
+from keydirectory import MemoryKeyDirectory, SqliteKeyDirectory
+
+
+class KeyDirectoryTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.keys = [RSAKey.generate(1024).public_key() for _ in range(3)]
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tempdir.name, "keys.db")
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_MemoryKeyDirectory_BulkImport_Lookup(self):
+        directory = MemoryKeyDirectory()
+        directory.bulk_import({key.address(): key for key in self.keys[:2]})
+        self.assertIs(directory.get_pubkey_for_address(self.keys[0].address()), self.keys[0])
+        self.assertIsNone(directory.get_pubkey_for_address(self.keys[2].address()))
+        self.assertEqual(len(directory), 2)
+
+    def test_SqliteKeyDirectory_Reopen_KeysArePersisted(self):
+        directory = SqliteKeyDirectory(self.filename)
+        directory.bulk_import({key.address(): key for key in self.keys[:2]})
+        directory.add(self.keys[2].address(), self.keys[2])
+        directory.close()
+        directory = SqliteKeyDirectory(self.filename)
+        self.assertEqual(len(directory), 3)
+        for key in self.keys:
+            self.assertEqual(directory.get_pubkey_for_address(key.address()).public_key_hex(), key.public_key_hex())
+        directory.close()
+
+    def test_SqliteKeyDirectory_CacheFull_EvictsLeastRecentlyUsed(self):
+        directory = SqliteKeyDirectory(self.filename, cache_size=2)
+        for key in self.keys:
+            directory.add(key.address(), key)
+        self.assertEqual(list(directory.cache.keys()), [key.address() for key in self.keys[1:]])
+        misses = directory.cache_stats.misses
+        self.assertIsNotNone(directory.get_pubkey_for_address(self.keys[0].address()))
+        self.assertEqual(directory.cache_stats.misses - misses, 1)
+        self.assertNotIn(self.keys[1].address(), directory.cache)
+        directory.close()
+
+    def test_SqliteKeyDirectory_BulkImport_ReplacesCachedKey(self):
+        directory = SqliteKeyDirectory(self.filename)
+        address = self.keys[0].address()
+        directory.add(address, self.keys[0])
+        self.assertIs(directory.get_pubkey_for_address(address), self.keys[0])
+        directory.bulk_import({address: self.keys[1]})
+        self.assertIs(directory.get_pubkey_for_address(address), self.keys[1])
+        directory.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+""" These tests require the same dependencies as test_serializations.py
+"""
+import unittest
+from main import EnveloppeContext, TelefericClient
+from keywrap import KeyWrapScheme, RSAOAEPKeyWrap, BatchedKeyWrap
+from crypto import RSAKey, AESKey
+from cryptopool import CryptoExecutor
+from test_teleferic import PublicKeyServer, registration_request
+
+
+class CountingKey():
+    """ Public key counting the OAEP ciphers created """
+    def __init__(self, key):
+        self.key = key
+        self.ciphers = 0
+
+    def cipher(self):
+        self.ciphers += 1
+        return self.key.cipher()
+
+
+class KeyWrapTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.keys = [RSAKey.generate(1024) for _ in range(5)]
+        cls.recipients = [(key.address(), key.public_key()) for key in cls.keys]
+
+    def check_ACL(self, ACL, aeskey):
+        ACL = KeyWrapScheme.resolve(ACL)
+        self.assertEqual(set(ACL), set(key.address() for key in self.keys))
+        for key in self.keys:
+            self.assertEqual(key.decrypt(ACL[key.address()]), aeskey)
+
+    def test_Schemes_WrapForEachRecipient(self):
+        aeskey = AESKey.generate().key
+        self.check_ACL(RSAOAEPKeyWrap().wrap(aeskey, self.recipients, EnveloppeContext()), aeskey)
+        self.check_ACL(BatchedKeyWrap().wrap(aeskey, self.recipients, EnveloppeContext()), aeskey)
+        with CryptoExecutor(2) as executor:
+            scheme = BatchedKeyWrap(executor, chunksize=2)
+            self.check_ACL(scheme.wrap(aeskey, self.recipients, EnveloppeContext()), aeskey)
+
+    def test_Batched_DuplicateRecipientWrappedOnce(self):
+        aeskey = AESKey.generate().key
+        counting = CountingKey(self.keys[0].public_key())
+        address = self.keys[0].address()
+        context = EnveloppeContext()
+        ACL = BatchedKeyWrap().wrap(aeskey, [(address, counting), (address, counting)], context)
+        self.assertEqual(list(ACL), [address])
+        self.assertEqual(counting.ciphers, 1)
+        self.assertEqual(self.keys[0].decrypt(ACL[address]), aeskey)
+
+    def test_Client_KeyWrapScheme(self):
+        server = PublicKeyServer(self.keys)
+        sender_key = RSAKey.generate(1024)
+        destinations = [(key.address(), 0) for key in self.keys]
+        for key_wrap in (RSAOAEPKeyWrap(), BatchedKeyWrap()):
+            client = TelefericClient(server, key_wrap=key_wrap)
+            enveloppe = client.make_enveloppe(sender_key, 0, destinations, registration_request(0))
+            self.assertEqual(set(enveloppe.ACL), set(addr for addr, _ in destinations))
+            for key in self.keys:
+                self.assertEqual(enveloppe.decrypt(key.address(), key).body, registration_request(0))
+
+
+if __name__ == '__main__':
+    unittest.main()
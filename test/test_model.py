@@ -0,0 +1,177 @@
+""" These tests require the same dependencies as test_serializations.py
+"""
+import copy
+import dataclasses
+import datetime
+import hashlib
+import io
+import os
+import pickle
+import tempfile
+import unittest
+from model import Address, Message, MessageEnveloppe, MessageEnveloppeView, Attachement,\
+    RegistrationRequest, BodyType, Assertion, Attestation, Invitation, MessageAnalysis, ResearchAnalysis,\
+    GetBodyType, GetBodyClass, UnregisteredBodyType, register_body
+from crypto import RSAKey, AESKey
+from serialization import MsgpackSerialize
+from utils import MappedFile
+
+
+class MessageEnveloppeViewTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.key = RSAKey.generate(1024)
+        cls.address = cls.key.address()
+
+    def make_enveloppe(self):
+        message = Message(1, 2, b"\x01" * 40, BodyType.RegistrationRequest,
+                          RegistrationRequest(b"\x02" * 32, b"\x03" * 128, "AccountLevel1", "30819f30", "nickname1"))
+        aeskey = AESKey.generate()
+        return MessageEnveloppe(messageHash=b"\x04" * 32,
+                                dossierHash=b"\x05" * 32,
+                                senderAddr=self.address,
+                                messageSig=b"\x06" * 128,
+                                message=aeskey.encrypt(MsgpackSerialize.pack(message)),
+                                ACL={self.address: self.key.public_key().encrypt(aeskey.key)},
+                                attachements=[Attachement(b"\x07" * 32, None, b"\x08" * 300, None, [b"\x09" * 32]),
+                                              Attachement(None, None, b"\x0a" * 70000, b"\x0b" * 32, [])]), message
+
+    def test_View_HeaderFields_MatchEnveloppe(self):
+        enveloppe, _ = self.make_enveloppe()
+        view = MessageEnveloppeView(MsgpackSerialize.pack(enveloppe))
+        self.assertEqual(view.messageHash, enveloppe.messageHash)
+        self.assertEqual(view.dossierHash, enveloppe.dossierHash)
+        self.assertEqual(view.senderAddr, enveloppe.senderAddr)
+        self.assertEqual(view.messageSig, enveloppe.messageSig)
+        self.assertEqual(view.ACL, enveloppe.ACL)
+        self.assertIsNone(view.replacesMsgHash)
+        self.assertEqual(view.unpack(), enveloppe)
+
+    def test_View_Binaries_AreSlicesOfThePackedBuffer(self):
+        enveloppe, message = self.make_enveloppe()
+        packed = MsgpackSerialize.pack(enveloppe)
+        view = MessageEnveloppeView(packed)
+        self.assertIsInstance(view.message, memoryview)
+        self.assertIs(view.message.obj, packed)
+        self.assertEqual(view.message, enveloppe.message)
+        self.assertEqual(len(view.attachements), 2)
+        for attachement_view, attachement in zip(view.attachements, enveloppe.attachements):
+            self.assertIs(attachement_view.objectContainer.obj, packed)
+            self.assertEqual(attachement_view.objectContainer, attachement.objectContainer)
+            self.assertEqual(attachement_view.containerHash, attachement.containerHash)
+            self.assertEqual(attachement_view.objectHash, attachement.objectHash)
+            self.assertEqual(attachement_view.Metahashes, attachement.Metahashes)
+        self.assertEqual(view.decrypt(self.address, self.key), message)
+
+
+class AttachementTests(unittest.TestCase):
+
+    def test_MakePacked_FromMappedFile_SameContainerAsMake(self):
+        key = AESKey.generate()
+        content = os.urandom(200000)
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "document.bin")
+            with open(filename, "wb") as fout:
+                fout.write(content)
+            with MappedFile(filename) as data:
+                attachement = Attachement.make_packed(key, {"IdentityDocument": data, "Name": "John"}, [b"\x01" * 32])
+        decrypted = key.decrypt(attachement.objectContainer)
+        self.assertEqual(decrypted, MsgpackSerialize.pack({"IdentityDocument": content, "Name": "John"}))
+        self.assertEqual(attachement.Metahashes, [b"\x01" * 32])
+
+    def test_Make_HashesAndSignature(self):
+        key = AESKey.generate()
+        sign_key = RSAKey.generate(1024)
+        data = os.urandom(5000)
+        attachement = Attachement.make(key, data, [], sign_key)
+        self.assertEqual(attachement.objectHash, hashlib.sha256(data).digest())
+        self.assertEqual(attachement.containerHash, hashlib.sha256(attachement.objectContainer).digest())
+        self.assertTrue(sign_key.public_key().verify(attachement.objectContainer, attachement.containerSig))
+        self.assertTrue(attachement.verify_container(sign_key.public_key()))
+        self.assertEqual(attachement.decrypt(key), data)
+        streamed = Attachement.make_from_stream(key, io.BytesIO(data), [], chunk_size=1000)
+        self.assertEqual(streamed.objectHash, attachement.objectHash)
+        self.assertIsNone(streamed.containerSig)
+        self.assertEqual(streamed.decrypt(key), data)
+
+    def test_Make_TamperedContainer_Detected(self):
+        key = AESKey.generate()
+        sign_key = RSAKey.generate(1024)
+        attachement = Attachement.make(key, b"document", [], sign_key)
+        tampered = Attachement(attachement.containerHash, attachement.containerSig,
+                               attachement.objectContainer[:-1] + b"\x00", attachement.objectHash, [])
+        self.assertFalse(tampered.verify_container())
+        forged = Attachement.make(key, b"document", [], RSAKey.generate(1024))
+        self.assertTrue(forged.verify_container())
+        self.assertFalse(forged.verify_container(sign_key.public_key()))
+
+
+class BodyTypeRegistryTests(unittest.TestCase):
+
+    def test_Registry_BothDirections(self):
+        for bodyType in BodyType:
+            try:
+                bodyClass = GetBodyClass(bodyType)
+            except UnregisteredBodyType:
+                continue
+            self.assertEqual(GetBodyType(bodyClass.__new__(bodyClass)), bodyType)
+        self.assertIs(GetBodyClass(BodyType.Attestation), Attestation)
+
+    def test_Registry_Unregistered(self):
+        with self.assertRaises(UnregisteredBodyType):
+            GetBodyClass(BodyType.Checkpoint)
+        # Subclasses are not registered with their base class
+        with self.assertRaises(KeyError):
+            GetBodyType(Invitation("node", None, None, b"", 1, b"", b"", b""))
+        packed = MsgpackSerialize.pack(Message(1, 2, b"\x01" * 40, BodyType.Checkpoint, None))
+        with self.assertRaises(UnregisteredBodyType):
+            MsgpackSerialize.unpack(Message, packed)
+        with self.assertRaises(ValueError):
+            register_body(BodyType.Attestation)(Invitation)
+
+    def test_Message_AttestationRoundTrip(self):
+        attestation = Attestation(Address("2nPfgysH5URwM6mcknqwNEgbCi9C36oQsdZ"),
+                                  [Attestation.AttestationEntry("MRZ", MessageAnalysis(None, None, None, None, None, True)),
+                                   Attestation.AttestationEntry("PEP", ResearchAnalysis(None, None, None, [])),
+                                   Attestation.AttestationEntry("Other", None)])
+        message = Message(1, 2, b"\x01" * 40, BodyType.Attestation, attestation)
+        self.assertEqual(MsgpackSerialize.unpack(Message, MsgpackSerialize.pack(message)), message)
+
+
+class SlottedModelTests(unittest.TestCase):
+
+    def make_objects(self):
+        attachement = Attachement(b"\x07" * 32, None, b"\x08" * 300, b"\x0b" * 32, [b"\x09" * 32])
+        address = Address("2nPfgysH5URwM6mcknqwNEgbCi9C36oQsdZ")
+        metadata = Assertion.Metadata(b"\x01" * 40, "value")
+        assertion = Assertion(address, datetime.date(2020, 1, 1), datetime.date(2020, 1, 1), b"\x02" * 32,
+                              {"Name": metadata})
+        enveloppe = MessageEnveloppe(b"\x04" * 32, b"\x05" * 32, address, b"\x06" * 128, b"message",
+                                     {address: b"key"}, [attachement])
+        return [attachement, metadata, assertion, enveloppe]
+
+    def test_Slotted_NoDictAndFrozen(self):
+        for obj in self.make_objects():
+            self.assertFalse(hasattr(obj, "__dict__"), type(obj).__name__)
+            with self.assertRaises(dataclasses.FrozenInstanceError):
+                setattr(obj, dataclasses.fields(obj)[0].name, None)
+        self.assertIsNone(self.make_objects()[3].replacesMsgHash)
+
+    def test_Slotted_PickleCopyReplace(self):
+        for obj in self.make_objects():
+            self.assertEqual(pickle.loads(pickle.dumps(obj)), obj)
+            self.assertEqual(copy.copy(obj), obj)
+            self.assertEqual(copy.deepcopy(obj), obj)
+            name = dataclasses.fields(obj)[0].name
+            self.assertEqual(dataclasses.replace(obj, **{name: getattr(obj, name)}), obj)
+
+    def test_Slotted_Serialization(self):
+        for obj in self.make_objects():
+            packed = MsgpackSerialize.pack(obj)
+            self.assertEqual(MsgpackSerialize.pack_stream(obj), packed)
+            self.assertEqual(MsgpackSerialize.unpack(type(obj), packed), obj)
+
+
+if __name__ == '__main__':
+    unittest.main()
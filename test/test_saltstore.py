@@ -0,0 +1,153 @@
+""" These tests require the same dependencies as test_serializations.py
+"""
+import os
+import tempfile
+import threading
+import unittest
+from crypto import AESKey, Address
+from main import SaltStorage
+from saltstore import LogSaltStore, MemorySaltStore, salt_key
+
+
+class LogSaltStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tempdir.name, "salts.log")
+        self.keys = [salt_key("metadata", "value%d" % i) for i in range(50)]
+        self.salts = [os.urandom(40) for _ in self.keys]
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def fill(self, store, start, end):
+        for key, salt in zip(self.keys[start:end], self.salts[start:end]):
+            store.put(key, salt)
+
+    def check(self, store, count):
+        for key, salt in zip(self.keys[:count], self.salts[:count]):
+            self.assertEqual(store.get(key), salt)
+        self.assertIsNone(store.get(salt_key("metadata", "unknown")))
+        self.assertEqual(len(store), count)
+
+    def test_Reopen_SaltsArePersisted(self):
+        for aes_key in (None, AESKey.generate()):
+            store = LogSaltStore(self.filename + str(aes_key is None), aes_key, cache_size=10)
+            self.fill(store, 0, 30)
+            store.close()
+            store = LogSaltStore(self.filename + str(aes_key is None), aes_key, cache_size=10)
+            self.check(store, 30)
+            self.assertEqual(len(store.cache), 10)
+            store.close()
+
+    def test_Snapshot_ThenAppend_Restored(self):
+        store = LogSaltStore(self.filename)
+        self.fill(store, 0, 20)
+        store.snapshot()
+        self.fill(store, 20, 30)
+        self.check(store, 30)
+        store.close()
+        store = LogSaltStore(self.filename)
+        self.assertEqual(len(store.index), 10)
+        self.check(store, 30)
+        store.snapshot()
+        self.fill(store, 30, 50)
+        store.close()
+        # Torn record at the end of the log
+        with open(self.filename, "ab") as fout:
+            fout.write(self.keys[0] + b"\x00")
+        store = LogSaltStore(self.filename)
+        self.check(store, 50)
+        store.close()
+
+    def test_Snapshot_Threshold_WrittenInBackground(self):
+        started, release = threading.Event(), threading.Event()
+        class SlowSnapshot(LogSaltStore):
+            def _merged_entries(self, snapshot_index, index):
+                started.set()
+                release.wait(10)
+                return LogSaltStore._merged_entries(snapshot_index, index)
+
+        store = SlowSnapshot(self.filename, snapshot_threshold=8)
+        self.fill(store, 0, 8)
+        self.assertTrue(started.wait(10))
+        # get and put are not blocked by the snapshot being written
+        self.fill(store, 8, 20)
+        self.salts[3] = os.urandom(40)
+        self.fill(store, 3, 4)
+        self.check(store, 20)
+        self.assertFalse(release.is_set())
+        snapshot_thread = store.snapshot_thread
+        self.assertTrue(snapshot_thread.is_alive())
+        release.set()
+        snapshot_thread.join(10)
+        self.assertEqual(len(store.snapshot_index) // LogSaltStore.INDEX_ENTRY.size, 8)
+        # The salt written again replaces its snapshot entry
+        self.assertEqual(len(store.index), 13)
+        self.check(store, 20)
+        store.close()
+        store = LogSaltStore(self.filename, snapshot_threshold=None)
+        self.assertEqual(len(store.index), 13)
+        self.check(store, 20)
+        store.snapshot()
+        store.close()
+        store = LogSaltStore(self.filename)
+        self.assertEqual(len(store.index), 0)
+        self.check(store, 20)
+        store.close()
+
+    def test_Encrypted_OtherKey_Fails(self):
+        store = LogSaltStore(self.filename, AESKey.generate())
+        self.fill(store, 0, 1)
+        store.close()
+        store = LogSaltStore(self.filename, AESKey.generate())
+        with self.assertRaises(ValueError):
+            store.get(self.keys[0])
+        store.close()
+        with open(self.filename, "rb") as fin:
+            self.assertNotIn(self.salts[0], fin.read())
+
+    def test_SaltStorage_Backends_SameSaltsAcrossRestart(self):
+        sender, receiver = Address("2n9hLLzhpn4ueRHYoJBtcR7JkmtcV4omzLK"), Address("2n6HW4uS6Wqq8e4vgkQHnniCu3yrhvjHHHF")
+        memory = SaltStorage(MemorySaltStore(), randbytes=os.urandom)
+        self.assertEqual(memory.getDossierSalt(sender, 0, receiver, 1), memory.getDossierSalt(sender, 0, receiver, 1))
+        storage = SaltStorage(LogSaltStore(self.filename), randbytes=os.urandom)
+        dossierSalt = storage.getDossierSalt(sender, 0, receiver, 1)
+        metadataSalt = storage.getMetadataSalt("John")
+        self.assertNotEqual(storage.getDossierSalt(sender, 0, None, None), dossierSalt)
+        storage.backend.close()
+        storage = SaltStorage(LogSaltStore(self.filename), randbytes=os.urandom)
+        self.assertEqual(storage.getDossierSalt(sender, 0, receiver, 1), dossierSalt)
+        self.assertEqual(storage.getMetadataSalt("John"), metadataSalt)
+        storage.backend.close()
+
+    def test_SaltStorage_ConcurrentFirstUse_OneSalt(self):
+        class SlowStore(MemorySaltStore):
+            """ Lets the other threads run between get and put """
+            def __init__(self, barrier):
+                super().__init__()
+                self.barrier = barrier
+
+            def get(self, key):
+                salt = super().get(key)
+                if salt is None:
+                    try:
+                        self.barrier.wait(0.5)
+                    except threading.BrokenBarrierError:
+                        pass
+                return salt
+
+        barrier = threading.Barrier(4)
+        storage = SaltStorage(SlowStore(barrier), randbytes=os.urandom)
+        salts = []
+        threads = [threading.Thread(target=lambda: salts.append(storage.getMetadataSalt("John"))) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(salts)), 1)
+        self.assertEqual(len(storage.backend), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
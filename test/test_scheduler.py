@@ -0,0 +1,159 @@
+""" These tests require the same dependencies as test_serializations.py
+"""
+import os
+import sqlite3
+import threading
+import time
+import unittest
+from dataclasses import replace
+from scheduler import AttestationScheduler
+from test_attestation import AttestationTestCase, ADDRESS
+
+
+class RecordingEngine():
+    """ Forwards to an AttestationEngine, records the attestation types of the jobs run and the enveloppes
+        scanned. build_attestation sets started, then waits for the gate to be set.
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        self.gate = threading.Event()
+        self.started = threading.Event()
+        self.processed = []
+        self.scanned = 0
+
+    def scan_assertion(self, *args):
+        self.scanned += 1
+        return self.engine.scan_assertion(*args)
+
+    def rules_for(self, fields):
+        return self.engine.rules_for(fields)
+
+    def build_attestation(self, subject, rules):
+        self.started.set()
+        self.gate.wait(10)
+        attestation = self.engine.build_attestation(subject, rules)
+        self.processed.append([entry.attestType for entry in attestation.attestations])
+        return attestation
+
+
+class AttestationSchedulerTests(AttestationTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.filename = os.path.join(self.tempdir.name, "attestations.sqlite")
+        self.recording = RecordingEngine(self.engine)
+
+    def wait_empty(self, scheduler):
+        for _ in range(1000):
+            if len(scheduler) == 0:
+                return
+            time.sleep(0.01)
+        self.fail("Jobs still pending")
+
+    def test_Submit_PriorityOrder(self):
+        scheduler = AttestationScheduler(self.recording, self.filename, workers=1)
+        terms = self.make_assertion([{"TermsAndConditions": True}])
+        address = self.make_assertion([ADDRESS])
+        identity = self.make_assertion([{"IdentityDocument": b"passport"}])
+        # The worker is busy with the first job while the others are queued
+        futures = [scheduler.submit(terms)]
+        self.assertTrue(self.recording.started.wait(10))
+        futures += [scheduler.submit(address), scheduler.submit(identity)]
+        self.recording.gate.set()
+        attestations = [future.result(10) for future in futures]
+        scheduler.close()
+        self.assertEqual(attestations, [self.engine.get_attestation(e) for e in (terms, address, identity)])
+        self.assertEqual([names[:1] for names in self.recording.processed], [[], ["MRZ"], ["AddressValidity"]])
+
+    def test_Submit_DuplicateDocumentsFromStore(self):
+        self.recording.gate.set()
+        scheduler = AttestationScheduler(self.recording, self.filename, workers=2)
+        first = self.make_assertion([ADDRESS, {"IdentityDocument": b"passport"}])
+        second = self.make_assertion([ADDRESS, {"IdentityDocument": b"passport"}])
+        other = self.make_assertion([{"IdentityDocument": b"other passport"}])
+        expected = scheduler.submit(first).result(10)
+        self.assertEqual(scheduler.submit(second).result(10), expected)
+        self.assertNotEqual(scheduler.submit(other).result(10), expected)
+        self.assertEqual(len(self.recording.processed), 2)
+        self.assertEqual(self.recording.scanned, 3)
+        subject = self.customer_key.address()
+        self.assertEqual(scheduler.result(subject, first.messageHash), expected)
+        self.assertEqual(scheduler.result(subject, second.messageHash), expected)
+        self.assertIsNone(scheduler.result(subject, b"\x00" * 32))
+        scheduler.close()
+
+    def test_Restart_PendingJobsRun(self):
+        scheduler = AttestationScheduler(self.recording, self.filename, workers=0)
+        enveloppes = [self.make_assertion([ADDRESS]), self.make_assertion([{"IdentityDocument": b"passport"}])]
+        for enveloppe in enveloppes:
+            scheduler.submit(enveloppe)
+        self.assertEqual(len(scheduler), 2)
+        scheduler.close()
+        self.recording.gate.set()
+        scheduler = AttestationScheduler(self.recording, self.filename, workers=1)
+        self.wait_empty(scheduler)
+        subject = self.customer_key.address()
+        for enveloppe in enveloppes:
+            self.assertEqual(scheduler.result(subject, enveloppe.messageHash), self.engine.get_attestation(enveloppe))
+        scheduler.close()
+
+    def test_Restart_DuplicatesOfPendingJobStored(self):
+        scheduler = AttestationScheduler(self.recording, self.filename, workers=0)
+        first = self.make_assertion([ADDRESS])
+        second = self.make_assertion([ADDRESS])
+        scheduler.submit(first)
+        scheduler.submit(second)
+        self.assertEqual(len(scheduler), 1)
+        scheduler.close()
+        self.recording.gate.set()
+        scheduler = AttestationScheduler(self.recording, self.filename, workers=1)
+        self.wait_empty(scheduler)
+        subject = self.customer_key.address()
+        expected = self.engine.get_attestation(first)
+        self.assertEqual(scheduler.result(subject, first.messageHash), expected)
+        self.assertEqual(scheduler.result(subject, second.messageHash), expected)
+        self.assertEqual(len(self.recording.processed), 1)
+        scheduler.close()
+
+    def test_Work_StoreFails_FutureFailsWorkerGoesOn(self):
+        class FailingDB():
+            """ The first executemany (storing the results) fails """
+            def __init__(self, db):
+                self.db = db
+                self.failed = False
+            def executemany(self, *args):
+                if not self.failed:
+                    self.failed = True
+                    raise sqlite3.OperationalError("disk I/O error")
+                return self.db.executemany(*args)
+            def __getattr__(self, name):
+                return getattr(self.db, name)
+
+        self.recording.gate.set()
+        scheduler = AttestationScheduler(self.recording, self.filename, workers=1)
+        scheduler.db = FailingDB(scheduler.db)
+        with self.assertRaises(sqlite3.OperationalError):
+            scheduler.submit(self.make_assertion([ADDRESS])).result(10)
+        enveloppe = self.make_assertion([{"IdentityDocument": b"passport"}])
+        self.assertEqual(scheduler.submit(enveloppe).result(10), self.engine.get_attestation(enveloppe))
+        # The failed job is kept, to run again after a restart
+        self.assertEqual(len(scheduler), 1)
+        scheduler.close()
+
+    def test_Submit_ObjectHashMismatch_ValueError(self):
+        scheduler = AttestationScheduler(self.recording, self.filename, workers=0)
+        enveloppe = self.make_assertion([{"IdentityDocument": b"passport"}])
+        other = self.make_assertion([{"IdentityDocument": b"other passport"}])
+        forged = replace(enveloppe, attachements=[replace(enveloppe.attachements[0],
+                                                          objectHash=other.attachements[0].objectHash)])
+        with self.assertRaisesRegex(ValueError, "objectHash"):
+            scheduler.submit(forged)
+        missing = replace(enveloppe, attachements=[replace(enveloppe.attachements[0], objectHash=None)])
+        with self.assertRaisesRegex(ValueError, "objectHash"):
+            scheduler.submit(missing)
+        self.assertEqual(len(scheduler), 0)
+        scheduler.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,8 +6,13 @@
         pip install msgpack
         pip install parameterized
 """
-from typing import Dict
+from concurrent.futures import ThreadPoolExecutor
+import dataclasses
+from typing import Dict, List
+import sys
+import threading
 import os
+import io
 from forms import XForm, BooleanField, FileField, get_metadata_dict
 import datetime
 import hashlib
@@ -17,7 +22,8 @@ from model import Address, Message, MessageEnveloppe,\
     Assertion, BodyType, Attachement, MessageAnalysis,\
     ResearchAnalysis
 from crypto import RSAKey, AESKey
-from serialization import MsgpackSerialize
+from serialization import MsgpackSerialize, msgpack_skip, msgpack_bin, msgpack_array_header
+from reflective_serialization import ReflectiveMsgpackSerialize
 from utils import merge_dicts, read_file_contents
 from Crypto.Hash import SHA256
 from binascii import hexlify, unhexlify
@@ -126,6 +132,11 @@ class MessageBodySerializationTests(unittest.TestCase):
         # 2/  When packed with msgpack we get (in hex):
         serialized_body = MsgpackSerialize.pack(messageBody)
         self.assertEqual(serialized_body,  unhexlify(result_hex))
+        # 3/ The single pass encoder writes the same bytes, in memory or into a stream
+        self.assertEqual(MsgpackSerialize.pack_stream(messageBody),  unhexlify(result_hex))
+        fout = io.BytesIO()
+        MsgpackSerialize.dump(messageBody, fout)
+        self.assertEqual(fout.getvalue(),  unhexlify(result_hex))
 
 
 class MessageSerializationTests(unittest.TestCase):
@@ -151,6 +162,7 @@ class MessageSerializationTests(unittest.TestCase):
         # 2/  When packed with msgpack we get (in hex):
         serialized_message = MsgpackSerialize.pack(message)
         self.assertEqual(serialized_message,  unhexlify(expected_hex))
+        self.assertEqual(MsgpackSerialize.pack_stream(message),  unhexlify(expected_hex))
 
 
 class MessageSignatureTests(unittest.TestCase):
@@ -184,5 +196,69 @@ class MessageEncryptionTests(unittest.TestCase):
        
 
 
+class CompiledSerializationTests(unittest.TestCase):
+    @parameterized.expand([
+        (Assertion(subjectAddr=Address(address='2n4gSd2aVC6Dep5ECS4NRCw3AG2p73r7DcM'),
+                   validUntil=datetime.date(2020, 1, 1),
+                   retainUntil=None,
+                   containerKey=b"\x01" * 32,
+                   Meta={'Name': Assertion.Metadata(MetaSalt=b"\x02" * 40, MetaValue='John')}),),
+        (Message(serviceID=1,
+                 consumerID=2,
+                 dossierSalt=b"",
+                 bodyType=BodyType.InviteRegistration,
+                 body=InviteRegistration(boostrapNode="http://api.bitstamp.com/teleferic",
+                                         boostrapAddr=Address('2nPfgysH5URwM6mcknqwNEgbCi9C36oQsdZ'),
+                                         offeringAddr=Address('2n9hLLzhpn4ueRHYoJBtcR7JkmtcV4omzLK'),
+                                         serviceAnnouncementMessage=b"\x03" * 32,
+                                         serviceOfferingID=1,
+                                         inviteName=b"\x04" * 45)),),
+        (MessageEnveloppe(messageHash=b"\x05" * 32,
+                          dossierHash=b"\x06" * 32,
+                          senderAddr=Address('2n4gSd2aVC6Dep5ECS4NRCw3AG2p73r7DcM'),
+                          messageSig=b"\x07" * 128,
+                          message=b"\x08" * 100,
+                          ACL={Address('2n6HW4uS6Wqq8e4vgkQHnniCu3yrhvjHHHF'): b"\x09" * 128,
+                               Address('2n4gSd2aVC6Dep5ECS4NRCw3AG2p73r7DcM'): b"\x0c" * 128},
+                          attachements=[Attachement(None, None, b"\x0a" * 64, None, [b"\x0b" * 32])]),),
+    ])
+    def test_Serialization_CompiledPlans_MatchReflective(self, obj):
+        packed = MsgpackSerialize.pack(obj)
+        self.assertEqual(packed, ReflectiveMsgpackSerialize.pack(obj))
+        self.assertEqual(MsgpackSerialize.unpack(type(obj), packed), obj)
+        self.assertEqual(ReflectiveMsgpackSerialize.unpack(type(obj), packed), obj)
+
+    def test_Scan_TruncatedData_ValueError(self):
+        packed = MsgpackSerialize.pack(MessageEnveloppe(b"\x05" * 32, b"\x06" * 32, Address('2n4gSd2aVC6Dep5ECS4NRCw3AG2p73r7DcM'),
+                                                        b"\x07" * 128, b"\x08" * 300, {}, [Attachement(None, None, b"\x0a" * 70000, None, [])]))
+        self.assertEqual(msgpack_skip(packed, 0), len(packed))
+        for size in list(range(0, 400)) + [len(packed) - 1]:
+            with self.assertRaises(ValueError):
+                msgpack_skip(memoryview(packed)[:size], 0)
+        with self.assertRaises(ValueError):
+            msgpack_bin(MsgpackSerialize.pack(b"\x01" * 300)[:100], 0)
+        with self.assertRaises(ValueError):
+            msgpack_array_header(b"", 0)
+
+    def test_Serialization_ConcurrentFirstUnpack(self):
+        # Each round compiles the plan of new dataclasses while several threads unpack them
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        self.addCleanup(sys.setswitchinterval, switch_interval)
+        for round in range(30):
+            fields = [("f%d" % i, Dict[str, int]) for i in range(100)]
+            inner = dataclasses.make_dataclass("Inner%d" % round, fields, frozen=True)
+            outer = dataclasses.make_dataclass("Outer%d" % round, [("items", List[inner]), ("name", str)], frozen=True)
+            obj = outer([inner(*[{"k": i} for i in range(100)])], "outer")
+            packed = MsgpackSerialize.pack(obj)
+            barrier = threading.Barrier(8)
+            def unpack():
+                barrier.wait()
+                return MsgpackSerialize.unpack(outer, packed)
+            with ThreadPoolExecutor(8) as executor:
+                results = list(executor.map(lambda _: unpack(), range(8)))
+            self.assertEqual(results, [obj] * 8)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,358 @@
+""" These tests require the same dependencies as test_serializations.py
+"""
+import asyncio
+import hashlib
+import os
+import random
+import tempfile
+import unittest
+from dataclasses import replace
+from main import TelefericClient, TelefericServer
+from pipeline import Pipeline, Stage, EnveloppePipeline
+from aioteleferic import AsyncTelefericServer, AsyncTelefericClient, InProcessTransport, SocketTransport, FRAME_HEADER, \
+    STATUS_OK, TelefericError
+from model import Message, RegistrationRequest, InviteRegistration, Address, BodyType, Attachement
+from crypto import RSAKey, AESKey
+from blobstore import BlobStore
+from cryptopool import CryptoExecutor
+from serialization import MsgpackSerialize
+
+
+class PublicKeyServer():
+    """ Only provides the public keys (TelefericServer writes its key to the current directory) """
+    def __init__(self, keys):
+        self.public_keys = {key.address(): key.public_key() for key in keys}
+
+    def get_pubkey_for_address(self, addr):
+        return self.public_keys.get(addr)
+
+
+def registration_request(i):
+    return RegistrationRequest(b"\x01" * 32, b"\x02" * 128, "AccountLevel%d" % i, "30819f30", "nickname%d" % i)
+
+
+def invite_registration(i):
+    return InviteRegistration("http://api.bitstamp.com/teleferic", Address("2nPfgysH5URwM6mcknqwNEgbCi9C36oQsdZ"),
+                              Address("2n9hLLzhpn4ueRHYoJBtcR7JkmtcV4omzLK"), b"\x03" * 32, i, b"\x04" * 45)
+
+
+class TelefericClientTests(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.sender_key = RSAKey.generate(1024)
+        cls.receiver_keys = [RSAKey.generate(1024) for _ in range(2)]
+        cls.server = PublicKeyServer(cls.receiver_keys)
+
+    def make_batch(self):
+        receivers = [(key.address(), 0) for key in self.receiver_keys]
+        return [(self.sender_key, 0, receivers, registration_request(0)),
+                (self.sender_key, 1, receivers[:1], registration_request(1), []),
+                (self.sender_key, 0, [], invite_registration(2), [], [])]
+
+    def check_enveloppe(self, enveloppe, expected, destination_list):
+        self.assertEqual(enveloppe.messageHash, hashlib.sha256(enveloppe.message).digest())
+        self.assertEqual(enveloppe.senderAddr, self.sender_key.address())
+        self.assertEqual(set(enveloppe.ACL.keys()), set(addr for addr, _ in destination_list))
+        if destination_list:
+            receiver_key = self.receiver_keys[0]
+            message = enveloppe.decrypt(receiver_key.address(), receiver_key)
+        else:
+            message = MsgpackSerialize.unpack(Message, enveloppe.message)
+        self.assertEqual(message, expected)
+        self.assertTrue(self.sender_key.verify(MsgpackSerialize.pack(message), enveloppe.messageSig))
+
+    def test_MakeEnveloppes_Batch_MatchesSingleCalls(self):
+        random.seed(0)
+        single_client = TelefericClient(self.server)
+        singles = [single_client.make_enveloppe(*entry) for entry in self.make_batch()]
+        random.seed(0)
+        batch_client = TelefericClient(self.server)
+        batch = batch_client.make_enveloppes(self.make_batch())
+        self.assertEqual(len(batch), len(singles))
+        for entry, single, batched in zip(self.make_batch(), singles, batch):
+            sender_key, senderID, destination_list, body = entry[:4]
+            self.assertEqual(batched.dossierHash, single.dossierHash)
+            receiverID = destination_list[0][1] if destination_list else None
+            expected = Message(senderID, receiverID, single_client.salt_storage.getDossierSalt(
+                                   sender_key.address(), senderID, destination_list[0][0] if destination_list else None, receiverID),
+                               BodyType[type(body).__name__], body)
+            self.check_enveloppe(single, expected, destination_list)
+            self.check_enveloppe(batched, expected, destination_list)
+
+    def test_MakeEnveloppes_CryptoExecutor_SignsAndWrapsKeys(self):
+        random.seed(0)
+        with CryptoExecutor(2) as executor:
+            client = TelefericClient(self.server, executor)
+            enveloppes = client.make_enveloppes(self.make_batch())
+        for entry, enveloppe in zip(self.make_batch(), enveloppes):
+            sender_key, senderID, destination_list, body = entry[:4]
+            receiverID = destination_list[0][1] if destination_list else None
+            expected = Message(senderID, receiverID, client.salt_storage.getDossierSalt(
+                                   sender_key.address(), senderID, destination_list[0][0] if destination_list else None, receiverID),
+                               BodyType[type(body).__name__], body)
+            self.check_enveloppe(enveloppe, expected, destination_list)
+
+
+class TelefericServerTestCase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.sender_key = RSAKey.generate(1024)
+        cls.customer_key = RSAKey.generate(1024)
+
+    def setUp(self):
+        # TelefericServer keeps its key in the current directory
+        self.cwd = os.getcwd()
+        self.tempdir = tempfile.TemporaryDirectory()
+        os.chdir(self.tempdir.name)
+        self.server = TelefericServer({self.sender_key.address(): self.sender_key.public_key()})
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tempdir.cleanup()
+
+    def make_batch(self, count):
+        batch = [(self.sender_key, 0, [], invite_registration(i)) for i in range(count)]
+        registration = RegistrationRequest(b"\x01" * 32, b"\x02" * 128, "AccountLevel1",
+                                           self.customer_key.public_key_hex(), "nickname1")
+        batch.append((self.customer_key, 0, [(self.server.get_server_address(), 0)], registration))
+        return batch
+
+
+class EnveloppePipelineTests(TelefericServerTestCase):
+
+    def test_Pipeline_SendMessages_SameHashesAsSendEnveloppe(self):
+        batch = self.make_batch(20)
+        with EnveloppePipeline(TelefericClient(self.server), {"sign": 2}, queue_size=4) as pipeline:
+            hashes = pipeline.map(batch)
+            stats = pipeline.stats()
+        self.assertEqual(len(set(hashes)), len(batch))
+        self.assertIsNotNone(self.server.get_pubkey_for_address(self.customer_key.address()))
+        self.assertEqual(list(stats.keys()), list(EnveloppePipeline.STAGES))
+        for latency, depth, max_depth in stats.values():
+            self.assertEqual(latency.count, len(batch))
+            self.assertEqual(depth, 0)
+            self.assertLessEqual(max_depth, 4)
+
+    def test_Pipeline_ConcurrentPack_OneSaltPerDossier(self):
+        client = TelefericClient(self.server)
+        batch = [(self.sender_key, 0, [], invite_registration(i)) for i in range(20)]
+        enveloppes = []
+        send_enveloppe = self.server.send_enveloppe
+        self.server.send_enveloppe = lambda enveloppe: enveloppes.append(enveloppe) or send_enveloppe(enveloppe)
+        with EnveloppePipeline(client, {"pack": 4, "wrap": 2}, queue_size=4, context_size=3) as pipeline:
+            pipeline.map(batch)
+            # The contexts are renewed every 3 messages
+            self.assertLessEqual(pipeline.context_uses, 3)
+        self.assertEqual(len(set(enveloppe.dossierHash for enveloppe in enveloppes)), 1)
+
+    def test_Pipeline_StageFails_FutureHasTheException(self):
+        def fail(item):
+            raise ValueError(item)
+        with Pipeline([Stage("double", lambda x: 2 * x), Stage("fail", fail), Stage("never", lambda x: x)]) as pipeline:
+            future = pipeline.submit(21)
+            with self.assertRaises(ValueError):
+                future.result()
+            self.assertEqual(pipeline.stats()["never"][0].count, 0)
+
+
+class AsyncTelefericServerTests(TelefericServerTestCase):
+
+    def run_client(self, connect):
+        async def scenario():
+            async with AsyncTelefericServer(self.server, max_queue=4, workers=2) as async_server:
+                transport = await connect(async_server)
+                client = AsyncTelefericClient(TelefericClient(self.server), transport)
+                batch = self.make_batch(20)
+                hashes = await client.send_messages(batch)
+                await transport.close()
+                return batch, hashes
+        return asyncio.run(scenario())
+
+    def check_results(self, batch, hashes):
+        self.assertEqual(len(hashes), len(batch))
+        self.assertTrue(all(len(h) == 32 for h in hashes))
+        self.assertEqual(len(set(hashes)), len(batch))
+        # The registration was applied by the server
+        self.assertIsNotNone(self.server.get_pubkey_for_address(self.customer_key.address()))
+
+    def test_SubmitEnvelope_InProcess_ReturnsMessageHashes(self):
+        async def connect(async_server):
+            return InProcessTransport(async_server)
+        self.check_results(*self.run_client(connect))
+
+    def test_SubmitEnvelope_Socket_ReturnsMessageHashes(self):
+        async def connect(async_server):
+            tcp_server = await async_server.serve()
+            return await SocketTransport.connect(*tcp_server.sockets[0].getsockname()[:2])
+        self.check_results(*self.run_client(connect))
+
+    def test_SubmitEnvelope_SameAsSendEnveloppe(self):
+        enveloppe = TelefericClient(self.server).make_enveloppe(self.sender_key, 0, [], invite_registration(0))
+        async def submit():
+            async with AsyncTelefericServer(self.server) as async_server:
+                return await async_server.submit_envelope(enveloppe)
+        messageHash = asyncio.run(submit())
+        self.assertEqual(messageHash, self.server.send_enveloppe(enveloppe))
+
+    def test_Serve_FrameTooLarge_ConnectionClosed(self):
+        async def scenario():
+            async with AsyncTelefericServer(self.server, max_frame_size=1024) as async_server:
+                tcp_server = await async_server.serve()
+                reader, writer = await asyncio.open_connection(*tcp_server.sockets[0].getsockname()[:2])
+                writer.write(FRAME_HEADER.pack(1 << 31))
+                await writer.drain()
+                data = await asyncio.wait_for(reader.read(), 5)
+                writer.close()
+                tcp_server.close()
+                return data
+        self.assertEqual(asyncio.run(scenario()), b"")
+
+    def test_HandleConnection_BrokenWriter_Returns(self):
+        class BrokenWriter():
+            def write(self, data):
+                pass
+            async def drain(self):
+                raise ConnectionResetError()
+            def close(self):
+                pass
+        async def scenario():
+            async with AsyncTelefericServer(self.server, max_queue=2) as async_server:
+                reader = asyncio.StreamReader()
+                for _ in range(10):
+                    reader.feed_data(FRAME_HEADER.pack(3) + b"bad")
+                # The reader stays open: the connection is only ended by the write failure
+                await asyncio.wait_for(async_server._handle_connection(reader, BrokenWriter()), 5)
+        asyncio.run(scenario())
+
+    def test_SocketTransport_SendFails_PendingFail(self):
+        class BrokenWriter():
+            def __init__(self):
+                self.broken = False
+            def write(self, data):
+                pass
+            async def drain(self):
+                if self.broken:
+                    raise ConnectionResetError()
+            def close(self):
+                pass
+        async def scenario():
+            writer = BrokenWriter()
+            transport = SocketTransport(asyncio.StreamReader(), writer)
+            first = asyncio.ensure_future(transport.send_packed_enveloppe(b"first"))
+            await asyncio.sleep(0)
+            writer.broken = True
+            with self.assertRaises(ConnectionResetError):
+                await transport.send_packed_enveloppe(b"second")
+            with self.assertRaises(TelefericError):
+                await first
+            self.assertEqual(len(transport.pending), 0)
+            transport.reader_task.cancel()
+        asyncio.run(scenario())
+
+    def test_SocketTransport_CancelledDuringDrain_AnswersInOrder(self):
+        class BlockingWriter():
+            def __init__(self):
+                self.frames = []
+                self.blocked = asyncio.Event()
+                self.release = asyncio.Event()
+            def write(self, data):
+                self.frames.append(data)
+            async def drain(self):
+                if len(self.frames) == 4:
+                    # Second frame (header and payload written)
+                    self.blocked.set()
+                    await self.release.wait()
+            def close(self):
+                pass
+        def answer(messageHash):
+            data = bytes([STATUS_OK]) + messageHash
+            return FRAME_HEADER.pack(len(data)) + data
+        async def scenario():
+            reader = asyncio.StreamReader()
+            writer = BlockingWriter()
+            transport = SocketTransport(reader, writer)
+            first = asyncio.ensure_future(transport.send_packed_enveloppe(b"first"))
+            second = asyncio.ensure_future(transport.send_packed_enveloppe(b"second"))
+            await writer.blocked.wait()
+            second.cancel()
+            third = asyncio.ensure_future(transport.send_packed_enveloppe(b"third"))
+            await asyncio.sleep(0)
+            # The cancelled frame was sent: the server answers the three frames
+            reader.feed_data(answer(b"1") + answer(b"2") + answer(b"3"))
+            self.assertEqual(await first, b"1")
+            self.assertEqual(await third, b"3")
+            self.assertTrue(second.cancelled())
+            self.assertEqual(len(transport.pending), 0)
+            transport.reader_task.cancel()
+        asyncio.run(scenario())
+
+
+class AttachementReferenceTests(TelefericServerTestCase):
+
+    def test_UploadAttachements_ContainersSentOnce(self):
+        server = TelefericServer({self.sender_key.address(): self.sender_key.public_key()},
+                                 blob_store=BlobStore(os.path.join(self.tempdir.name, "blobs")))
+        client = TelefericClient(server)
+        attachement = Attachement.make(AESKey.generate(), b"passport" * 1000, [])
+        uploads = []
+        put_blob = server.put_blob
+        server.put_blob = lambda *args: uploads.append(args) or put_blob(*args)
+        for i in range(3):
+            references = client.upload_attachements([attachement])
+            self.assertEqual(references, [attachement.reference()])
+            client.send_message(self.sender_key, 0, [], invite_registration(i), references)
+        self.assertEqual(len(uploads), 1)
+        self.assertEqual(server.get_blob(attachement.containerHash), attachement.objectContainer)
+        unknown = Attachement.make(AESKey.generate(), b"other", []).reference()
+        with self.assertRaises(KeyError):
+            client.send_message(self.sender_key, 0, [], invite_registration(3), [unknown])
+
+    def test_SendEnveloppe_ReferencesAcquiredUntilDropped(self):
+        blob_store = BlobStore(os.path.join(self.tempdir.name, "blobs"))
+        server = TelefericServer({self.sender_key.address(): self.sender_key.public_key()}, blob_store=blob_store)
+        client = TelefericClient(server)
+        attachement = Attachement.make(AESKey.generate(), b"passport" * 1000, [])
+        references = client.upload_attachements([attachement])
+        containerHash = attachement.containerHash
+        messageHashes = [client.send_message(self.sender_key, 0, [], invite_registration(i), references)
+                         for i in range(2)]
+        self.assertEqual(blob_store.refcount(containerHash), 2)
+        # Sending the same enveloppe again takes no other reference
+        enveloppe = client.make_enveloppe(self.sender_key, 0, [], invite_registration(2), references)
+        server.send_enveloppe(enveloppe)
+        server.send_enveloppe(enveloppe)
+        self.assertEqual(blob_store.refcount(containerHash), 3)
+        for messageHash in messageHashes:
+            server.drop_enveloppe(messageHash)
+        self.assertEqual(blob_store.refcount(containerHash), 1)
+        missing = replace(references[0], containerHash=None)
+        with self.assertRaisesRegex(ValueError, "containerHash"):
+            client.send_message(self.sender_key, 0, [], invite_registration(3), [missing])
+        blob_store.close()
+
+    def test_Retention_DroppedReferencesEvictable(self):
+        documents = [Attachement.make(AESKey.generate(), bytes([i]) * 8000, []) for i in range(4)]
+        size = len(documents[0].objectContainer)
+        blob_store = BlobStore(os.path.join(self.tempdir.name, "blobs"), max_size=size * 5 // 2)
+        server = TelefericServer({self.sender_key.address(): self.sender_key.public_key()}, blob_store=blob_store,
+                                 retained_enveloppes=1)
+        client = TelefericClient(server)
+        first = client.upload_attachements(documents[:1])
+        client.send_message(self.sender_key, 0, [], invite_registration(0), first)
+        client.upload_attachements(documents[1:3])
+        # The container of the retained enveloppe is kept, the unreferenced one is evicted
+        self.assertIn(documents[0].containerHash, blob_store)
+        self.assertNotIn(documents[1].containerHash, blob_store)
+        client.send_message(self.sender_key, 0, [], invite_registration(1), [documents[2].reference()])
+        self.assertEqual(blob_store.refcount(documents[0].containerHash), 0)
+        client.upload_attachements(documents[3:])
+        self.assertNotIn(documents[0].containerHash, blob_store)
+        self.assertIn(documents[2].containerHash, blob_store)
+        self.assertEqual(len(server.references), 1)
+        blob_store.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
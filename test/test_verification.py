@@ -0,0 +1,76 @@
+""" These tests require the same dependencies as test_serializations.py
+"""
+from dataclasses import replace
+import unittest
+from main import TelefericClient
+from model import RegistrationRequest
+from cryptopool import CryptoExecutor
+from verification import EnveloppeVerifier
+from utils import LatencyStats
+from test_teleferic import TelefericServerTestCase, invite_registration
+
+
+class EnveloppeVerifierTests(TelefericServerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = TelefericClient(self.server)
+        self.verifier = EnveloppeVerifier(self.server, cache_size=2)
+
+    def test_Verify_PublicEnveloppe_CachedBySignature(self):
+        enveloppe = self.client.make_enveloppe(self.sender_key, 0, [], invite_registration(1))
+        self.assertTrue(self.verifier.verify(enveloppe))
+        self.assertTrue(self.verifier.verify(enveloppe))
+        self.assertEqual((self.verifier.cache_stats.hits, self.verifier.cache_stats.misses), (1, 1))
+        forged = replace(enveloppe, messageSig=bytes(len(enveloppe.messageSig)))
+        self.assertFalse(self.verifier.verify(forged))
+        self.assertFalse(self.verifier.verify(replace(enveloppe, message=enveloppe.message + b"\x00")))
+        self.assertEqual(self.verifier.latency.count, 4)
+
+    def test_Verify_EncryptedEnveloppe_NeedsThePlaintext(self):
+        server_address = self.server.get_server_address()
+        enveloppe = self.client.make_enveloppe(self.sender_key, 0, [(server_address, 0)], invite_registration(1))
+        with self.assertRaises(ValueError):
+            self.verifier.verify(enveloppe)
+        plaintext = enveloppe.decrypt_raw(server_address, self.server.teleferic_key)
+        self.assertTrue(self.verifier.verify(enveloppe, plaintext))
+        # Unknown sender
+        self.assertFalse(self.verifier.verify(self.client.make_enveloppe(self.customer_key, 0, [], invite_registration(2))))
+
+    def test_VerifyMany_CryptoExecutor_SameResults(self):
+        enveloppes = [self.client.make_enveloppe(self.sender_key, 0, [], invite_registration(i)) for i in range(4)]
+        enveloppes[2] = replace(enveloppes[2], messageSig=enveloppes[1].messageSig)
+        with CryptoExecutor(1) as executor:
+            verifier = EnveloppeVerifier(self.server, crypto_executor=executor)
+            self.assertEqual(verifier.verify_many(enveloppes), [True, True, False, True])
+        self.assertEqual(self.verifier.verify_many(enveloppes), [True, True, False, True])
+        self.assertEqual(verifier.latency.count, 4)
+
+    def test_VerifyMany_LatencyPerEnveloppe(self):
+        enveloppes = [self.client.make_enveloppe(self.sender_key, 0, [], invite_registration(i)) for i in range(2)]
+        self.assertTrue(self.verifier.verify(enveloppes[0]))
+        self.verifier.latency = LatencyStats()
+        self.assertEqual(self.verifier.verify_many(enveloppes), [True, True])
+        # The cached enveloppe is not charged with the signature check of the other one
+        self.assertEqual(self.verifier.latency.count, 2)
+        self.assertLess(self.verifier.latency.total - self.verifier.latency.max, self.verifier.latency.max / 2)
+
+    def test_Server_WithVerifier_RejectsForgedEnveloppes(self):
+        self.server.verifier = EnveloppeVerifier(self.server)
+        for entry in self.make_batch(3):
+            self.server.send_enveloppe(self.client.make_enveloppe(*entry))
+        self.assertIsNotNone(self.server.get_pubkey_for_address(self.customer_key.address()))
+        # A registration signed by another key than the one registered
+        registration = RegistrationRequest(b"\x01" * 32, b"\x02" * 128, "AccountLevel1",
+                                           self.customer_key.public_key_hex(), "nickname1")
+        forged = self.client.make_enveloppe(self.sender_key, 0, [(self.server.get_server_address(), 0)], registration)
+        forged = replace(forged, senderAddr=self.customer_key.address())
+        with self.assertRaisesRegex(ValueError, "signature"):
+            self.server.send_enveloppe(forged)
+        enveloppe = self.client.make_enveloppe(self.sender_key, 0, [], invite_registration(1))
+        with self.assertRaisesRegex(ValueError, "messageHash"):
+            self.server.send_enveloppe(replace(enveloppe, messageHash=bytes(32)))
+
+
+if __name__ == '__main__':
+    unittest.main()